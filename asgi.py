@@ -0,0 +1,3 @@
+from async_app import create_asgi_app
+
+app = create_asgi_app()
@@ -0,0 +1,342 @@
+# async_app.py
+"""
+Modo de servicio asíncrono (ASGI).
+
+Las rutas de streaming y /api/ask se atienden con el cliente AsyncOpenAI dentro
+de un event loop, de modo que un solo proceso puede mantener cientos de streams
+abiertos. El resto de rutas de `create_app()` se sirven tal cual a través de
+WsgiToAsgi.
+
+La validación (login, CSRF, middleware de modelos) y el acceso a la base de
+datos siguen ejecutándose en código Flask síncrono, en un hilo aparte, usando
+los mismos helpers de `routes.py` que las vistas síncronas.
+"""
+import asyncio
+import io
+import re
+import sys
+import time
+
+import openai
+from asgiref.wsgi import WsgiToAsgi
+from flask import jsonify
+from flask_login import login_required
+
+import metrics
+import routes
+from stream_buffer import sse_event, SSE_KEEPALIVE
+from upstream import build_async_upstream, UpstreamUnavailable
+from usage import quota_required
+
+STREAM_PATH = re.compile(r"^/api/conversations/(\d+)/messages/stream$")
+ASK_PATH = "/api/ask"
+
+
+def _build_environ(scope, body):
+    """Construye un environ WSGI mínimo a partir de un scope HTTP de ASGI."""
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": scope.get("root_path", "").encode("utf8").decode("latin1"),
+        "PATH_INFO": scope["path"].encode("utf8").decode("latin1"),
+        "QUERY_STRING": scope.get("query_string", b"").decode("ascii"),
+        "SERVER_PROTOCOL": "HTTP/%s" % scope.get("http_version", "1.1"),
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": io.BytesIO(body),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": True,
+        "wsgi.run_once": False,
+        # La duración de estas peticiones la mide AsyncStreamingApp, no Flask
+        metrics.NATIVE_ASYNC_KEY: True,
+    }
+    server = scope.get("server") or ("localhost", 80)
+    environ["SERVER_NAME"] = server[0]
+    environ["SERVER_PORT"] = str(server[1] or 80)
+    if scope.get("client"):
+        environ["REMOTE_ADDR"] = scope["client"][0]
+        environ["REMOTE_PORT"] = str(scope["client"][1])
+
+    for name, value in scope.get("headers", []):
+        name = name.decode("latin1")
+        value = value.decode("latin1")
+        if name == "content-length":
+            key = "CONTENT_LENGTH"
+        elif name == "content-type":
+            key = "CONTENT_TYPE"
+        else:
+            key = "HTTP_" + name.upper().replace("-", "_")
+        if key in environ:
+            value = environ[key] + "," + value
+        environ[key] = value
+    return environ
+
+
+async def _read_body(receive):
+    body = b""
+    more = True
+    while more:
+        message = await receive()
+        body += message.get("body", b"")
+        more = message.get("more_body", False)
+    return body
+
+
+async def _send_flask_response(send, response):
+    """Envía una respuesta Flask (ya completa) por ASGI."""
+    headers = [(k.lower().encode("latin1"), v.encode("latin1"))
+               for k, v in response.headers.to_wsgi_list()]
+    await send({"type": "http.response.start", "status": response.status_code, "headers": headers})
+    await send({"type": "http.response.body", "body": response.get_data()})
+
+
+class AsyncStreamingApp:
+    """
+    Aplicación ASGI que envuelve la app Flask.
+
+    - POST /api/ask y POST /api/conversations/<id>/messages/stream se atienden
+      de forma nativa con AsyncOpenAI.
+    - Todo lo demás se delega a la app Flask vía WsgiToAsgi.
+    """
+
+    def __init__(self, flask_app):
+        self.flask_app = flask_app
+        self.wsgi = WsgiToAsgi(flask_app)
+        self.upstream = build_async_upstream(flask_app)
+        self._prepare_ask = login_required(quota_required(
+            routes.model_constraints_middleware(routes.prepare_ask)))
+        self._prepare_stream = login_required(quota_required(
+            routes.model_constraints_middleware(routes.prepare_stream)))
+        # Productores SSE en curso (referencia fuerte hasta que terminen)
+        self._producers = set()
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and scope["method"] == "POST":
+            if scope["path"] == ASK_PATH:
+                return await self._timed("ask", self._ask, scope, receive, send)
+            match = STREAM_PATH.match(scope["path"])
+            if match:
+                return await self._timed("stream_messages", self._stream, scope, receive, send,
+                                         int(match.group(1)))
+        await self.wsgi(scope, receive, send)
+
+    async def _timed(self, endpoint, handler, scope, receive, send, *args):
+        """Mide como Flask (hasta las cabeceras) un endpoint atendido de forma nativa."""
+        started = time.perf_counter()
+
+        async def timed_send(message):
+            if message["type"] == "http.response.start":
+                metrics.observe_request(endpoint, "POST", message["status"], time.perf_counter() - started)
+            await send(message)
+
+        return await handler(scope, receive, timed_send, *args)
+
+    # --- Puente con Flask (se ejecuta en un hilo) ---
+
+    def _run_in_request(self, environ, fn, *args):
+        """
+        Ejecuta `fn` dentro de un contexto de petición Flask completo
+        (before_request, CSRF, sesión). Devuelve el job que produzca `fn`
+        o una Response de Flask si la petición termina ahí.
+        """
+        app = self.flask_app
+        with app.request_context(environ):
+            try:
+                rv = app.preprocess_request()
+                if rv is None:
+                    rv = fn(*args)
+            except Exception as e:
+                rv = app.handle_user_exception(e)
+            if isinstance(rv, (routes.AskJob, routes.StreamJob)):
+                return rv
+            return app.process_response(app.make_response(rv))
+
+    def _run_in_app(self, fn, *args):
+        with self.flask_app.app_context():
+            return fn(*args)
+
+    async def _prepare(self, scope, receive, fn, *args):
+        body = await _read_body(receive)
+        environ = _build_environ(scope, body)
+        try:
+            return await asyncio.to_thread(self._run_in_request, environ, fn, *args)
+        except Exception as e:
+            self.flask_app.logger.error("Error preparando petición async: %s", e, exc_info=True)
+            return await asyncio.to_thread(self._run_in_app, self._error_response,
+                                           "Error interno del servidor. Revisa los registros.", 500)
+
+    @staticmethod
+    def _error_response(message, status):
+        response = jsonify({"error": message})
+        response.status_code = status
+        return response
+
+    # --- Endpoints ---
+
+    async def _ask(self, scope, receive, send):
+        job = await self._prepare(scope, receive, self._prepare_ask)
+        if not isinstance(job, routes.AskJob):
+            return await _send_flask_response(send, job)
+
+        try:
+            flight = self.flask_app.extensions.get("single_flight")
+            if flight is None:
+                result, coalesced = await self._ask_call(job), False
+            else:
+                result, coalesced = await flight.do_async(job.flight_key, lambda: self._ask_call(job))
+                if coalesced:
+                    await asyncio.to_thread(self._run_in_app, routes.refund_rate_limit, job.rate_limit_charge)
+            response = self._run_in_app(lambda: jsonify(dict(result, coalesced=coalesced)))
+        except UpstreamUnavailable as e:
+            response = self._run_in_app(routes.upstream_unavailable_response, e)
+        except openai.BadRequestError as e:
+            self.flask_app.logger.error("BadRequest en /api/ask: %s", e, exc_info=True)
+            response = await asyncio.to_thread(self._run_in_app, self._error_response, e._message, 400)
+        except (openai.APIConnectionError, openai.InternalServerError) as e:
+            self.flask_app.logger.error("OpenAI no responde en /api/ask: %s", e, exc_info=True)
+            response = await asyncio.to_thread(self._run_in_app, self._error_response,
+                                               "OpenAI no responde. Inténtalo de nuevo.", 502)
+        except Exception as e:
+            self.flask_app.logger.error("Error en /api/ask: %s", e, exc_info=True)
+            response = await asyncio.to_thread(self._run_in_app, self._error_response,
+                                               "Error interno del servidor. Revisa los registros.", 500)
+        await _send_flask_response(send, response)
+
+    async def _ask_call(self, job):
+        resp = await self.upstream.create("responses", **job.params)
+        return await asyncio.to_thread(self._run_in_app, routes.ask_result, job, resp)
+
+    async def _stream(self, scope, receive, send, conv_id):
+        job = await self._prepare(scope, receive, self._prepare_stream, conv_id)
+        if not isinstance(job, routes.StreamJob):
+            return await _send_flask_response(send, job)
+
+        accept = dict(scope.get("headers") or []).get(b"accept", b"")
+        if b"text/event-stream" in accept:
+            return await self._stream_sse(send, job)
+
+        await send({
+            "type": "http.response.start",
+            "status": 200,
+            "headers": [
+                (b"content-type", b"text/plain; charset=utf-8"),
+                (b"cache-control", b"no-transform"),
+            ],
+        })
+
+        checkpoint = self._run_in_app(routes.stream_checkpoint, job)
+        status = routes.MessageStatusEnum.interrupted
+        try:
+            api, kwargs = routes.stream_request(job)
+            stream_resp = await self.upstream.create(api, **kwargs)
+
+            async for chunk in stream_resp:
+                delta = routes.stream_delta(job, chunk)
+                if not delta:
+                    continue
+                if checkpoint.add(delta):
+                    await asyncio.to_thread(self._run_in_app, checkpoint.flush)
+                await send({"type": "http.response.body", "body": delta.encode("utf-8"), "more_body": True})
+            status = routes.MessageStatusEnum.complete
+
+        except Exception as e:
+            self.upstream.report_failure(job.model, e)
+            self.flask_app.logger.error("Error en stream: %s", e, exc_info=True)
+            await send({
+                "type": "http.response.body",
+                "body": f"\n\n[Stream interrumpido: {e}]\n".encode("utf-8"),
+                "more_body": True,
+            })
+        finally:
+            # Se guarda incluso si el cliente se desconecta (CancelledError)
+            await asyncio.shield(asyncio.to_thread(
+                self._run_in_app, routes.save_stream_answer, job, checkpoint.text(), status
+            ))
+        await send({"type": "http.response.body", "body": b""})
+
+    # --- Modo SSE: el productor es una tarea independiente de la conexión ---
+
+    async def _stream_sse(self, send, job):
+        app = self.flask_app
+        checkpoint = self._run_in_app(routes.stream_checkpoint, job)
+        gen = app.extensions["stream_generations"].create(
+            job.message_id, job.conv_id, job.user_id, checkpoint.text
+        )
+        task = asyncio.create_task(self._produce(job, checkpoint, gen))
+        self._producers.add(task)
+        task.add_done_callback(self._producers.discard)
+
+        await send({
+            "type": "http.response.start",
+            "status": 200,
+            "headers": [
+                (b"content-type", b"text/event-stream; charset=utf-8"),
+                (b"cache-control", b"no-cache, no-transform"),
+                (b"x-accel-buffering", b"no"),
+            ],
+        })
+        start = sse_event(routes.stream_metadata(job, routes.MessageStatusEnum.streaming),
+                          event_id=0, event="start")
+        await send({"type": "http.response.body", "body": start.encode("utf-8"), "more_body": True})
+
+        loop = asyncio.get_running_loop()
+        wakeup = asyncio.Event()
+        # publish() puede llamarse desde otro hilo (checkpoints); se despierta vía el loop
+        wake = lambda: loop.call_soon_threadsafe(wakeup.set)
+        gen.add_listener(wake)
+        keepalive = app.config.get("STREAM_SSE_KEEPALIVE", 15)
+        after = 0
+        try:
+            while True:
+                wakeup.clear()
+                events, done, meta = gen.since(after)
+                for offset, delta in events:
+                    body = sse_event({"delta": delta}, event_id=offset)
+                    await send({"type": "http.response.body", "body": body.encode("utf-8"), "more_body": True})
+                    after = offset
+                if done:
+                    body = sse_event(meta, event_id=after, event="done")
+                    await send({"type": "http.response.body", "body": body.encode("utf-8"), "more_body": True})
+                    break
+                try:
+                    await asyncio.wait_for(wakeup.wait(), keepalive)
+                except asyncio.TimeoutError:
+                    await send({"type": "http.response.body", "body": SSE_KEEPALIVE.encode("utf-8"),
+                                "more_body": True})
+        finally:
+            # Si el cliente se va, la tarea productora sigue hasta el final
+            gen.remove_listener(wake)
+        await send({"type": "http.response.body", "body": b""})
+
+    async def _produce(self, job, checkpoint, gen):
+        status = routes.MessageStatusEnum.interrupted
+        try:
+            api, kwargs = routes.stream_request(job)
+            stream_resp = await self.upstream.create(api, **kwargs)
+
+            async for chunk in stream_resp:
+                delta = routes.stream_delta(job, chunk)
+                if not delta:
+                    continue
+                due = checkpoint.add(delta)
+                gen.publish(delta)
+                if due:
+                    await asyncio.to_thread(self._run_in_app, checkpoint.flush)
+            status = routes.MessageStatusEnum.complete
+        except Exception as e:
+            self.upstream.report_failure(job.model, e)
+            self.flask_app.logger.error("Error en stream: %s", e, exc_info=True)
+        finally:
+            try:
+                await asyncio.shield(asyncio.to_thread(
+                    self._run_in_app, routes.save_stream_answer, job, checkpoint.text(), status
+                ))
+            finally:
+                gen.finish(routes.stream_metadata(job, status))
+
+
+def create_asgi_app(flask_app=None):
+    if flask_app is None:
+        from manage import create_app
+        flask_app = create_app()
+    return AsyncStreamingApp(flask_app)
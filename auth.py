@@ -1,19 +1,21 @@
 from flask import Blueprint, render_template, request, redirect, url_for, flash, current_app
 from flask_login import login_user, logout_user, current_user, login_required
 from models import User, db
+from mail_outbox import enqueue_email
+from password_hashing import HasherBusy, init_password_hashing
 from flask_wtf import CSRFProtect, FlaskForm
 from wtforms import StringField, PasswordField, SubmitField
 from wtforms.validators import DataRequired, Email, EqualTo
 from datetime import datetime, timedelta
+import hmac
 import secrets
-import smtplib
-from email.mime.text import MIMEText
 from urllib.parse import urlparse, urljoin
 
 csrf = CSRFProtect()
 
 def init_app(app):
     csrf.init_app(app)
+    init_password_hashing(app)
     app.register_blueprint(auth_bp)
 
 class LoginForm(FlaskForm):
@@ -53,7 +55,11 @@ def register():
             return redirect(url_for("auth.register"))
 
         user = User(username=username, email=email)
-        user.set_password(password)
+        try:
+            user.password_hash = current_app.extensions["password_hasher"].hash(password)
+        except HasherBusy:
+            flash("Demasiadas peticiones, inténtalo de nuevo en unos segundos.", "error")
+            return render_template("register.html"), 503
         user.is_approved = False
         db.session.add(user)
         db.session.commit()
@@ -75,9 +81,16 @@ def login():
     if form.validate_on_submit():
         username_or_email = form.username.data
         password = form.password.data
-        user = User.query.filter((User.username == username_or_email) | (User.email == username_or_email)).first()
-
-        if user is None or not user.check_password(password):
+        user = User.find_by_login(username_or_email)
+        # Con usuario inexistente se verifica igual (contra un hash ficticio)
+        # para que el tiempo de respuesta no revele qué usuarios existen
+        try:
+            valid = current_app.extensions["password_hasher"].verify(user, password)
+        except HasherBusy:
+            flash("Demasiados intentos de acceso, inténtalo de nuevo en unos segundos.", "error")
+            return render_template('login.html', form=form), 503
+
+        if not valid:
             flash("Credenciales inválidas", "error")
             return redirect(url_for("auth.login"))
 
@@ -101,45 +114,28 @@ def logout():
     flash('Has cerrado sesión.', 'info')
     return redirect(url_for('auth.login'))
 
-def send_email(subject, recipient, body):
-    app = current_app._get_current_object()
-    msg = MIMEText(body, "html")
-    msg["Subject"] = subject
-    msg["From"] = app.config["MAIL_USERNAME"]
-    msg["To"] = recipient
-
-    try:
-        if app.config["MAIL_USE_SSL"]:
-            server = smtplib.SMTP_SSL(app.config["MAIL_SERVER"], app.config["MAIL_PORT"])
-        else:
-            server = smtplib.SMTP(app.config["MAIL_SERVER"], app.config["MAIL_PORT"])
-            if app.config["MAIL_USE_TLS"]:
-                server.starttls()
-        server.login(app.config["MAIL_USERNAME"], app.config["MAIL_PASSWORD"])
-        server.sendmail(app.config["MAIL_USERNAME"], [recipient], msg.as_string())
-        server.quit()
-    except Exception as e:
-        app.logger.error(f"Error enviando correo: {e}")
-
 @auth_bp.route('/reset_password_request', methods=['GET', 'POST'])
 def reset_password_request():
     if current_user.is_authenticated:
         return redirect(url_for('index'))
     form = ResetPasswordRequestForm()
     if form.validate_on_submit():
-        user = User.query.filter_by(email=form.email.data).first()
+        user = User.query.filter(db.func.lower(User.email) == form.email.data.lower()).first()
         if user:
             token = secrets.token_urlsafe(32)
-            user.reset_token = token
+            user.reset_token = User.hash_reset_token(token)
             user.reset_token_expiration = datetime.utcnow() + timedelta(hours=1)
-            db.session.commit()
             reset_url = url_for('auth.reset_password', token=token, _external=True)
             html_body = f"""
             <p>Para restablecer tu contraseña, haz clic en el siguiente enlace:</p>
             <p><a href="{reset_url}">{reset_url}</a></p>
             <p>Si no solicitaste este cambio, ignora este correo.</p>
             """
-            send_email("Restablecimiento de contraseña", user.email, html_body)
+            # El correo va a la outbox en la misma transacción que el token;
+            # lo envía el hilo de fondo, la respuesta no espera al SMTP
+            enqueue_email("Restablecimiento de contraseña", user.email, html_body)
+            db.session.commit()
+            current_app.extensions["mail_outbox"].notify()
         # Mostrar mensaje genérico para no revelar si el email existe
         flash('Si el correo está registrado, recibirás un enlace para restablecer la contraseña.', 'info')
         return redirect(url_for('auth.login'))
@@ -149,13 +145,19 @@ def reset_password_request():
 def reset_password(token):
     if current_user.is_authenticated:
         return redirect(url_for('index'))
-    user = User.query.filter_by(reset_token=token).first()
-    if user is None or user.reset_token_expiration is None or user.reset_token_expiration < datetime.utcnow():
+    token_hash = User.hash_reset_token(token)
+    user = User.query.filter_by(reset_token=token_hash).first()
+    if (user is None or not hmac.compare_digest(user.reset_token, token_hash)
+            or user.reset_token_expiration is None or user.reset_token_expiration < datetime.utcnow()):
         flash('El enlace de restablecimiento no es válido o ha expirado.', 'error')
         return redirect(url_for('auth.reset_password_request'))
     form = ResetPasswordForm()
     if form.validate_on_submit():
-        user.set_password(form.password.data)
+        try:
+            user.password_hash = current_app.extensions["password_hasher"].hash(form.password.data)
+        except HasherBusy:
+            flash("Demasiadas peticiones, inténtalo de nuevo en unos segundos.", "error")
+            return render_template('reset_password.html', form=form), 503
         user.reset_token = None
         user.reset_token_expiration = None
         db.session.commit()
@@ -0,0 +1,479 @@
+# batch_jobs.py
+"""
+Trabajos por lotes sobre la Batch API de OpenAI (endpoint `v1/batch`).
+
+Para muchos prompts que no necesitan respuesta inmediata (revisión de código
+de cientos de ficheros, generación de tests...). OpenAI los procesa en menos
+de 24 h a mitad de precio y sin consumir los límites de ritmo de las
+llamadas síncronas.
+
+Flujo de un BatchJob:
+
+    pending -> submitted -> completed | failed | expired | cancelled
+
+- `create_job` guarda el trabajo y un BatchItem por prompt (el `input` de la
+  Responses API, ya con el prompt de sistema).
+- `BatchRunner` reclama los trabajos vencidos igual que la outbox de correo
+  (UPDATE ... RETURNING sobre `next_poll_at` con un lease). Con uno pendiente
+  escribe el JSONL de entrada (una línea por item, `custom_id` = id del item),
+  lo sube y crea el batch. Con uno enviado consulta el batch cada
+  BATCH_POLL_INTERVAL segundos y actualiza el progreso.
+- Cuando el batch termina, lee en streaming los ficheros de salida y de
+  errores y guarda la respuesta, el error y los tokens de cada item. El
+  consumo se anota en el ledger con BATCH_COST_FACTOR sobre el precio de
+  lista.
+
+Todo se puede probar con `scripts/fake_openai.py --batch-duration 30`.
+"""
+import atexit
+import json
+import logging
+import os
+import tempfile
+import threading
+from datetime import datetime, timedelta
+
+import openai
+from sqlalchemy import bindparam, func, insert, select
+
+from models import db, BatchItem, BatchJob
+from config.model_utils import AUTO_MODEL, get_model_config
+from config.tokenizer import count_tokens
+from pagination import encode_cursor
+
+model_config = get_model_config()
+logger = logging.getLogger(__name__)
+
+BATCH_ENDPOINT = "v1/batch"
+REQUEST_URL = "/v1/responses"
+
+PENDING = "pending"
+SUBMITTED = "submitted"
+COMPLETED = "completed"
+FAILED = "failed"
+EXPIRED = "expired"
+CANCELLED = "cancelled"
+FINAL_STATES = (COMPLETED, FAILED, EXPIRED, CANCELLED)
+
+# Mensaje para los items sin respuesta según cómo acabó el batch
+_UNANSWERED = {
+    COMPLETED: "Sin respuesta en el fichero de salida",
+    FAILED: "El lote no pasó la validación de OpenAI",
+    EXPIRED: "El lote caducó antes de procesar este prompt",
+    CANCELLED: "Lote cancelado",
+}
+
+UPDATE_CHUNK = 500
+
+
+class BatchError(ValueError):
+    """Petición de lote que no se puede aceptar."""
+
+
+# --- Creación ---
+
+def _input(prompt, system_prompt, n):
+    """`input` de la Responses API para un prompt (texto o lista de mensajes)."""
+    if isinstance(prompt, dict):
+        prompt = prompt.get("messages") or prompt.get("prompt")
+    if isinstance(prompt, str):
+        if not prompt.strip():
+            raise BatchError(f"Prompt {n}: vacío")
+        return [{"role": "system", "content": system_prompt}, {"role": "user", "content": prompt}]
+    if not isinstance(prompt, list) or not prompt:
+        raise BatchError(f"Prompt {n}: debe ser texto o una lista de mensajes")
+    for message in prompt:
+        if not isinstance(message, dict) or message.get("role") not in ("system", "user", "assistant") \
+                or not isinstance(message.get("content"), str):
+            raise BatchError(f"Prompt {n}: mensaje inválido")
+    if prompt[0]["role"] != "system":
+        prompt = [{"role": "system", "content": system_prompt}] + prompt
+    return prompt
+
+
+def create_job(user_id, model, prompts, system_prompt, max_items=5000, router=None):
+    """
+    Crea el trabajo con sus items y confirma. Lanza BatchError si el modelo
+    no admite lotes o algún prompt no es válido (sin crear nada). Con
+    model="auto" el router elige uno según el prompt más largo.
+    """
+    inputs = []
+    for n, prompt in enumerate(prompts):
+        if n >= max_items:
+            raise BatchError(f"Como máximo {max_items} prompts por lote")
+        messages = _input(prompt, system_prompt, n)
+        inputs.append((messages, count_tokens(messages)))
+    if not inputs:
+        raise BatchError("No hay prompts")
+
+    if model == AUTO_MODEL and router is not None:
+        model = router.choose(max(tokens for _, tokens in inputs), endpoint=BATCH_ENDPOINT,
+                              context={"user_id": user_id, "endpoint": "batch"})
+        if model is None:
+            raise BatchError("Algún prompt excede la ventana de contexto de todos los modelos")
+    if not model_config.is_model_allowed(model) or not model_config.supports_endpoint(model, BATCH_ENDPOINT):
+        raise BatchError(f"El modelo {model} no admite lotes")
+    rows = []
+    for n, (messages, tokens) in enumerate(inputs):
+        if not model_config.validate_input_length(model, tokens):
+            raise BatchError(f"Prompt {n}: excede la ventana de contexto de {model}")
+        rows.append({"idx": n, "request": json.dumps(messages, ensure_ascii=False)})
+
+    job = BatchJob(user_id=user_id, model=model, total=len(rows))
+    db.session.add(job)
+    db.session.flush()
+    for row in rows:
+        row["job_id"] = job.id
+    db.session.execute(insert(BatchItem.__table__), rows)
+    db.session.commit()
+    return job
+
+
+def request_cancel(job):
+    """Marca el trabajo para cancelar; el runner lo hace en su próxima pasada."""
+    table = BatchJob.__table__
+    db.session.execute(
+        table.update()
+        .where(table.c.id == job.id, table.c.status.in_((PENDING, SUBMITTED)))
+        .values(cancel_requested=True, next_poll_at=datetime.utcnow())
+    )
+    db.session.commit()
+
+
+# --- Consulta ---
+
+def job_payload(job):
+    return {
+        "id": job.id,
+        "model": job.model,
+        "status": job.status,
+        "total": job.total,
+        "completed": job.completed,
+        "failed": job.failed,
+        "cancel_requested": job.cancel_requested,
+        "error": job.error,
+        "created_at": job.created_at.isoformat() if job.created_at else None,
+        "submitted_at": job.submitted_at.isoformat() if job.submitted_at else None,
+        "finished_at": job.finished_at.isoformat() if job.finished_at else None,
+    }
+
+
+def job_page(user_id, limit, before_id=None):
+    """Trabajos del usuario, del más reciente al más antiguo (cursor: id)."""
+    query = BatchJob.query.filter(BatchJob.user_id == user_id)
+    if before_id is not None:
+        query = query.filter(BatchJob.id < before_id)
+    jobs = query.order_by(BatchJob.id.desc()).limit(limit + 1).all()
+    next_cursor = encode_cursor(jobs[limit - 1].id) if len(jobs) > limit else None
+    return {"items": [job_payload(j) for j in jobs[:limit]], "next_cursor": next_cursor}
+
+
+def item_page(job_id, limit, after_idx=None, status=None):
+    """Resultados del trabajo en el orden de los prompts (cursor: idx)."""
+    table = BatchItem.__table__
+    query = select(table.c.idx, table.c.status, table.c.answer, table.c.error,
+                   table.c.input_tokens, table.c.cached_input_tokens, table.c.output_tokens)\
+        .where(table.c.job_id == job_id)
+    if after_idx is not None:
+        query = query.where(table.c.idx > after_idx)
+    if status:
+        query = query.where(table.c.status == status)
+    rows = db.session.execute(query.order_by(table.c.idx).limit(limit + 1)).all()
+    next_cursor = encode_cursor(rows[limit - 1].idx) if len(rows) > limit else None
+    return {"items": [dict(r._mapping) for r in rows[:limit]], "next_cursor": next_cursor}
+
+
+# --- Resultados ---
+
+def _output_text(body):
+    """Equivalente a `Response.output_text` sobre el JSON crudo del fichero de salida."""
+    parts = []
+    for item in body.get("output") or []:
+        if item.get("type") != "message":
+            continue
+        for content in item.get("content") or []:
+            if content.get("type") == "output_text":
+                parts.append(content.get("text") or "")
+    return "".join(parts)
+
+
+def _result(line):
+    """Valores de un item a partir de una línea del fichero de salida o de errores."""
+    record = json.loads(line)
+    values = {"b_item_id": int(record["custom_id"]), "b_status": FAILED, "b_answer": None,
+              "b_error": None, "b_input": None, "b_cached": None, "b_output": None}
+    response = record.get("response") or {}
+    body = response.get("body") or {}
+    usage = body.get("usage") or {}
+    if usage:
+        values.update(b_input=usage.get("input_tokens") or 0,
+                      b_cached=(usage.get("input_tokens_details") or {}).get("cached_tokens") or 0,
+                      b_output=usage.get("output_tokens") or 0)
+    if response.get("status_code") == 200 and not record.get("error"):
+        values.update(b_status=COMPLETED, b_answer=_output_text(body).strip())
+    else:
+        error = record.get("error") or body.get("error") or {}
+        values["b_error"] = error.get("message") or f"HTTP {response.get('status_code')}"
+    return values
+
+
+class BatchRunner:
+    def __init__(self, app, upstream, poll_interval=60.0, lease=300.0, batch_size=10,
+                 max_output_tokens=4096, cost_factor=0.5):
+        self.app = app
+        self.upstream = upstream
+        self.poll_interval = poll_interval
+        self.lease = lease
+        self.batch_size = batch_size
+        self.max_output_tokens = max_output_tokens
+        self.cost_factor = cost_factor
+        self._wakeup = threading.Event()
+        self._lock = threading.Lock()
+        self._stopping = False
+        self._thread = None
+        self._pid = None
+        atexit.register(self._stop)
+
+    @property
+    def client(self):
+        return self.upstream.client
+
+    def notify(self):
+        """Despierta al hilo del runner (llamar tras el commit que crea o cancela)."""
+        self._ensure_thread()
+        self._wakeup.set()
+
+    def _ensure_thread(self):
+        # Tras un fork de gunicorn el hilo del padre no existe en el hijo
+        if self._thread is not None and self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._thread is not None and self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name="batch-runner", daemon=True)
+            self._thread.start()
+
+    def _stop(self):
+        self._stopping = True
+        self._wakeup.set()
+
+    def _run(self):
+        while not self._stopping:
+            self._wakeup.wait(self.poll_interval)
+            self._wakeup.clear()
+            try:
+                while self.run_once() and not self._stopping:
+                    pass
+            except Exception as e:
+                logger.error(f"Batch runner failed: {e}", exc_info=True)
+
+    # --- Reparto ---
+
+    def _claim(self):
+        """Reclama hasta `batch_size` trabajos vencidos; devuelve sus ids."""
+        now = datetime.utcnow()
+        table = BatchJob.__table__
+        due = select(table.c.id)\
+            .where(table.c.status.in_((PENDING, SUBMITTED)), table.c.next_poll_at <= now)\
+            .order_by(table.c.next_poll_at)\
+            .limit(self.batch_size)\
+            .with_for_update(skip_locked=True)
+        ids = list(db.session.execute(due).scalars())
+        if not ids:
+            db.session.rollback()
+            return []
+        ids = list(db.session.execute(
+            table.update()
+            .where(table.c.id.in_(ids), table.c.next_poll_at <= now)
+            .values(next_poll_at=now + timedelta(seconds=self.lease))
+            .returning(table.c.id)
+        ).scalars())
+        db.session.commit()
+        return ids
+
+    def run_once(self):
+        """Atiende un lote de trabajos vencidos. True si había (puede quedar más)."""
+        with self.app.app_context():
+            ids = self._claim()
+            for job_id in ids:
+                try:
+                    self.process(job_id)
+                except Exception as e:
+                    # El lease vence y se reintenta en la siguiente pasada
+                    db.session.rollback()
+                    logger.error(f"Lote {job_id}: {e}", exc_info=True)
+            return len(ids) == self.batch_size
+
+    def process(self, job_id):
+        job = db.session.get(BatchJob, job_id)
+        if job is None or job.status in FINAL_STATES:
+            return
+        if job.status == PENDING:
+            if job.cancel_requested:
+                self._finish(job, CANCELLED)
+            else:
+                self._submit(job)
+        else:
+            self._poll(job)
+
+    # --- Envío ---
+
+    def _write_input(self, job, fh):
+        table = BatchItem.__table__
+        result = db.session.execute(
+            select(table.c.id, table.c.request)
+            .where(table.c.job_id == job.id, table.c.status == PENDING)
+            .order_by(table.c.idx)
+            .execution_options(stream_results=True, yield_per=1000)
+        )
+        for row in result:
+            fh.write(json.dumps({
+                "custom_id": str(row.id),
+                "method": "POST",
+                "url": REQUEST_URL,
+                "body": {"model": job.model, "input": json.loads(row.request),
+                         "max_output_tokens": self.max_output_tokens},
+            }, ensure_ascii=False).encode("utf-8") + b"\n")
+
+    def _existing_batch(self, input_file_id):
+        """Batch ya creado con este fichero (un intento anterior perdió la respuesta)."""
+        page = self.upstream.call(self.client.batches.list, limit=100)
+        for batch in page.data:
+            if batch.input_file_id == input_file_id:
+                return batch
+        return None
+
+    def _submit(self, job):
+        job_id, input_file_id = job.id, job.input_file_id
+        batch = None
+        with tempfile.SpooledTemporaryFile(max_size=8 * 1024 * 1024) as fh:
+            self._write_input(job, fh)
+            # No se retiene la conexión a la BD durante la subida
+            db.session.commit()
+            try:
+                if input_file_id is None:
+                    def upload():
+                        fh.seek(0)
+                        return self.client.files.create(file=(f"batch-{job_id}.jsonl", fh), purpose="batch")
+                    input_file_id = self.upstream.call(upload).id
+                    self._update(job_id, input_file_id=input_file_id)
+                else:
+                    batch = self._existing_batch(input_file_id)
+                if batch is None:
+                    # No es idempotente: un reintento ciego podría crear dos batches
+                    batch = self.upstream.call(
+                        self.client.batches.create,
+                        input_file_id=input_file_id,
+                        endpoint=REQUEST_URL,
+                        completion_window="24h",
+                        metadata={"job_id": str(job_id)},
+                        retry=False,
+                    )
+            except openai.BadRequestError as e:
+                logger.error(f"Lote {job_id} rechazado: {e}")
+                job = db.session.get(BatchJob, job_id)
+                job.error = e.message
+                self._finish(job, FAILED)
+                return
+        now = datetime.utcnow()
+        self._update(job_id, status=SUBMITTED, openai_batch_id=batch.id, submitted_at=now,
+                     next_poll_at=now + timedelta(seconds=self.poll_interval))
+        logger.info(f"Lote {job_id} enviado como {batch.id}")
+
+    def _update(self, job_id, **values):
+        table = BatchJob.__table__
+        db.session.execute(table.update().where(table.c.id == job_id).values(**values))
+        db.session.commit()
+
+    # --- Seguimiento ---
+
+    def _poll(self, job):
+        job_id, batch_id, cancel = job.id, job.openai_batch_id, job.cancel_requested
+        db.session.commit()
+        batch = self.upstream.call(self.client.batches.retrieve, batch_id)
+        if cancel and batch.status not in FINAL_STATES + ("cancelling",):
+            batch = self.upstream.call(self.client.batches.cancel, batch_id)
+
+        job = db.session.get(BatchJob, job_id)
+        counts = batch.request_counts
+        if counts is not None:
+            job.completed, job.failed = counts.completed, counts.failed
+        if batch.status in FINAL_STATES:
+            self._collect(job, batch)
+        else:
+            job.next_poll_at = datetime.utcnow() + timedelta(seconds=self.poll_interval)
+            db.session.commit()
+
+    def _read_results(self, job_id, file_id):
+        table = BatchItem.__table__
+        stmt = table.update()\
+            .where(table.c.id == bindparam("b_item_id"), table.c.job_id == job_id,
+                   table.c.status == PENDING)\
+            .values(status=bindparam("b_status"), answer=bindparam("b_answer"),
+                    error=bindparam("b_error"), input_tokens=bindparam("b_input"),
+                    cached_input_tokens=bindparam("b_cached"), output_tokens=bindparam("b_output"))
+        chunk = []
+        with self.client.files.with_streaming_response.content(file_id) as response:
+            for line in response.iter_lines():
+                if not line.strip():
+                    continue
+                chunk.append(_result(line))
+                if len(chunk) >= UPDATE_CHUNK:
+                    db.session.execute(stmt, chunk)
+                    chunk = []
+        if chunk:
+            db.session.execute(stmt, chunk)
+
+    def _collect(self, job, batch):
+        for file_id in (batch.output_file_id, batch.error_file_id):
+            if file_id:
+                self._read_results(job.id, file_id)
+        if batch.status == FAILED and batch.errors and batch.errors.data:
+            job.error = "; ".join(e.message or e.code or "" for e in batch.errors.data[:5])
+        self._finish(job, batch.status)
+
+    def _finish(self, job, status):
+        """Cierra el trabajo: items sin respuesta a failed, recuento final y consumo."""
+        items = BatchItem.__table__
+        db.session.execute(
+            items.update()
+            .where(items.c.job_id == job.id, items.c.status == PENDING)
+            .values(status=FAILED, error=_UNANSWERED[status])
+        )
+        counts = dict(db.session.execute(
+            select(items.c.status, func.count()).where(items.c.job_id == job.id).group_by(items.c.status)
+        ).all())
+        table = BatchJob.__table__
+        result = db.session.execute(
+            table.update()
+            .where(table.c.id == job.id, table.c.status.notin_(FINAL_STATES))
+            .values(status=status, completed=counts.get(COMPLETED, 0), failed=counts.get(FAILED, 0),
+                    error=job.error, finished_at=datetime.utcnow())
+        )
+        usage = db.session.execute(
+            select(func.coalesce(func.sum(items.c.input_tokens), 0),
+                   func.coalesce(func.sum(items.c.cached_input_tokens), 0),
+                   func.coalesce(func.sum(items.c.output_tokens), 0))
+            .where(items.c.job_id == job.id)
+        ).one()
+        user_id, model, job_id = job.user_id, job.model, job.id
+        db.session.commit()
+        logger.info(f"Lote {job_id} terminado: {status}, {counts.get(COMPLETED, 0)} respuestas")
+
+        ledger = self.app.extensions.get("usage_ledger")
+        # Solo quien cierra el trabajo anota el consumo
+        if ledger is not None and result.rowcount == 1 and any(usage):
+            ledger.record(user_id, model, tuple(usage), cost_factor=self.cost_factor)
+
+
+def init_batch_runner(app, upstream):
+    runner = BatchRunner(
+        app,
+        upstream,
+        poll_interval=app.config.get("BATCH_POLL_INTERVAL", 60),
+        max_output_tokens=app.config.get("BATCH_MAX_OUTPUT_TOKENS", 4096),
+        cost_factor=app.config.get("BATCH_COST_FACTOR", 0.5),
+    )
+    app.extensions["batch_runner"] = runner
+    return runner
@@ -1,26 +1,13 @@
-from flask import request, jsonify, g
-from functools import wraps
-from config.model_utils import ModelConfig
-
-model_config = ModelConfig()
-
-def count_tokens(messages):
-    """
-    Simple token count approximation by counting words in message contents.
-    This can be replaced with a more accurate tokenizer if needed.
-    """
-    token_count = 0
-    for msg in messages:
-        content = msg.get("content", "")
-        token_count += len(content.split())
-    return token_count
-
 import logging
-from flask import request, jsonify, g
+from flask import request, jsonify, g, current_app
+from flask_login import current_user
 from functools import wraps
-from config.model_utils import ModelConfig
+from config.model_utils import AUTO_MODEL, get_model_config
+from config.tokenizer import count_tokens
+from context_builder import context_tokens
+import metrics
 
-model_config = ModelConfig()
+model_config = get_model_config()
 logger = logging.getLogger(__name__)
 
 class ModelValidationError(Exception):
@@ -29,42 +16,102 @@ class ModelValidationError(Exception):
         self.message = message
         super().__init__(message)
 
-def count_tokens(messages):
+class RateLimitExceeded(ModelValidationError):
+    def __init__(self, retry_after):
+        self.retry_after = retry_after
+        super().__init__("RATE_LIMITED", f"Rate limit exceeded, retry in {retry_after}s")
+
+def _history_tokens():
+    """
+    Conversation endpoints only send the new turn: tokens of the history that
+    build_context will send along with it (0 elsewhere).
+    """
+    conv_id = (request.view_args or {}).get("conv_id")
+    if conv_id is None:
+        return 0
+    return context_tokens(conv_id, current_app.config.get("CONTEXT_MAX_INPUT_TOKENS"))
+
+def _route(messages, history):
+    """Concrete model for `model: "auto"` (see config/model_router.py)."""
+    router = current_app.extensions.get("model_router")
+    if router is None:
+        raise ModelValidationError("MODEL_NOT_ALLOWED", "Automatic model routing is disabled")
+    # Every allowed model uses o200k_base, so one count serves all candidates
+    input_length = count_tokens(messages) + history
+    model = router.choose(
+        input_length,
+        breaker=current_app.extensions.get("upstream_breaker"),
+        context={
+            "user_id": current_user.id if current_user.is_authenticated else None,
+            "endpoint": request.endpoint,
+        },
+    )
+    if model is None:
+        raise ModelValidationError(
+            "INPUT_LENGTH_EXCEEDED", f"Input length {input_length} exceeds every model's context window"
+        )
+    return model
+
+def refund_rate_limit(charge):
     """
-    Simple token count approximation by counting words in message contents.
-    This can be replaced with a more accurate tokenizer if needed.
+    Give back the tokens charged by the middleware (`g.rate_limit_charge`)
+    when the request is answered without calling OpenAI.
     """
-    token_count = 0
-    for msg in messages:
-        content = msg.get("content", "")
-        token_count += len(content.split())
-    return token_count
+    limiter = current_app.extensions.get("rate_limiter")
+    if limiter is not None and charge is not None:
+        limiter.refund(*charge)
 
 def model_constraints_middleware(f):
     @wraps(f)
     def decorated_function(*args, **kwargs):
-        data = request.get_json() or {}
-        model = data.get("model", None)
+        # Solo las peticiones que generan texto (POST) pasan por las restricciones
+        if request.method != "POST":
+            return f(*args, **kwargs)
+
+        data = request.get_json(silent=True) or {}
+        model = data.get("model") or model_config.default_model
         messages = data.get("messages") or data.get("input") or []
+        if not messages and data.get("content"):
+            # Endpoints de conversación: solo llega el nuevo turno del usuario
+            messages = [{"role": "user", "content": data["content"]}]
         client_ip = request.remote_addr or "unknown"
 
         try:
-            if not model:
-                raise ModelValidationError("MODEL_REQUIRED", "Model is required")
+            history = _history_tokens()
+            if model == AUTO_MODEL:
+                model = _route(messages, history)
+                g.routed_model = model
+            # get_json() returns the same cached dict, so the view sees the concrete model
+            data["model"] = model
 
             if not model_config.is_model_allowed(model):
                 raise ModelValidationError("MODEL_NOT_ALLOWED", f"Model not allowed: {model}")
 
-            input_length = count_tokens(messages)
+            input_length = count_tokens(messages, model) + history
             if not model_config.validate_input_length(model, input_length):
                 raise ModelValidationError(
                     "INPUT_LENGTH_EXCEEDED",
                     f"Input length {input_length} exceeds context window for model {model}"
                 )
 
+            limiter = current_app.extensions.get("rate_limiter")
+            if limiter is not None and current_user.is_authenticated:
+                retry_after = limiter.check(model, current_user.id, current_user.tier, input_length)
+                metrics.rate_limit(model, not retry_after)
+                if retry_after:
+                    raise RateLimitExceeded(retry_after)
+                g.rate_limit_charge = (model, current_user.id, current_user.tier, input_length)
+
             g.token_count = input_length
             logger.debug(f"Request from {client_ip}: model={model}, tokens={input_length}")
 
+        except RateLimitExceeded as e:
+            logger.warning(f"Rate limited {client_ip}: {e.message}")
+            response = jsonify({"error_code": e.error_code, "error": e.message})
+            response.status_code = 429
+            response.headers["Retry-After"] = str(e.retry_after)
+            return response
+
         except ModelValidationError as e:
             logger.warning(f"Validation error from {client_ip}: {e.error_code} - {e.message}")
             response = jsonify({"error_code": e.error_code, "error": e.message})
@@ -0,0 +1,177 @@
+import json
+import logging
+import math
+import threading
+import time
+from collections import deque
+from typing import Dict, Optional, Tuple
+
+from config.model_utils import get_model_config
+
+model_config = get_model_config()
+logger = logging.getLogger(__name__)
+
+INTELLIGENCE_LEVELS = {"low": 0, "balanced": 1, "high": 2}
+# Latency prior (seconds) per declared speed, used until a model has enough samples
+SPEED_PRIOR_SECONDS = {"slow": 6.0, "balanced": 3.0, "fast": 1.5}
+
+
+class ModelStats:
+    """
+    Rolling window of observed upstream calls per model (per process): call
+    latency and whether it failed. Old samples fall out after `window`
+    seconds, so a model that recovers is picked again.
+    """
+
+    def __init__(self, window: float = 300.0, max_samples: int = 500):
+        self.window = window
+        self.max_samples = max_samples
+        self._samples = {}   # model -> deque[(timestamp, seconds, failed)]
+        self._lock = threading.Lock()
+
+    def observe(self, model: str, seconds: float, failed: bool = False):
+        with self._lock:
+            samples = self._samples.get(model)
+            if samples is None:
+                samples = self._samples[model] = deque(maxlen=self.max_samples)
+            samples.append((time.monotonic(), seconds, failed))
+
+    def snapshot(self, model: str) -> Tuple[int, Optional[float], float]:
+        """(samples, median latency of successful calls or None, error rate)."""
+        cutoff = time.monotonic() - self.window
+        with self._lock:
+            samples = self._samples.get(model)
+            if not samples:
+                return 0, None, 0.0
+            while samples and samples[0][0] < cutoff:
+                samples.popleft()
+            recent = list(samples)
+        if not recent:
+            return 0, None, 0.0
+        latencies = sorted(s for _, s, failed in recent if not failed)
+        errors = sum(1 for *_, failed in recent if failed)
+        median = latencies[len(latencies) // 2] if latencies else None
+        return len(recent), median, errors / len(recent)
+
+
+_stats = None
+_stats_lock = threading.Lock()
+
+
+def get_model_stats() -> ModelStats:
+    """Return the process-wide rolling stats, creating them on first use."""
+    global _stats
+    if _stats is None:
+        with _stats_lock:
+            if _stats is None:
+                _stats = ModelStats()
+    return _stats
+
+
+class ModelRouter:
+    """
+    Picks a concrete model for `model: "auto"`.
+
+    Every allowed model whose context window fits the prompt (plus the
+    expected output) and whose circuit is closed gets a score; the lowest
+    wins:
+
+        cost_weight    * log2(estimated cost / cheapest)
+      + latency_weight * log2(latency / fastest)
+      + error_weight   * error rate
+      - quality_weight * intelligence level * size factor
+
+    Latency is the median observed in the rolling window, or a prior from
+    the model's declared `speed` while it has fewer than `min_samples`
+    calls. The size factor grows from 0 to 1 as the prompt approaches
+    `long_prompt_tokens`, so short prompts go to the cheap, fast models and
+    only long ones pay for intelligence.
+    """
+
+    def __init__(self, stats: ModelStats, cost_weight: float = 1.0, latency_weight: float = 0.5,
+                 error_weight: float = 4.0, quality_weight: float = 1.5,
+                 long_prompt_tokens: int = 8000, output_estimate: int = 1000, min_samples: int = 5):
+        self.stats = stats
+        self.cost_weight = cost_weight
+        self.latency_weight = latency_weight
+        self.error_weight = error_weight
+        self.quality_weight = quality_weight
+        self.long_prompt_tokens = long_prompt_tokens
+        self.output_estimate = output_estimate
+        self.min_samples = min_samples
+
+    def _candidates(self, input_tokens: int, breaker, endpoint: Optional[str]) -> Dict[str, dict]:
+        config = model_config.current
+        candidates = {}
+        for name in config.model_names:
+            if input_tokens + self.output_estimate > config.context_windows.get(name, 0):
+                continue
+            if endpoint and not config.supports_endpoint(name, endpoint):
+                continue
+            if breaker is not None and breaker.retry_after(name) > 0:
+                continue
+            meta = config.get_model(name) or {}
+            pricing = config.get_pricing(name) or {}
+            samples, latency, error_rate = self.stats.snapshot(name)
+            if samples < self.min_samples or latency is None:
+                latency = SPEED_PRIOR_SECONDS.get(meta.get("speed"), SPEED_PRIOR_SECONDS["balanced"])
+            candidates[name] = {
+                "cost": (input_tokens * pricing.get("input", 0)
+                         + self.output_estimate * pricing.get("output", 0)) / 1_000_000,
+                "latency": latency,
+                "error_rate": error_rate,
+                "samples": samples,
+                "intelligence": INTELLIGENCE_LEVELS.get(meta.get("intelligence"), 1),
+            }
+        return candidates
+
+    def choose(self, input_tokens: int, breaker=None, endpoint: Optional[str] = "v1/responses",
+               context: Optional[dict] = None) -> Optional[str]:
+        """
+        Model for a prompt of `input_tokens`, or None if no model fits.
+        `context` (user, endpoint...) is only added to the audit log line.
+        """
+        candidates = self._candidates(input_tokens, breaker, endpoint)
+        if not candidates:
+            logger.warning(f"Model routing: no model fits {input_tokens} input tokens")
+            return None
+
+        cheapest = min(c["cost"] for c in candidates.values()) or 1e-9
+        fastest = min(c["latency"] for c in candidates.values()) or 1e-3
+        size_factor = min(1.0, input_tokens / self.long_prompt_tokens)
+        for c in candidates.values():
+            c["score"] = round(
+                self.cost_weight * math.log2(max(c["cost"], 1e-9) / cheapest)
+                + self.latency_weight * math.log2(max(c["latency"], 1e-3) / fastest)
+                + self.error_weight * c["error_rate"]
+                - self.quality_weight * c["intelligence"] * size_factor,
+                4,
+            )
+        chosen = min(candidates, key=lambda name: candidates[name]["score"])
+
+        # One JSON line per decision so routing can be audited offline
+        logger.info("model_route %s", json.dumps({
+            "chosen": chosen,
+            "input_tokens": input_tokens,
+            "size_factor": round(size_factor, 3),
+            "candidates": candidates,
+            **(context or {}),
+        }, sort_keys=True, default=str))
+        return chosen
+
+
+def init_model_router(app) -> ModelRouter:
+    config = app.config
+    stats = get_model_stats()
+    stats.window = config.get("ROUTER_WINDOW_SECONDS", 300)
+    router = ModelRouter(
+        stats,
+        cost_weight=config.get("ROUTER_COST_WEIGHT", 1.0),
+        latency_weight=config.get("ROUTER_LATENCY_WEIGHT", 0.5),
+        error_weight=config.get("ROUTER_ERROR_WEIGHT", 4.0),
+        quality_weight=config.get("ROUTER_QUALITY_WEIGHT", 1.5),
+        long_prompt_tokens=config.get("ROUTER_LONG_PROMPT_TOKENS", 8000),
+        output_estimate=config.get("RATE_LIMIT_OUTPUT_ESTIMATE", 1000),
+    )
+    app.extensions["model_router"] = router
+    return router
@@ -1,11 +1,41 @@
 import json
+import logging
 import os
+import threading
+import time
+from types import MappingProxyType
 from typing import Optional, Dict, Any
 
+logger = logging.getLogger(__name__)
+
+# Resuelto respecto al paquete, no al directorio de trabajo
+DEFAULT_CONFIG_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "allowed_models.json")
+
+# Cada cuánto (segundos) se mira el mtime del fichero, como mucho
+RELOAD_CHECK_INTERVAL = 2.0
+
+# Pseudo-model: the server picks a concrete one (see config/model_router.py)
+AUTO_MODEL = "auto"
+
+
+def _freeze(value):
+    """Deep-freeze JSON data: dicts become read-only mappings, lists tuples."""
+    if isinstance(value, dict):
+        return MappingProxyType({k: _freeze(v) for k, v in value.items()})
+    if isinstance(value, list):
+        return tuple(_freeze(v) for v in value)
+    return value
+
+
 class ModelConfig:
-    def __init__(self, config_path: str = "config/allowed_models.json"):
+    """
+    Immutable snapshot of allowed_models.json with precomputed lookups.
+    Use `get_model_config()` to get the process-wide, hot-reloading registry.
+    """
+
+    def __init__(self, config_path: str = DEFAULT_CONFIG_PATH):
         self.config_path = config_path
-        self.models = {}
+        self.models = MappingProxyType({})
         self.last_updated = None
         self._load_config()
 
@@ -14,8 +44,47 @@ class ModelConfig:
             raise FileNotFoundError(f"Model config file not found: {self.config_path}")
         with open(self.config_path, "r", encoding="utf-8") as f:
             data = json.load(f)
-            self.models = data.get("models", {})
-            self.last_updated = data.get("last_updated", None)
+
+        models = data.get("models", {})
+        self.models = _freeze(models)
+        self.last_updated = data.get("last_updated", None)
+
+        # Estructuras precalculadas para el camino de la petición
+        self.model_names = tuple(models)
+        self.allowed = frozenset(models)
+        self.features = MappingProxyType({
+            name: frozenset(m.get("supported_features", [])) for name, m in models.items()
+        })
+        self.endpoints = MappingProxyType({
+            name: frozenset(m.get("endpoints", [])) for name, m in models.items()
+        })
+        self.context_windows = MappingProxyType({
+            name: m.get("context_window", 0) for name, m in models.items()
+        })
+        self.max_output_tokens = MappingProxyType({
+            name: m.get("max_output_tokens") for name, m in models.items()
+        })
+        self.rate_limits = MappingProxyType({
+            name: MappingProxyType(m.get("rate_limits_tpm", {})) for name, m in models.items()
+        })
+        self.timeouts = MappingProxyType({
+            name: MappingProxyType(m.get("timeouts", {})) for name, m in models.items()
+        })
+        self.pricing = MappingProxyType({
+            name: MappingProxyType(m["pricing_per_1m_tokens"])
+            for name, m in models.items() if m.get("pricing_per_1m_tokens")
+        })
+        # Cheap model for background work (summaries); falls back to the
+        # model with the lowest input + output price
+        summary = data.get("summary_model")
+        if summary not in self.allowed:
+            priced = sorted(self.pricing, key=lambda n: self.pricing[n].get("input", 0) + self.pricing[n].get("output", 0))
+            summary = priced[0] if priced else next(iter(self.model_names), None)
+        self.summary_model = summary
+        # The default may be "auto" (routed per request)
+        default = data.get("default_model")
+        self.default_model = default if default in self.allowed or default == AUTO_MODEL \
+            else next(iter(self.model_names), None)
 
     def get_model(self, model_name: str) -> Optional[Dict[str, Any]]:
         """Retrieve the configuration for a specific model by name."""
@@ -23,34 +92,107 @@ class ModelConfig:
 
     def is_model_allowed(self, model_name: str) -> bool:
         """Check if a model is in the allowed models list."""
-        return model_name in self.models
+        return model_name in self.allowed
 
     def get_rate_limit(self, model_name: str, tier: str = "free") -> Optional[int]:
         """Get the tokens per minute rate limit for a model at a given tier."""
-        model = self.get_model(model_name)
-        if model:
-            rate_limits = model.get("rate_limits_tpm", {})
-            return rate_limits.get(tier)
+        limits = self.rate_limits.get(model_name)
+        if limits is not None:
+            return limits.get(tier)
         return None
 
     def supports_feature(self, model_name: str, feature: str) -> bool:
         """Check if a model supports a specific feature."""
-        model = self.get_model(model_name)
-        if model:
-            features = model.get("supported_features", [])
-            return feature in features
-        return False
+        return feature in self.features.get(model_name, ())
+
+    def supports_endpoint(self, model_name: str, endpoint: str) -> bool:
+        """Check if a model is available on an API endpoint (e.g. "v1/batch")."""
+        return endpoint in self.endpoints.get(model_name, ())
 
     def validate_input_length(self, model_name: str, input_length: int) -> bool:
         """Validate if the input length is within the model's context window."""
-        model = self.get_model(model_name)
-        if model:
-            return input_length <= model.get("context_window", 0)
+        if model_name in self.context_windows:
+            return input_length <= self.context_windows[model_name]
         return False
 
     def get_pricing(self, model_name: str) -> Optional[Dict[str, float]]:
         """Get pricing details for a model."""
-        model = self.get_model(model_name)
-        if model:
-            return model.get("pricing_per_1m_tokens")
-        return None
+        return self.pricing.get(model_name)
+
+    def reasoning_effort(self, model_name: str) -> Optional[str]:
+        """
+        Reasoning effort for o-series models, or None for chat models. Reasoning
+        models only run on the Responses API (no `max_tokens`), so callers pick
+        the API from this.
+        """
+        return (self.models.get(model_name) or {}).get("reasoning_effort")
+
+    def get_timeouts(self, model_name: str) -> Dict[str, float]:
+        """Per-model upstream timeout overrides (connect, read, first_token)."""
+        return self.timeouts.get(model_name, {})
+
+
+class ModelRegistry:
+    """
+    Process-wide holder of the current ModelConfig snapshot.
+
+    Attribute access is delegated to the snapshot, so the registry can be used
+    wherever a ModelConfig was. The file's mtime is checked at most once every
+    `check_interval` seconds; when it changes, a new snapshot is built and
+    swapped in atomically. A file that fails to parse keeps the old snapshot.
+    """
+
+    def __init__(self, config_path: str = DEFAULT_CONFIG_PATH, check_interval: float = RELOAD_CHECK_INTERVAL):
+        self.config_path = config_path
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._mtime = os.stat(config_path).st_mtime
+        self._snapshot = ModelConfig(config_path)
+        self._next_check = time.monotonic() + check_interval
+
+    @property
+    def current(self) -> ModelConfig:
+        if time.monotonic() >= self._next_check:
+            self._maybe_reload()
+        return self._snapshot
+
+    def _maybe_reload(self):
+        # Un solo hilo hace el stat; el resto sigue con el snapshot actual
+        if not self._lock.acquire(blocking=False):
+            return
+        try:
+            self._next_check = time.monotonic() + self.check_interval
+            try:
+                mtime = os.stat(self.config_path).st_mtime
+            except OSError as e:
+                logger.error(f"Cannot stat model config {self.config_path}: {e}")
+                return
+            if mtime == self._mtime:
+                return
+            try:
+                snapshot = ModelConfig(self.config_path)
+            except (OSError, ValueError) as e:
+                logger.error(f"Invalid model config {self.config_path}, keeping previous: {e}")
+                return
+            self._snapshot = snapshot
+            self._mtime = mtime
+            logger.info(f"Model config reloaded from {self.config_path}")
+        finally:
+            self._lock.release()
+
+    def __getattr__(self, name):
+        return getattr(self.current, name)
+
+
+_registry = None
+_registry_lock = threading.Lock()
+
+
+def get_model_config() -> ModelRegistry:
+    """Return the process-wide model registry, creating it on first use."""
+    global _registry
+    if _registry is None:
+        with _registry_lock:
+            if _registry is None:
+                _registry = ModelRegistry()
+    return _registry
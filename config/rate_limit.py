@@ -0,0 +1,150 @@
+import logging
+import math
+import sqlite3
+import time
+from typing import Iterable, Optional, Tuple
+
+from config.model_utils import get_model_config
+from local_store import LocalStore
+
+model_config = get_model_config()
+logger = logging.getLogger(__name__)
+
+
+class TokenBucketLimiter:
+    """
+    Token buckets (tokens per minute) stored in a local SQLite WAL file, so
+    every gunicorn worker on the host shares the same state.
+
+    Each bucket refills continuously at capacity/60 tokens per second up to
+    `capacity` (one minute of burst).
+    """
+
+    SCHEMA = (
+        """CREATE TABLE IF NOT EXISTS rate_buckets (
+            key TEXT PRIMARY KEY,
+            tokens REAL NOT NULL,
+            updated REAL NOT NULL
+        )""",
+    )
+
+    def __init__(self, path: str):
+        self.store = LocalStore(path, self.SCHEMA)
+
+    def acquire(self, buckets: Iterable[Tuple[str, int]], cost: int) -> float:
+        """
+        Take `cost` tokens from every bucket atomically. Returns 0 when the
+        request is allowed, or the seconds to wait until all buckets can
+        afford it (nothing is taken in that case).
+        """
+        now = time.time()
+        with self.store.transaction() as conn:
+            states = []
+            wait = 0.0
+            for key, capacity in buckets:
+                rate = capacity / 60.0
+                row = conn.execute(
+                    "SELECT tokens, updated FROM rate_buckets WHERE key = ?", (key,)
+                ).fetchone()
+                tokens = capacity if row is None else min(capacity, row[0] + (now - row[1]) * rate)
+                # Una petición mayor que el bucket entero nunca cabría: se cobra el bucket lleno
+                need = min(cost, capacity)
+                if tokens < need:
+                    wait = max(wait, (need - tokens) / rate)
+                states.append((key, tokens, need))
+
+            if wait > 0:
+                return wait
+            for key, tokens, need in states:
+                conn.execute(
+                    "INSERT OR REPLACE INTO rate_buckets (key, tokens, updated) VALUES (?, ?, ?)",
+                    (key, tokens - need, now),
+                )
+        return 0.0
+
+    def release(self, buckets: Iterable[Tuple[str, int]], cost: int) -> None:
+        """Give back `cost` tokens taken by acquire() (never above capacity)."""
+        now = time.time()
+        with self.store.transaction() as conn:
+            for key, capacity in buckets:
+                row = conn.execute(
+                    "SELECT tokens, updated FROM rate_buckets WHERE key = ?", (key,)
+                ).fetchone()
+                if row is None:
+                    continue
+                tokens = min(capacity, row[0] + (now - row[1]) * capacity / 60.0 + min(cost, capacity))
+                conn.execute(
+                    "UPDATE rate_buckets SET tokens = ?, updated = ? WHERE key = ?", (tokens, now, key)
+                )
+
+
+class RateLimiter:
+    """
+    Global (org tier) and per-user (user tier) limits for each model, taken
+    from `rate_limits_tpm` in allowed_models.json.
+    """
+
+    def __init__(self, limiter: TokenBucketLimiter, org_tier: str, output_estimate: int):
+        self.limiter = limiter
+        self.org_tier = org_tier
+        self.output_estimate = output_estimate
+
+    @staticmethod
+    def _tier_limit(model_name: str, tier: Optional[str]) -> Optional[int]:
+        limit = model_config.get_rate_limit(model_name, tier) if tier else None
+        if limit is None:
+            # Tier no listado para este modelo: se aplica el más bajo que tenga
+            limits = (model_config.get_model(model_name) or {}).get("rate_limits_tpm", {})
+            limit = min(limits.values()) if limits else None
+        return limit
+
+    def _buckets(self, model_name: str, user_id: int, user_tier: Optional[str]):
+        buckets = []
+        org_limit = model_config.get_rate_limit(model_name, self.org_tier)
+        if org_limit:
+            buckets.append((f"org:{model_name}", org_limit))
+        user_limit = self._tier_limit(model_name, user_tier)
+        if user_limit:
+            buckets.append((f"user:{user_id}:{model_name}", user_limit))
+        return buckets
+
+    def check(self, model_name: str, user_id: int, user_tier: Optional[str], input_tokens: int) -> int:
+        """
+        Returns 0 if the request may go upstream, or the Retry-After seconds.
+        Fails open if the shared store is unavailable.
+        """
+        buckets = self._buckets(model_name, user_id, user_tier)
+        if not buckets:
+            return 0
+
+        try:
+            wait = self.limiter.acquire(buckets, input_tokens + self.output_estimate)
+        except sqlite3.Error as e:
+            logger.error(f"Rate limiter store unavailable, allowing request: {e}")
+            return 0
+        return math.ceil(wait) if wait > 0 else 0
+
+    def refund(self, model_name: str, user_id: int, user_tier: Optional[str], input_tokens: int) -> None:
+        """
+        Give back what check() charged for a request that was answered without
+        calling upstream (response cache hit or coalesced in single-flight).
+        """
+        buckets = self._buckets(model_name, user_id, user_tier)
+        if not buckets:
+            return
+        try:
+            self.limiter.release(buckets, input_tokens + self.output_estimate)
+        except sqlite3.Error as e:
+            logger.error(f"Rate limiter store unavailable, refund lost: {e}")
+
+
+def init_rate_limiter(app) -> Optional[RateLimiter]:
+    limiter = None
+    if app.config.get("RATE_LIMIT_ENABLED", True):
+        limiter = RateLimiter(
+            TokenBucketLimiter(app.config["RATE_LIMIT_PATH"]),
+            org_tier=app.config.get("OPENAI_ORG_TIER", "tier_1"),
+            output_estimate=app.config.get("RATE_LIMIT_OUTPUT_ESTIMATE", 1000),
+        )
+    app.extensions["rate_limiter"] = limiter
+    return limiter
@@ -0,0 +1,155 @@
+import hashlib
+import logging
+import re
+import threading
+from collections import OrderedDict
+from typing import Iterable, Optional
+
+try:
+    import tiktoken
+except ImportError:  # pragma: no cover - fallback sin dependencia opcional
+    tiktoken = None
+
+logger = logging.getLogger(__name__)
+
+# Tokens extra por mensaje en el formato chat (rol + separadores) y para
+# cebar la respuesta del asistente, según la guía de OpenAI.
+TOKENS_PER_MESSAGE = 3
+TOKENS_PER_REPLY = 3
+
+DEFAULT_ENCODING = "o200k_base"
+
+# Prefijos de modelo -> encoding. El primero que coincida gana.
+MODEL_ENCODINGS = (
+    ("gpt-4o", "o200k_base"),
+    ("chatgpt-4o", "o200k_base"),
+    ("gpt-4.1", "o200k_base"),
+    ("gpt-4.5", "o200k_base"),
+    ("o1", "o200k_base"),
+    ("o3", "o200k_base"),
+    ("o4", "o200k_base"),
+    ("gpt-4", "cl100k_base"),
+    ("gpt-3.5", "cl100k_base"),
+)
+
+# Textos más grandes que esto se parten en trozos y se tokenizan en paralelo
+CHUNK_CHARS = 256 * 1024
+CACHE_SIZE = 4096
+
+# Aproximación del pre-tokenizador de OpenAI para cuando tiktoken no está
+# disponible (o no hay ficheros BPE en caché y no hay red).
+_PIECE = re.compile(r"[A-Za-zÀ-ÿ]+|\d{1,3}|\s+|[^\sA-Za-zÀ-ÿ\d]")
+
+_encodings = {}
+_encodings_lock = threading.Lock()
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+
+
+def encoding_for_model(model_name: Optional[str]) -> str:
+    """Return the tiktoken encoding name used by a model family."""
+    if model_name:
+        for prefix, encoding in MODEL_ENCODINGS:
+            if model_name.startswith(prefix):
+                return encoding
+    return DEFAULT_ENCODING
+
+
+def _get_encoding(name: str):
+    """
+    Load a tiktoken encoding once per process. Returns None when tiktoken is
+    missing or the BPE file cannot be loaded offline (see TIKTOKEN_CACHE_DIR).
+    """
+    if name in _encodings:
+        return _encodings[name]
+    with _encodings_lock:
+        if name not in _encodings:
+            encoding = None
+            if tiktoken is not None:
+                try:
+                    encoding = tiktoken.get_encoding(name)
+                except Exception as e:
+                    logger.warning(f"Could not load tiktoken encoding {name}, using estimate: {e}")
+            _encodings[name] = encoding
+    return _encodings[name]
+
+
+def _estimate(text: str) -> int:
+    pieces = _PIECE.findall(text)
+    # Las palabras largas suelen partirse en varios tokens
+    return sum(1 + len(p) // 8 if p[0].isalpha() else 1 for p in pieces)
+
+
+def _split(text: str) -> list:
+    """Split a large text into chunks at line boundaries."""
+    chunks = []
+    start = 0
+    while start < len(text):
+        end = min(start + CHUNK_CHARS, len(text))
+        if end < len(text):
+            newline = text.rfind("\n", start, end)
+            if newline > start:
+                end = newline + 1
+        chunks.append(text[start:end])
+        start = end
+    return chunks
+
+
+def _count_uncached(text: str, encoding_name: str) -> int:
+    encoding = _get_encoding(encoding_name)
+    if encoding is None:
+        return _estimate(text)
+    if len(text) <= CHUNK_CHARS:
+        return len(encoding.encode_ordinary(text))
+    # tiktoken libera el GIL: los trozos se tokenizan en hilos
+    return sum(len(tokens) for tokens in encoding.encode_ordinary_batch(_split(text)))
+
+
+def count_text(text: Optional[str], model_name: Optional[str] = None) -> int:
+    """
+    Count the tokens of a single text with the tokenizer of `model_name`.
+    Results are cached by content hash, so repeated texts are never re-tokenized.
+    """
+    if not text:
+        return 0
+    encoding_name = encoding_for_model(model_name)
+    key = (encoding_name, hashlib.blake2b(text.encode("utf-8"), digest_size=16).digest())
+    with _cache_lock:
+        if key in _cache:
+            _cache.move_to_end(key)
+            return _cache[key]
+
+    count = _count_uncached(text, encoding_name)
+
+    with _cache_lock:
+        _cache[key] = count
+        if len(_cache) > CACHE_SIZE:
+            _cache.popitem(last=False)
+    return count
+
+
+def message_tokens(message, model_name: Optional[str] = None) -> int:
+    """
+    Tokens of a stored `Message`, using its precomputed `token_count`
+    when available.
+    """
+    if getattr(message, "token_count", None) is not None:
+        return message.token_count + TOKENS_PER_MESSAGE
+    return count_text(message.content, model_name) + TOKENS_PER_MESSAGE
+
+
+def count_tokens(messages: Iterable[dict], model_name: Optional[str] = None) -> int:
+    """
+    Count the prompt tokens of a list of chat messages ({"role", "content"}),
+    including the per-message formatting overhead.
+    """
+    token_count = 0
+    for msg in messages:
+        content = msg.get("content", "")
+        if not isinstance(content, str):
+            content = str(content)
+        token_count += count_text(content, model_name) + TOKENS_PER_MESSAGE
+    if token_count:
+        token_count += TOKENS_PER_REPLY
+    return token_count
+
@@ -0,0 +1,132 @@
+# context_builder.py
+"""
+Ensamblado del contexto que se envía al modelo en cada turno.
+
+En lugar de leer la conversación entera y quedarse con los últimos N turnos,
+se lee el mensaje de sistema y la cola de la conversación en páginas
+ordenadas por `turn_index` descendente (LIMIT), y se van añadiendo turnos
+mientras quepan en el presupuesto de tokens del modelo.
+
+Si la conversación tiene resumen (summarizer.py), los turnos que cubre no se
+leen: se envía sistema + resumen + los turnos posteriores a `summary_turn`.
+"""
+from sqlalchemy import func, or_, select
+
+from models import db, Conversation, Message, RoleEnum
+from config.model_utils import get_model_config
+from config.tokenizer import message_tokens, TOKENS_PER_MESSAGE, TOKENS_PER_REPLY
+from summarizer import summary_payload, summary_tokens
+from message_archive import message_text
+
+model_config = get_model_config()
+
+# Mensajes leídos por consulta al recorrer la cola hacia atrás
+PAGE_SIZE = 50
+# Tope absoluto de mensajes de historial, aunque quepan en la ventana
+MAX_CONTEXT_MESSAGES = 400
+# Presupuesto para modelos sin entrada en allowed_models.json
+FALLBACK_CONTEXT_WINDOW = 16000
+
+
+def token_budget(model, reserved_output, max_input_tokens=None):
+    """
+    Tokens disponibles para el prompt: la ventana de contexto del modelo menos
+    la salida reservada (acotada por `max_output_tokens` del modelo).
+    `max_input_tokens` permite fijar un tope más bajo por configuración.
+    """
+    info = model_config.get_model(model) or {}
+    window = info.get("context_window") or FALLBACK_CONTEXT_WINDOW
+    output = min(reserved_output, info.get("max_output_tokens") or reserved_output)
+    budget = window - output - TOKENS_PER_REPLY
+    if max_input_tokens:
+        budget = min(budget, max_input_tokens)
+    return max(budget, 0)
+
+
+def context_tokens(conv_id, max_input_tokens=None):
+    """
+    Tokens aproximados del contexto que armará build_context para la
+    conversación (sistema + resumen + turnos posteriores), sin contar el turno
+    nuevo. Suma `token_count` en una sola consulta, sin leer el texto: sirve
+    para elegir modelo antes de construir el payload.
+    """
+    conv = db.session.get(Conversation, conv_id)
+    if conv is None:
+        return 0
+    query = select(func.coalesce(func.sum(func.coalesce(Message.token_count, 0) + TOKENS_PER_MESSAGE), 0))\
+        .where(Message.conversation_id == conv_id)
+    if summary_payload(conv):
+        query = query.where(or_(Message.role == RoleEnum.system, Message.turn_index > conv.summary_turn))
+    total = db.session.scalar(query) + summary_tokens(conv)
+    if max_input_tokens:
+        total = min(total, max_input_tokens)
+    return total
+
+
+def _system_message(conv_id):
+    return Message.query\
+        .filter_by(conversation_id=conv_id, role=RoleEnum.system)\
+        .order_by(Message.turn_index.asc())\
+        .first()
+
+
+def _tail_pages(conv_id, after=None):
+    """
+    Recorre los mensajes no-sistema del más nuevo al más viejo, por páginas,
+    sin bajar de `after` (turn_index ya cubierto por el resumen).
+    """
+    before = None
+    while True:
+        query = Message.query\
+            .filter(Message.conversation_id == conv_id, Message.role != RoleEnum.system)
+        if after is not None:
+            query = query.filter(Message.turn_index > after)
+        if before is not None:
+            query = query.filter(Message.turn_index < before)
+        page = query.order_by(Message.turn_index.desc()).limit(PAGE_SIZE).all()
+        if not page:
+            return
+        yield page
+        if len(page) < PAGE_SIZE:
+            return
+        before = page[-1].turn_index
+
+
+def build_context(conv_id, model, reserved_output, max_input_tokens=None):
+    """
+    Devuelve el payload [{"role", "content"}, ...] para el modelo: mensaje de
+    sistema + resumen (si lo hay) + los turnos más recientes que quepan en el
+    presupuesto.
+    El último mensaje (el turno del usuario) se incluye siempre.
+    """
+    budget = token_budget(model, reserved_output, max_input_tokens)
+
+    system_msg = _system_message(conv_id)
+    if system_msg:
+        budget -= message_tokens(system_msg, model)
+    # Normalmente ya está en la sesión (la vista acaba de cargarla)
+    conv = db.session.get(Conversation, conv_id)
+    summary = summary_payload(conv)
+    if summary:
+        budget -= summary_tokens(conv, model)
+
+    selected = []
+    done = False
+    for page in _tail_pages(conv_id, conv.summary_turn if summary else None):
+        for m in page:
+            cost = message_tokens(m, model)
+            if selected and (cost > budget or len(selected) >= MAX_CONTEXT_MESSAGES):
+                done = True
+                break
+            selected.append(m)
+            budget -= cost
+        if done:
+            break
+
+    payload = []
+    if system_msg:
+        payload.append({"role": system_msg.role.value, "content": message_text(system_msg)})
+    if summary:
+        payload.append(summary)
+    payload += [{"role": m.role.value, "content": message_text(m)} for m in reversed(selected)]
+    return payload
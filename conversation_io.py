@@ -0,0 +1,280 @@
+# conversation_io.py
+"""
+Exportación e importación de conversaciones en NDJSON.
+
+Formato: una línea JSON por registro. Cada conversación va seguida de sus
+mensajes en orden de turno:
+
+    {"type": "conversation", "id": 7, "title": "...", "created_at": "..."}
+    {"type": "message", "conversation_id": 7, "turn_index": 0, "role": "system", ...}
+
+La exportación es una única consulta (conversaciones LEFT JOIN mensajes)
+leída con un cursor del lado del servidor (`stream_results`) por bloques, y
+cada fila se escribe según llega. La memoria no depende del tamaño del
+historial. Con gzip se comprime al vuelo.
+
+La importación lee línea a línea y crea conversaciones nuevas para el
+usuario de destino. Los ids originales solo sirven para asociar mensajes y
+conversación. Los `turn_index` se renumeran de forma correlativa desde 0 y
+`next_turn` queda justo detrás del último. Los mensajes se insertan por
+lotes: con COPY en PostgreSQL y con un INSERT multi-fila en el resto. Todo
+ocurre en una transacción: un fichero con errores no deja nada a medias.
+"""
+import csv
+import gzip
+import io
+import json
+import zlib
+from datetime import datetime
+
+from sqlalchemy import bindparam, insert, select
+
+from models import db, Conversation, Message, MessageStatusEnum, RoleEnum
+from config.tokenizer import count_text
+from message_archive import message_text, system_prompt_id
+
+EXPORT_CHUNK_ROWS = 1000
+IMPORT_BATCH_SIZE = 5000
+
+_MESSAGE_COLUMNS = ("conversation_id", "role", "content", "system_prompt_id", "created_at",
+                    "turn_index", "token_count", "status")
+
+
+class ImportFormatError(ValueError):
+    """Línea del NDJSON que no se puede importar."""
+
+    def __init__(self, line_no, message):
+        super().__init__(f"Línea {line_no}: {message}")
+        self.line_no = line_no
+
+
+# --- Exportación ---
+
+def _iso(value):
+    return value.isoformat() if value else None
+
+
+def export_lines(user_id):
+    """Genera las líneas NDJSON (str, con salto de línea) del historial del usuario."""
+    c, m = Conversation.__table__, Message.__table__
+    query = select(
+        c.c.id, c.c.title, c.c.created_at, c.c.updated_at,
+        m.c.turn_index, m.c.role, m.c.content, m.c.status, m.c.created_at.label("message_created_at"),
+        m.c.token_count, m.c.system_prompt_id, m.c.content_archive, m.c.content_codec,
+        m.c.archive_dict_id,
+    ).select_from(c.outerjoin(m, m.c.conversation_id == c.c.id))\
+        .where(c.c.user_id == user_id)\
+        .order_by(c.c.id, m.c.turn_index)
+
+    result = db.session.execute(
+        query.execution_options(stream_results=True, yield_per=EXPORT_CHUNK_ROWS)
+    )
+    current = None
+    try:
+        for row in result:
+            if row.id != current:
+                current = row.id
+                yield json.dumps({
+                    "type": "conversation",
+                    "id": row.id,
+                    "title": row.title,
+                    "created_at": _iso(row.created_at),
+                    "updated_at": _iso(row.updated_at),
+                }, ensure_ascii=False) + "\n"
+            if row.turn_index is None:
+                continue   # conversación sin mensajes (LEFT JOIN)
+            yield json.dumps({
+                "type": "message",
+                "conversation_id": row.id,
+                "turn_index": row.turn_index,
+                "role": row.role.value,
+                "content": message_text(row),
+                "status": row.status.value,
+                "created_at": _iso(row.message_created_at),
+                "token_count": row.token_count,
+            }, ensure_ascii=False) + "\n"
+    finally:
+        result.close()
+
+
+def export_chunks(user_id, compress=False):
+    """Bytes listos para enviar o escribir; con `compress` en formato gzip."""
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31) if compress else None
+    buffer, size = [], 0
+    for line in export_lines(user_id):
+        data = line.encode("utf-8")
+        buffer.append(data)
+        size += len(data)
+        if size >= 64 * 1024:
+            chunk = b"".join(buffer)
+            buffer, size = [], 0
+            chunk = compressor.compress(chunk) if compressor else chunk
+            if chunk:
+                yield chunk
+    chunk = b"".join(buffer)
+    if compressor:
+        chunk = compressor.compress(chunk) + compressor.flush()
+    if chunk:
+        yield chunk
+
+
+# --- Importación ---
+
+def open_ndjson(stream):
+    """Envuelve un stream binario (gzip o no) como texto línea a línea."""
+    if not hasattr(stream, "peek"):
+        stream = io.BufferedReader(stream)
+    if stream.peek(2)[:2] == b"\x1f\x8b":
+        stream = gzip.GzipFile(fileobj=stream)
+    return io.TextIOWrapper(stream, encoding="utf-8")
+
+
+def _parse_datetime(value, line_no):
+    if value is None:
+        return datetime.utcnow()
+    try:
+        return datetime.fromisoformat(value)
+    except (TypeError, ValueError):
+        raise ImportFormatError(line_no, f"fecha inválida: {value!r}")
+
+
+class _Importer:
+    def __init__(self, user_id, batch_size, trust_token_counts):
+        self.user_id = user_id
+        self.batch_size = batch_size
+        self.trust_token_counts = trust_token_counts
+        self.connection = db.session.connection()
+        self.use_copy = self.connection.dialect.name == "postgresql"
+        self.ids = {}          # id original -> id nuevo
+        self.next_turn = {}    # id nuevo -> siguiente turn_index
+        self.rows = []
+        self.conversations = 0
+        self.messages = 0
+
+    def conversation(self, record, line_no):
+        table = Conversation.__table__
+        new_id = self.connection.execute(
+            insert(table).returning(table.c.id),
+            {
+                "user_id": self.user_id,
+                "title": record.get("title") or "Sin título",
+                "created_at": _parse_datetime(record.get("created_at"), line_no),
+                "updated_at": _parse_datetime(record.get("updated_at") or record.get("created_at"), line_no),
+                "next_turn": 0,
+            },
+        ).scalar_one()
+        self.ids[record.get("id")] = new_id
+        self.next_turn[new_id] = 0
+        self.conversations += 1
+
+    def message(self, record, line_no):
+        conv_id = self.ids.get(record.get("conversation_id"))
+        if conv_id is None:
+            raise ImportFormatError(line_no, "mensaje antes de su conversación")
+        try:
+            role = RoleEnum(record["role"])
+        except (KeyError, ValueError):
+            raise ImportFormatError(line_no, f"rol inválido: {record.get('role')!r}")
+        content = record.get("content")
+        if not isinstance(content, str):
+            raise ImportFormatError(line_no, "falta content")
+        try:
+            status = MessageStatusEnum(record.get("status") or "complete")
+        except ValueError:
+            raise ImportFormatError(line_no, f"estado inválido: {record.get('status')!r}")
+        if status == MessageStatusEnum.streaming:
+            # Nadie va a terminar esa respuesta en el destino
+            status = MessageStatusEnum.interrupted
+
+        prompt_id = None
+        if role == RoleEnum.system:
+            # Los prompts de sistema se deduplican en plantillas compartidas
+            prompt_id = system_prompt_id(content)
+
+        turn = self.next_turn[conv_id]
+        self.next_turn[conv_id] = turn + 1
+        token_count = record.get("token_count") if self.trust_token_counts else None
+        self.rows.append({
+            "conversation_id": conv_id,
+            "role": role,
+            "content": "" if prompt_id else content,
+            "system_prompt_id": prompt_id,
+            "created_at": _parse_datetime(record.get("created_at"), line_no),
+            "turn_index": turn,
+            "token_count": token_count if isinstance(token_count, int) else count_text(content),
+            "status": status,
+        })
+        self.messages += 1
+        if len(self.rows) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self.rows:
+            return
+        if self.use_copy:
+            self._copy(self.rows)
+        else:
+            self.connection.execute(insert(Message.__table__), self.rows)
+        self.rows = []
+
+    def _copy(self, rows):
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        for row in rows:
+            values = dict(row, role=row["role"].name, status=row["status"].name,
+                          created_at=row["created_at"].isoformat())
+            writer.writerow([values[col] for col in _MESSAGE_COLUMNS])
+        buffer.seek(0)
+        cursor = self.connection.connection.cursor()
+        try:
+            # En CSV, COPY lee un campo vacío sin comillas como NULL, y csv.writer
+            # escribe así "" (respuestas interrumpidas, plantillas de sistema)
+            cursor.copy_expert(
+                f"COPY messages ({', '.join(_MESSAGE_COLUMNS)}) FROM STDIN "
+                "WITH (FORMAT csv, FORCE_NOT_NULL (content))", buffer
+            )
+        finally:
+            cursor.close()
+
+    def finish(self):
+        self.flush()
+        if self.next_turn:
+            table = Conversation.__table__
+            self.connection.execute(
+                table.update()
+                .where(table.c.id == bindparam("conv_id"))
+                .values(next_turn=bindparam("turn")),
+                [{"conv_id": k, "turn": v} for k, v in self.next_turn.items()],
+            )
+
+
+def import_ndjson(lines, user_id, batch_size=IMPORT_BATCH_SIZE, trust_token_counts=False):
+    """
+    Importa las líneas NDJSON para `user_id` y confirma la transacción.
+    Devuelve {"conversations": n, "messages": n}; lanza ImportFormatError
+    (sin importar nada) si alguna línea no es válida. `token_count` del
+    fichero solo se usa con `trust_token_counts` (CLI); si no, se recuenta.
+    """
+    importer = _Importer(user_id, batch_size, trust_token_counts)
+    try:
+        for line_no, line in enumerate(lines, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError:
+                raise ImportFormatError(line_no, "JSON inválido")
+            kind = record.get("type") if isinstance(record, dict) else None
+            if kind == "conversation":
+                importer.conversation(record, line_no)
+            elif kind == "message":
+                importer.message(record, line_no)
+            else:
+                raise ImportFormatError(line_no, f"tipo desconocido: {kind!r}")
+        importer.finish()
+        db.session.commit()
+    except BaseException:
+        db.session.rollback()
+        raise
+    return {"conversations": importer.conversations, "messages": importer.messages}
@@ -0,0 +1,9 @@
+# Configuración de Gunicorn para el modo asíncrono (asgi:app).
+# Uso: gunicorn -c gunicorn_async_conf.py asgi:app
+from gunicorn_conf import *  # noqa: F401,F403 - bind, timeout, logs, keepalive
+
+# Worker ASGI: cada proceso atiende muchos streams concurrentes en un event loop
+worker_class = "uvicorn.workers.UvicornWorker"
+
+# Con workers async no hace falta multiplicar procesos para aguantar streams lentos
+workers = 2
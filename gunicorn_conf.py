@@ -1,4 +1,10 @@
 import multiprocessing
+import os
+import shutil
+
+# Métricas Prometheus agregadas entre workers (metrics.py). Se define aquí,
+# en el master, para que los workers la hereden antes de importar la app.
+os.environ.setdefault("PROMETHEUS_MULTIPROC_DIR", "/tmp/epicode/prometheus")
 
 # Bind to all interfaces on port 8000
 bind = "0.0.0.0:5002"
@@ -20,3 +26,23 @@ errorlog = "-"
 
 # Enable keep-alive connections
 keepalive = 2
+
+
+def post_worker_init(worker):
+    """Abre la conexión con OpenAI al arrancar cada worker, no en la primera petición."""
+    from upstream import warm_up
+    # En modo ASGI worker.wsgi es AsyncStreamingApp, que envuelve la app Flask
+    warm_up(getattr(worker.wsgi, "flask_app", worker.wsgi))
+
+
+def on_starting(server):
+    """Vacía los ficheros de métricas de una ejecución anterior."""
+    path = os.environ["PROMETHEUS_MULTIPROC_DIR"]
+    shutil.rmtree(path, ignore_errors=True)
+    os.makedirs(path, exist_ok=True)
+
+
+def child_exit(server, worker):
+    """Los gauges "live" del worker que sale dejan de sumar en /metrics."""
+    from metrics import mark_process_dead
+    mark_process_dead(worker.pid)
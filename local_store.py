@@ -0,0 +1,60 @@
+# local_store.py
+"""
+Almacén local compartido entre los workers de gunicorn de una misma máquina.
+
+Es un fichero SQLite en modo WAL: lecturas concurrentes sin bloqueo y
+escrituras serializadas por SQLite, sin servicios externos. Cada hilo de cada
+proceso abre su propia conexión (las conexiones no sobreviven a un fork).
+"""
+import os
+import sqlite3
+import threading
+
+
+class LocalStore:
+    def __init__(self, path, schema=(), busy_timeout_ms=5000):
+        self.path = path
+        self.schema = tuple(schema)
+        self.busy_timeout_ms = busy_timeout_ms
+        self._local = threading.local()
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+
+    def connection(self):
+        """Conexión de este hilo/proceso, creada y configurada la primera vez."""
+        conn = getattr(self._local, "conn", None)
+        if conn is not None and self._local.pid == os.getpid():
+            return conn
+        conn = sqlite3.connect(self.path, timeout=self.busy_timeout_ms / 1000, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(f"PRAGMA busy_timeout={int(self.busy_timeout_ms)}")
+        for statement in self.schema:
+            conn.execute(statement)
+        self._local.conn = conn
+        self._local.pid = os.getpid()
+        return conn
+
+    def execute(self, sql, params=()):
+        return self.connection().execute(sql, params)
+
+    def transaction(self):
+        """
+        Transacción de escritura inmediata (BEGIN IMMEDIATE): toma el lock de
+        escritura al empezar, así un leer-modificar-escribir es atómico entre
+        procesos.
+        """
+        return _Transaction(self.connection())
+
+
+class _Transaction:
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __enter__(self):
+        self.conn.execute("BEGIN IMMEDIATE")
+        return self.conn
+
+    def __exit__(self, exc_type, exc, tb):
+        self.conn.execute("ROLLBACK" if exc_type else "COMMIT")
+        return False
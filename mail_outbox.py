@@ -0,0 +1,233 @@
+# mail_outbox.py
+"""
+Envío de correo en segundo plano.
+
+Las vistas no hablan con el servidor SMTP: `enqueue_email` añade una fila a
+`outbox_emails` en la misma transacción que el cambio que la origina (p. ej.
+el token de restablecimiento) y la respuesta HTTP sale al momento. Un hilo de
+fondo por worker reclama lotes de correos pendientes y los envía por una única
+conexión SMTP autenticada que se reutiliza entre lotes.
+
+Reclamar un correo es un UPDATE ... RETURNING que adelanta su
+`next_attempt_at` un "lease": dos workers nunca envían el mismo correo a la
+vez, y si un worker muere a mitad de envío el correo se reintenta al vencer
+el lease. Los fallos transitorios se reintentan con backoff exponencial; los
+permanentes (destinatario rechazado) o tras MAIL_MAX_ATTEMPTS quedan en
+"failed".
+"""
+import atexit
+import logging
+import os
+import random
+import smtplib
+import threading
+import time
+from datetime import datetime, timedelta
+from email.mime.text import MIMEText
+
+from sqlalchemy import select
+
+from models import db, OutboxEmail
+
+logger = logging.getLogger(__name__)
+
+PENDING = "pending"
+SENT = "sent"
+FAILED = "failed"
+
+# Errores tras los que no tiene sentido reintentar
+PERMANENT_ERRORS = (smtplib.SMTPRecipientsRefused, smtplib.SMTPSenderRefused,
+                    smtplib.SMTPNotSupportedError)
+
+
+def enqueue_email(subject, recipient, body):
+    """Añade el correo a la sesión actual; se enviará cuando se haga commit."""
+    email = OutboxEmail(recipient=recipient, subject=subject, body=body)
+    db.session.add(email)
+    return email
+
+
+class SMTPConnection:
+    """
+    Conexión SMTP reutilizable. Se abre (y autentica) la primera vez, se
+    comprueba con NOOP si lleva un rato ociosa y se cierra tras `idle_timeout`
+    segundos sin uso.
+    """
+
+    def __init__(self, config, idle_timeout=60.0, check_after=10.0):
+        self.config = config
+        self.idle_timeout = idle_timeout
+        self.check_after = check_after
+        self._server = None
+        self._last_used = 0.0
+
+    def _open(self):
+        config = self.config
+        timeout = config.get("MAIL_TIMEOUT", 10)
+        if config.get("MAIL_USE_SSL"):
+            server = smtplib.SMTP_SSL(config["MAIL_SERVER"], config["MAIL_PORT"], timeout=timeout)
+        else:
+            server = smtplib.SMTP(config["MAIL_SERVER"], config["MAIL_PORT"], timeout=timeout)
+            if config.get("MAIL_USE_TLS"):
+                server.starttls()
+        # Un servidor local de depuración no pide credenciales
+        if config.get("MAIL_USERNAME"):
+            server.login(config["MAIL_USERNAME"], config["MAIL_PASSWORD"])
+        return server
+
+    def get(self):
+        now = time.monotonic()
+        if self._server is not None and now - self._last_used > self.check_after:
+            try:
+                self._server.noop()
+            except smtplib.SMTPException:
+                self.close()
+        if self._server is None:
+            self._server = self._open()
+        self._last_used = now
+        return self._server
+
+    def send(self, sender, recipient, message):
+        try:
+            self.get().sendmail(sender, [recipient], message)
+        except PERMANENT_ERRORS:
+            raise
+        except (smtplib.SMTPServerDisconnected, ConnectionError):
+            # El servidor cerró la conexión reutilizada: se reabre una vez
+            self.close()
+            self.get().sendmail(sender, [recipient], message)
+        self._last_used = time.monotonic()
+
+    def close_if_idle(self):
+        if self._server is not None and time.monotonic() - self._last_used > self.idle_timeout:
+            self.close()
+
+    def close(self):
+        if self._server is None:
+            return
+        try:
+            self._server.quit()
+        except (smtplib.SMTPException, OSError):
+            pass
+        self._server = None
+
+
+class MailOutbox:
+    def __init__(self, app, poll_interval=10.0, batch_size=20, max_attempts=5,
+                 backoff_base=30.0, backoff_max=3600.0, lease=300.0):
+        self.app = app
+        self.poll_interval = poll_interval
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.lease = lease
+        self.smtp = SMTPConnection(app.config, idle_timeout=app.config.get("MAIL_IDLE_TIMEOUT", 60))
+        self._wakeup = threading.Event()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+        atexit.register(self.smtp.close)
+
+    @property
+    def sender(self):
+        return self.app.config.get("MAIL_DEFAULT_SENDER") or self.app.config["MAIL_USERNAME"]
+
+    def notify(self):
+        """Despierta al hilo de envío (llamar tras el commit que encola)."""
+        self._ensure_thread()
+        self._wakeup.set()
+
+    def _ensure_thread(self):
+        # Tras un fork de gunicorn el hilo del padre no existe en el hijo
+        if self._thread is not None and self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._thread is not None and self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name="mail-outbox", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.poll_interval)
+            self._wakeup.clear()
+            try:
+                while self.drain_once():
+                    pass
+                self.smtp.close_if_idle()
+            except Exception as e:
+                logger.error(f"Mail outbox failed: {e}", exc_info=True)
+
+    # --- Envío ---
+
+    def _claim(self):
+        """Reclama hasta `batch_size` correos vencidos; devuelve sus filas."""
+        now = datetime.utcnow()
+        table = OutboxEmail.__table__
+        due = select(table.c.id)\
+            .where(table.c.status == PENDING, table.c.next_attempt_at <= now)\
+            .order_by(table.c.next_attempt_at)\
+            .limit(self.batch_size)\
+            .with_for_update(skip_locked=True)
+        ids = list(db.session.execute(due).scalars())
+        if not ids:
+            db.session.rollback()
+            return []
+        rows = db.session.execute(
+            table.update()
+            .where(table.c.id.in_(ids), table.c.status == PENDING, table.c.next_attempt_at <= now)
+            .values(next_attempt_at=now + timedelta(seconds=self.lease), attempts=table.c.attempts + 1)
+            .returning(table.c.id, table.c.recipient, table.c.subject, table.c.body, table.c.attempts)
+        ).all()
+        db.session.commit()
+        return rows
+
+    def _backoff(self, attempts):
+        delay = min(self.backoff_max, self.backoff_base * 2 ** (attempts - 1))
+        return timedelta(seconds=delay * random.uniform(0.8, 1.2))
+
+    def drain_once(self):
+        """Envía un lote. Devuelve True si había trabajo (puede quedar más)."""
+        with self.app.app_context():
+            rows = self._claim()
+            if not rows:
+                return False
+
+            table = OutboxEmail.__table__
+            for row in rows:
+                msg = MIMEText(row.body, "html")
+                msg["Subject"] = row.subject
+                msg["From"] = self.sender
+                msg["To"] = row.recipient
+                try:
+                    self.smtp.send(self.sender, row.recipient, msg.as_string())
+                    values = {"status": SENT, "sent_at": datetime.utcnow(), "last_error": None}
+                except PERMANENT_ERRORS as e:
+                    logger.error(f"Correo {row.id} rechazado: {e}")
+                    values = {"status": FAILED, "last_error": str(e)}
+                except (smtplib.SMTPException, OSError) as e:
+                    if row.attempts >= self.max_attempts:
+                        logger.error(f"Correo {row.id} descartado tras {row.attempts} intentos: {e}")
+                        values = {"status": FAILED, "last_error": str(e)}
+                    else:
+                        logger.warning(f"Correo {row.id} fallido (intento {row.attempts}): {e}")
+                        values = {"next_attempt_at": datetime.utcnow() + self._backoff(row.attempts),
+                                  "last_error": str(e)}
+                    # La conexión puede haber quedado inservible
+                    self.smtp.close()
+                db.session.execute(table.update().where(table.c.id == row.id).values(**values))
+                db.session.commit()
+            return len(rows) == self.batch_size
+
+
+def init_mail_outbox(app):
+    outbox = MailOutbox(
+        app,
+        poll_interval=app.config.get("MAIL_POLL_INTERVAL", 10),
+        batch_size=app.config.get("MAIL_BATCH_SIZE", 20),
+        max_attempts=app.config.get("MAIL_MAX_ATTEMPTS", 5),
+    )
+    app.extensions["mail_outbox"] = outbox
+    return outbox
@@ -1,10 +1,12 @@
 # manage.py
 import os
+import json
+import time
 import click
 import logging
 from functools import wraps # Only needed if you have custom decorators here, otherwise can remove
 
-from flask import Flask, abort # abort might not be used here anymore, can remove if so
+from flask import Flask, abort, flash, current_app # abort might not be used here anymore, can remove if so
 from flask.cli import with_appcontext
 # from flask_sqlalchemy import SQLAlchemy # This import can be removed, as db is imported from models
 from flask_migrate import Migrate
@@ -19,7 +21,16 @@ from flask_login import LoginManager, current_user
 from flask_admin import Admin
 from flask_admin.contrib.sqla import ModelView
 from flask_admin.actions import action
-from models import db, User 
+from models import db, BatchJob, User 
+from user_cache import init_user_cache, invalidate_user, load_identity
+from mail_outbox import init_mail_outbox
+from metrics import init_metrics
+from sql_profiler import init_sql_profiler
+from conversation_io import ImportFormatError, export_chunks, import_ndjson, open_ndjson
+from message_archive import (
+    Archiver, archive_stats, read_latency, rebuild_search_index, train_dictionary
+)
+from batch_jobs import BatchError, FINAL_STATES, create_job, item_page
 import routes 
 from auth import init_app, auth_bp
 
@@ -34,7 +45,8 @@ login_manager = LoginManager()
 
 @login_manager.user_loader
 def load_user(user_id):
-    return User.query.get(int(user_id))
+    # Identidad cacheada con TTL: sin consulta a `users` en cada petición
+    return load_identity(int(user_id))
 
 @click.command("init-admin")
 @with_appcontext
@@ -60,9 +72,158 @@ def init_admin_env():
     user.is_approved = True
     db.session.add(user)
     db.session.commit()
+    invalidate_user(user.id)
     click.echo(f"✅  Administrador `{username}` con email `{email}` listo (desde .env).")
 
 
+def _user_or_fail(username):
+    user = User.query.filter_by(username=username).first()
+    if user is None:
+        raise click.ClickException(f"No existe el usuario `{username}`.")
+    return user
+
+
+@click.command("export-conversations")
+@click.argument("username")
+@click.option("-o", "--output", type=click.File("wb"), default="-", help="Fichero de salida (por defecto stdout).")
+@click.option("--gzip", "compress", is_flag=True, help="Comprimir la salida con gzip.")
+@with_appcontext
+def export_conversations_command(username, output, compress):
+    """Exporta en NDJSON las conversaciones y mensajes de USERNAME."""
+    user = _user_or_fail(username)
+    for chunk in export_chunks(user.id, compress):
+        output.write(chunk)
+
+
+@click.command("import-conversations")
+@click.argument("username")
+@click.argument("source", type=click.File("rb"), default="-")
+@with_appcontext
+def import_conversations_command(username, source):
+    """Importa un NDJSON (plano o gzip) como conversaciones nuevas de USERNAME."""
+    user = _user_or_fail(username)
+    try:
+        result = import_ndjson(open_ndjson(source), user.id, trust_token_counts=True)
+    except ImportFormatError as e:
+        raise click.ClickException(str(e))
+    routes._invalidate_conversation_list(user.id)
+    click.echo(f"✅  Importadas {result['conversations']} conversaciones y {result['messages']} mensajes.")
+
+
+@click.command("send-mail")
+@click.option("--loop", is_flag=True, help="Seguir enviando (proceso dedicado) en lugar de vaciar y salir.")
+@with_appcontext
+def send_mail_command(loop):
+    """Envía los correos pendientes de la outbox."""
+    outbox = current_app.extensions["mail_outbox"]
+    while True:
+        while outbox.drain_once():
+            pass
+        if not loop:
+            break
+        time.sleep(outbox.poll_interval)
+    outbox.smtp.close()
+    click.echo("✅  Outbox vaciada.")
+
+
+@click.command("archive-messages")
+@click.option("--loop", is_flag=True, help="Seguir archivando (proceso dedicado) en lugar de terminar.")
+@click.option("--train-dict", is_flag=True, help="Entrenar antes un diccionario nuevo con mensajes recientes.")
+@click.option("--stats", "show_stats", is_flag=True, help="Solo mostrar tamaños y latencia de lectura.")
+@click.option("--rebuild-search", is_flag=True,
+              help="Solo reconstruir el índice FTS5 (SQLite) sin perder los archivados.")
+@with_appcontext
+def archive_messages_command(loop, train_dict, show_stats, rebuild_search):
+    """Comprime el texto de los mensajes antiguos (ARCHIVE_AFTER_DAYS)."""
+    config = current_app.config
+    if rebuild_search:
+        reindexed = rebuild_search_index()
+        if reindexed is None:
+            click.echo("Solo SQLite tiene índice FTS5; en PostgreSQL no hay nada que reconstruir.")
+            return
+        click.echo(f"✅  Índice de búsqueda reconstruido ({reindexed} mensajes archivados).")
+        return
+    if show_stats:
+        for key, value in archive_stats().items():
+            click.echo(f"{key}: {value}")
+        latency = read_latency()
+        if latency:
+            click.echo(f"lectura archivados: media {latency['mean_ms']:.2f} ms, "
+                       f"p95 {latency['p95_ms']:.2f} ms ({latency['samples']} muestras)")
+        return
+
+    archiver = Archiver(
+        after_days=config.get("ARCHIVE_AFTER_DAYS", 30),
+        min_chars=config.get("ARCHIVE_MIN_CHARS", 256),
+        batch_size=config.get("ARCHIVE_BATCH_SIZE", 500),
+        codec=config.get("ARCHIVE_CODEC") or None,
+        level=config.get("ARCHIVE_LEVEL") or None,
+    )
+    if train_dict:
+        dict_id = train_dictionary(archiver.codec)
+        click.echo(f"Diccionario {archiver.codec} creado: {dict_id}")
+    archived, before, after = archiver.run(loop=loop, interval=config.get("ARCHIVE_INTERVAL", 3600))
+    ratio = f" ({after / before:.0%} del tamaño original)" if before else ""
+    click.echo(f"✅  Archivados {archived} mensajes: {before} → {after} bytes{ratio}.")
+
+
+@click.command("batch-submit")
+@click.argument("username")
+@click.argument("model")
+@click.argument("source", type=click.File("r", encoding="utf-8"), default="-")
+@with_appcontext
+def batch_submit_command(username, model, source):
+    """
+    Crea un trabajo por lotes con los prompts de SOURCE (JSONL): una línea por
+    prompt, texto JSON o {"prompt": ...} / {"messages": [...]}.
+    """
+    user = _user_or_fail(username)
+    try:
+        prompts = [json.loads(line) for line in source if line.strip()]
+        job = create_job(user.id, model, prompts, routes.SYSTEM_PROMPT,
+                         max_items=current_app.config.get("BATCH_MAX_ITEMS", 5000),
+                         router=current_app.extensions.get("model_router"))
+    except (BatchError, json.JSONDecodeError) as e:
+        raise click.ClickException(str(e))
+    click.echo(f"✅  Lote {job.id} creado con {job.total} prompts (se envía con `flask batch-run`).")
+
+
+@click.command("batch-run")
+@click.option("--loop", is_flag=True, help="Seguir atendiendo lotes (proceso dedicado) en lugar de terminar.")
+@with_appcontext
+def batch_run_command(loop):
+    """Envía los lotes pendientes y consulta los enviados."""
+    runner = current_app.extensions["batch_runner"]
+    while True:
+        while runner.run_once():
+            pass
+        if not loop:
+            break
+        time.sleep(runner.poll_interval)
+    click.echo("✅  Lotes al día.")
+
+
+@click.command("batch-results")
+@click.argument("job_id", type=int)
+@click.option("-o", "--output", type=click.File("w", encoding="utf-8"), default="-", help="Fichero de salida (por defecto stdout).")
+@with_appcontext
+def batch_results_command(job_id, output):
+    """Escribe en JSONL los resultados de un lote terminado."""
+    job = db.session.get(BatchJob, job_id)
+    if job is None:
+        raise click.ClickException(f"No existe el lote {job_id}.")
+    if job.status not in FINAL_STATES:
+        raise click.ClickException(f"El lote {job_id} sigue en curso ({job.completed + job.failed}/{job.total}).")
+    after = None
+    while True:
+        page = item_page(job.id, 1000, after)
+        for item in page["items"]:
+            output.write(json.dumps(item, ensure_ascii=False) + "\n")
+        if not page["next_cursor"]:
+            break
+        after = page["items"][-1]["idx"]
+
+
 class SecureModelView(ModelView):
     def scaffold_form(self):
         form_class = super().scaffold_form()
@@ -73,11 +234,11 @@ class SecureModelView(ModelView):
     form_excluded_columns = ('conversations',)
 
     # Sólo estos campos en el form de edición
-    form_columns = ['username', 'email', 'is_admin', 'is_approved']
+    form_columns = ['username', 'email', 'is_admin', 'is_approved', 'tier']
 
     # Columnas visibles
-    column_list = ['id', 'username', 'email', 'is_admin', 'is_approved']
-    column_filters = ['is_admin', 'is_approved']
+    column_list = ['id', 'username', 'email', 'is_admin', 'is_approved', 'tier']
+    column_filters = ['is_admin', 'is_approved', 'tier']
     column_searchable_list = ['username', 'email']
     can_create = False    # opcional
     can_delete = True
@@ -87,6 +248,13 @@ class SecureModelView(ModelView):
     def is_accessible(self):
         return current_user.is_authenticated and current_user.is_admin
 
+    # Cualquier cambio de permisos/aprobación debe verse en la siguiente petición
+    def after_model_change(self, form, model, is_created):
+        invalidate_user(model.id)
+
+    def after_model_delete(self, model):
+        invalidate_user(model.id)
+
     # acción en lote para aprobar usuarios
     @action('approve', 'Aprobar seleccionados', '¿Seguro que quieres aprobar estos usuarios?')
     def action_approve(self, ids):
@@ -97,6 +265,7 @@ class SecureModelView(ModelView):
                 u.is_approved = True
                 n += 1
         db.session.commit()
+        invalidate_user(*ids)
         flash(f"{n} usuario(s) aprobado(s).", "success")
 
 def create_app():
@@ -105,8 +274,13 @@ def create_app():
     # Carga de configuración según entorno
     env = os.getenv("FLASK_ENV", "development")
     app.config.from_object(app_config.config[env])
+    # Antes de db.init_app: el pool de la BD mide las esperas de checkout
+    init_metrics(app)
     db.init_app(app)
+    init_sql_profiler(app)
     migrate.init_app(app, db)
+    init_user_cache(app)
+    init_mail_outbox(app)
 
     login_manager.init_app(app)
     login_manager.login_view = "auth.login" # Correctly points to the blueprint's login endpoint
@@ -125,6 +299,13 @@ def create_app():
 
     # Registra el comando que lee de .env
     app.cli.add_command(init_admin_env)
+    app.cli.add_command(send_mail_command)
+    app.cli.add_command(export_conversations_command)
+    app.cli.add_command(import_conversations_command)
+    app.cli.add_command(archive_messages_command)
+    app.cli.add_command(batch_submit_command)
+    app.cli.add_command(batch_run_command)
+    app.cli.add_command(batch_results_command)
 
     # Flask-Admin
     admin = Admin(app, name="Panel Admin", template_mode="bootstrap3", url="/admin", endpoint="flask_admin")
@@ -0,0 +1,387 @@
+# message_archive.py
+"""
+Almacenamiento compacto del texto de los mensajes.
+
+- Plantillas de sistema: el prompt de sistema de cada conversación no se
+  copia en `messages.content`. Se guarda una vez en `system_prompts`,
+  deduplicado por hash, y el mensaje lo referencia con `system_prompt_id`.
+- Archivo en frío: `Archiver` comprime los mensajes con más de
+  ARCHIVE_AFTER_DAYS días en `content_archive` y deja `content` vacío. Usa
+  zstd si el paquete `zstandard` está instalado y zlib si no, con un
+  diccionario compartido opcional (`flask archive-messages --train-dict`).
+  Un diccionario sirve sobre todo para mensajes cortos y medianos, que
+  comparten mucho vocabulario y código entre sí.
+
+Cualquier lectura del texto pasa por `message_text()`, que resuelve la
+plantilla o descomprime según el caso. Plantillas y diccionarios son
+inmutables, así que se cachean en memoria por id.
+"""
+import hashlib
+import logging
+import threading
+import time
+import zlib
+from datetime import datetime, timedelta
+
+from sqlalchemy import bindparam, event, func, select, text
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+
+from models import db, CompressionDict, Message, MessageStatusEnum, RoleEnum, SystemPrompt
+
+try:
+    import zstandard
+except ImportError:   # dependencia opcional
+    zstandard = None
+
+logger = logging.getLogger(__name__)
+
+CODEC_ZSTD = "zstd"
+CODEC_ZLIB = "zlib"
+
+# zlib solo usa los últimos 32 KB del diccionario
+ZLIB_DICT_SIZE = 32 * 1024
+ZSTD_DICT_SIZE = 112 * 1024
+
+_prompts = {}          # id -> texto
+_prompt_ids = {}       # hash -> id
+_dicts = {}            # id -> (codec, bytes)
+_cache_lock = threading.Lock()
+
+# Plantillas creadas en la transacción en curso (session.info): solo pasan a
+# la caché del proceso cuando la transacción se confirma
+_PENDING_PROMPTS = "message_archive.pending_prompts"
+
+
+def default_codec():
+    return CODEC_ZSTD if zstandard is not None else CODEC_ZLIB
+
+
+# --- Plantillas de sistema ---
+
+def _hash(content):
+    return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+
+def system_prompt_id(content):
+    """Id de la plantilla con este texto; la crea si no existe (sin commit)."""
+    digest = _hash(content)
+    prompt_id = _prompt_ids.get(digest)
+    if prompt_id is not None:
+        return prompt_id
+    pending = db.session.info.get(_PENDING_PROMPTS)
+    if pending and digest in pending:
+        return pending[digest][0]
+    table = SystemPrompt.__table__
+    prompt_id = db.session.execute(
+        select(table.c.id).where(table.c.content_hash == digest)
+    ).scalar()
+    if prompt_id is None:
+        try:
+            # SAVEPOINT: si otro worker la crea a la vez, se usa la suya
+            with db.session.begin_nested():
+                prompt_id = db.session.execute(
+                    table.insert().returning(table.c.id),
+                    {"content": content, "content_hash": digest, "created_at": datetime.utcnow()},
+                ).scalar_one()
+        except IntegrityError:
+            prompt_id = db.session.execute(
+                select(table.c.id).where(table.c.content_hash == digest)
+            ).scalar_one()
+        else:
+            # Si la transacción se deshace, la fila no existe: no se cachea aún
+            db.session.info.setdefault(_PENDING_PROMPTS, {})[digest] = (prompt_id, content)
+            return prompt_id
+    with _cache_lock:
+        _prompt_ids[digest] = prompt_id
+        _prompts[prompt_id] = content
+    return prompt_id
+
+
+@event.listens_for(Session, "after_commit")
+def _publish_prompts(session):
+    pending = session.info.pop(_PENDING_PROMPTS, None)
+    if pending:
+        with _cache_lock:
+            for digest, (prompt_id, content) in pending.items():
+                _prompt_ids[digest] = prompt_id
+                _prompts[prompt_id] = content
+
+
+@event.listens_for(Session, "after_transaction_end")
+def _discard_prompts(session, transaction):
+    # Tras un rollback de la transacción principal (tras un commit ya se vació)
+    if transaction.parent is None:
+        session.info.pop(_PENDING_PROMPTS, None)
+
+
+def _prompt_text(prompt_id):
+    content = _prompts.get(prompt_id)
+    if content is None:
+        content = db.session.execute(
+            select(SystemPrompt.content).where(SystemPrompt.id == prompt_id)
+        ).scalar_one()
+        with _cache_lock:
+            _prompts[prompt_id] = content
+    return content
+
+
+# --- Compresión ---
+
+def _dictionary(dict_id, connection=None):
+    entry = _dicts.get(dict_id)
+    if entry is None:
+        row = (connection or db.session).execute(
+            select(CompressionDict.codec, CompressionDict.data).where(CompressionDict.id == dict_id)
+        ).one()
+        entry = (row.codec, bytes(row.data))
+        with _cache_lock:
+            _dicts[dict_id] = entry
+    return entry[1]
+
+
+def compress(content, codec, dict_data=None, level=None):
+    raw = content.encode("utf-8")
+    if codec == CODEC_ZSTD:
+        kwargs = {"level": level or 9}
+        if dict_data:
+            kwargs["dict_data"] = zstandard.ZstdCompressionDict(dict_data)
+        return zstandard.ZstdCompressor(**kwargs).compress(raw)
+    compressor = zlib.compressobj(level or 9, zlib.DEFLATED, 15, 9, zlib.Z_DEFAULT_STRATEGY,
+                                  *([dict_data] if dict_data else []))
+    return compressor.compress(raw) + compressor.flush()
+
+
+def decompress(blob, codec, dict_data=None):
+    blob = bytes(blob)
+    if codec == CODEC_ZSTD:
+        if zstandard is None:
+            raise RuntimeError("Mensaje archivado con zstd pero el paquete zstandard no está instalado")
+        kwargs = {"dict_data": zstandard.ZstdCompressionDict(dict_data)} if dict_data else {}
+        return zstandard.ZstdDecompressor(**kwargs).decompress(blob).decode("utf-8")
+    decompressor = zlib.decompressobj(zdict=dict_data) if dict_data else zlib.decompressobj()
+    return (decompressor.decompress(blob) + decompressor.flush()).decode("utf-8")
+
+
+def message_text(message):
+    """
+    Texto de un mensaje: objeto Message o fila con las columnas content,
+    system_prompt_id, content_archive, content_codec y archive_dict_id.
+    """
+    if message.system_prompt_id is not None:
+        return _prompt_text(message.system_prompt_id)
+    if message.content_archive is not None:
+        dict_data = _dictionary(message.archive_dict_id) if message.archive_dict_id else None
+        return decompress(message.content_archive, message.content_codec, dict_data)
+    return message.content
+
+
+# Columnas que necesita message_text() en consultas con with_entities/select
+TEXT_COLUMNS = (Message.content, Message.system_prompt_id, Message.content_archive,
+                Message.content_codec, Message.archive_dict_id)
+
+
+# --- Índice FTS5 (SQLite) ---
+
+_FTS_DELETE = text(
+    "INSERT INTO messages_fts(messages_fts, rowid, content) VALUES ('delete', :id, :content)"
+)
+_FTS_INSERT = text("INSERT INTO messages_fts(rowid, content) VALUES (:id, :content)")
+
+
+@event.listens_for(Message, "after_delete")
+def _forget_archived(mapper, connection, target):
+    # El trigger messages_fts_ad no puede descomprimir: la entrada de un
+    # archivado se borra aquí con su texto. Cubre los borrados del ORM (p. ej.
+    # la cascada al borrar una conversación), no un DELETE en SQL directo.
+    if target.content_archive is None or connection.dialect.name != "sqlite":
+        return
+    dict_data = _dictionary(target.archive_dict_id, connection) if target.archive_dict_id else None
+    connection.execute(_FTS_DELETE, {
+        "id": target.id,
+        "content": decompress(target.content_archive, target.content_codec, dict_data),
+    })
+
+
+def rebuild_search_index(batch_size=500):
+    """
+    'rebuild' de messages_fts que conserva los archivados: el rebuild indexa
+    `content`, vacío en ellos, así que después se añade su texto. Devuelve
+    los archivados reindexados (None fuera de SQLite, donde no hay FTS5).
+    """
+    if db.engine.dialect.name != "sqlite":
+        return None
+    db.session.execute(text("INSERT INTO messages_fts(messages_fts) VALUES ('rebuild')"))
+    table = Message.__table__
+    reindexed = last_id = 0
+    while True:
+        rows = db.session.execute(
+            select(table.c.id, *TEXT_COLUMNS)
+            .where(table.c.content_archive.isnot(None), table.c.id > last_id)
+            .order_by(table.c.id)
+            .limit(batch_size)
+        ).all()
+        if not rows:
+            break
+        for row in rows:
+            db.session.execute(_FTS_DELETE, {"id": row.id, "content": ""})
+            db.session.execute(_FTS_INSERT, {"id": row.id, "content": message_text(row)})
+        reindexed += len(rows)
+        last_id = rows[-1].id
+    db.session.commit()
+    return reindexed
+
+
+# --- Archivador ---
+
+def latest_dictionary(codec):
+    row = db.session.execute(
+        select(CompressionDict.id, CompressionDict.data)
+        .where(CompressionDict.codec == codec)
+        .order_by(CompressionDict.id.desc())
+        .limit(1)
+    ).first()
+    return (row.id, bytes(row.data)) if row else (None, None)
+
+
+def train_dictionary(codec=None, samples=2000):
+    """Crea un diccionario a partir de mensajes recientes; devuelve su id (None sin muestras)."""
+    codec = codec or default_codec()
+    texts = db.session.execute(
+        select(Message.content)
+        .where(Message.role != RoleEnum.system, Message.content_archive.is_(None),
+               func.length(Message.content) > 0)
+        .order_by(Message.id.desc())
+        .limit(samples)
+    ).scalars().all()
+    if not texts:
+        return None
+    encoded = [t.encode("utf-8") for t in texts]
+    if codec == CODEC_ZSTD:
+        data = zstandard.train_dictionary(ZSTD_DICT_SIZE, encoded).as_bytes()
+    else:
+        # zlib: un "diccionario" es texto de ejemplo; lo más frecuente, al final
+        data = b"\n".join(encoded)[-ZLIB_DICT_SIZE:]
+    table = CompressionDict.__table__
+    dict_id = db.session.execute(
+        table.insert().returning(table.c.id),
+        {"codec": codec, "data": data, "created_at": datetime.utcnow()},
+    ).scalar_one()
+    db.session.commit()
+    return dict_id
+
+
+class Archiver:
+    def __init__(self, after_days=30, min_chars=256, batch_size=500, codec=None, level=None):
+        self.after_days = after_days
+        self.min_chars = min_chars
+        self.batch_size = batch_size
+        self.codec = codec or default_codec()
+        self.level = level
+        if self.codec == CODEC_ZSTD and zstandard is None:
+            raise RuntimeError("ARCHIVE_CODEC=zstd requiere el paquete zstandard")
+
+    def archive_once(self, after_id=0):
+        """
+        Archiva un lote de ids mayores que `after_id`. Devuelve (filas
+        revisadas, último id, archivadas, bytes antes, bytes después).
+        """
+        dict_id, dict_data = latest_dictionary(self.codec)
+        cutoff = datetime.utcnow() - timedelta(days=self.after_days)
+        table = Message.__table__
+        rows = db.session.execute(
+            select(table.c.id, table.c.content)
+            .where(table.c.id > after_id,
+                   table.c.created_at < cutoff,
+                   table.c.content_archive.is_(None),
+                   table.c.system_prompt_id.is_(None),
+                   table.c.status != MessageStatusEnum.streaming,
+                   func.length(table.c.content) >= self.min_chars)
+            .order_by(table.c.id)
+            .limit(self.batch_size)
+            # Varios archivadores a la vez se reparten las filas
+            .with_for_update(skip_locked=True)
+        ).all()
+        if not rows:
+            db.session.rollback()
+            return 0, after_id, 0, 0, 0
+
+        before = after = 0
+        updates = []
+        for row in rows:
+            blob = compress(row.content, self.codec, dict_data, self.level)
+            raw = len(row.content.encode("utf-8"))
+            if len(blob) >= raw:
+                continue   # no compensa; se queda como está (el cursor lo salta)
+            before += raw
+            after += len(blob)
+            updates.append({"message_id": row.id, "blob": blob})
+        if updates:
+            db.session.execute(
+                table.update()
+                .where(table.c.id == bindparam("message_id"))
+                .values(content="", content_archive=bindparam("blob"),
+                        content_codec=self.codec, archive_dict_id=dict_id),
+                updates,
+            )
+        db.session.commit()
+        return len(rows), rows[-1].id, len(updates), before, after
+
+    def run(self, loop=False, interval=60.0):
+        """
+        Archiva hasta agotar lo pendiente; con `loop` sigue cada `interval` s.
+        Devuelve (mensajes archivados, bytes antes, bytes después).
+        """
+        archived = before = after = 0
+        while True:
+            last_id = 0
+            while True:
+                count, last_id, done, b, a = self.archive_once(last_id)
+                archived, before, after = archived + done, before + b, after + a
+                if count < self.batch_size:
+                    break
+            if not loop:
+                return archived, before, after
+            time.sleep(interval)
+
+
+def archive_stats():
+    """Tamaños para medir el efecto del archivo (y de las plantillas)."""
+    table = Message.__table__
+    row = db.session.execute(select(
+        func.count().label("messages"),
+        func.count(table.c.content_archive).label("archived"),
+        func.count(table.c.system_prompt_id).label("templated"),
+        func.coalesce(func.sum(func.length(table.c.content_archive)), 0).label("archive_bytes"),
+    )).one()
+    stats = dict(row._mapping)
+    if db.engine.dialect.name == "postgresql":
+        sizes = db.session.execute(text(
+            "SELECT pg_relation_size('messages') AS heap, "
+            "pg_total_relation_size('messages') - pg_relation_size('messages') "
+            "- pg_indexes_size('messages') AS toast, "
+            "pg_indexes_size('messages') AS indexes, "
+            "pg_total_relation_size('messages') AS total"
+        )).one()
+        stats.update(sizes._mapping)
+    return stats
+
+
+def read_latency(samples=200):
+    """Media y p95 (ms) de leer y descomprimir mensajes archivados al azar."""
+    table = Message.__table__
+    ids = db.session.execute(
+        select(table.c.id).where(table.c.content_archive.isnot(None))
+        .order_by(func.random()).limit(samples)
+    ).scalars().all()
+    timings = []
+    for message_id in ids:
+        start = time.perf_counter()
+        row = db.session.execute(select(*TEXT_COLUMNS).where(table.c.id == message_id)).one()
+        message_text(row)
+        timings.append((time.perf_counter() - start) * 1000)
+    if not timings:
+        return None
+    timings.sort()
+    return {"samples": len(timings), "mean_ms": sum(timings) / len(timings),
+            "p95_ms": timings[min(len(timings) - 1, int(len(timings) * 0.95))]}
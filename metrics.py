@@ -0,0 +1,202 @@
+# metrics.py
+"""
+Métricas Prometheus en /metrics, agregadas entre workers de gunicorn.
+
+Con PROMETHEUS_MULTIPROC_DIR definido (gunicorn_conf.py lo hace) cada worker
+escribe sus valores en ficheros mmap de ese directorio, y /metrics los suma
+al leer (MultiProcessCollector). Sin la variable, como en `flask run`,
+funciona en modo de un solo proceso.
+
+Anotar una métrica es actualizar un valor en memoria compartida, del orden
+de un microsegundo. En los streams no se toca nada por chunk: solo al abrir,
+con el primer token y al cerrar (vía stream_request, stream_delta y
+save_stream_answer, que comparten las vistas sync y el modo async).
+
+Sin `prometheus_client` instalado las métricas no hacen nada y /metrics
+responde 404.
+"""
+import os
+import time
+
+from flask import g, request
+from sqlalchemy.pool import QueuePool
+
+try:
+    import prometheus_client
+    from prometheus_client import multiprocess
+except ImportError:   # dependencia opcional
+    prometheus_client = None
+
+# Sobre todo llamadas a OpenAI: de decenas de ms a minutos
+LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+FAST_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+RATE_BUCKETS = (5, 10, 20, 40, 60, 80, 100, 150, 200, 300, 500)
+
+# Marca en el environ de las peticiones que async_app.py mide por su cuenta
+NATIVE_ASYNC_KEY = "epicode.metrics.native"
+
+
+class _Noop:
+    def labels(self, *args, **kwargs):
+        return self
+
+    def observe(self, *args):
+        pass
+
+    def inc(self, *args):
+        pass
+
+    def dec(self, *args):
+        pass
+
+
+def _metric(kind, name, doc, labels=(), **kwargs):
+    if prometheus_client is None:
+        return _Noop()
+    return getattr(prometheus_client, kind)(name, doc, labels, **kwargs)
+
+
+HTTP_LATENCY = _metric(
+    "Histogram", "epicode_http_request_duration_seconds",
+    "Duración de las peticiones HTTP (en streams, hasta las cabeceras)",
+    ("endpoint", "method", "status"), buckets=LATENCY_BUCKETS)
+UPSTREAM_LATENCY = _metric(
+    "Histogram", "epicode_upstream_request_seconds",
+    "Llamadas a OpenAI hasta la respuesta (en streams, hasta las cabeceras)",
+    ("model", "api", "stream"), buckets=LATENCY_BUCKETS)
+UPSTREAM_ERRORS = _metric(
+    "Counter", "epicode_upstream_errors_total",
+    "Llamadas a OpenAI fallidas (conexión, timeout o 5xx)", ("model",))
+FIRST_TOKEN = _metric(
+    "Histogram", "epicode_upstream_first_token_seconds",
+    "Tiempo hasta el primer token de un stream", ("model",), buckets=LATENCY_BUCKETS)
+STREAM_DURATION = _metric(
+    "Histogram", "epicode_stream_duration_seconds",
+    "Duración total de un stream", ("model", "status"), buckets=LATENCY_BUCKETS)
+STREAM_RATE = _metric(
+    "Histogram", "epicode_stream_tokens_per_second",
+    "Tokens de salida por segundo desde el primer token", ("model",), buckets=RATE_BUCKETS)
+STREAMS_IN_FLIGHT = _metric(
+    "Gauge", "epicode_streams_in_flight",
+    "Streams abiertos en este momento", multiprocess_mode="livesum")
+DB_CHECKOUT = _metric(
+    "Histogram", "epicode_db_pool_checkout_seconds",
+    "Espera para obtener una conexión del pool de la BD", buckets=FAST_BUCKETS)
+CACHE_REQUESTS = _metric(
+    "Counter", "epicode_cache_requests_total",
+    "Consultas a las cachés", ("cache", "result"))
+RATE_LIMIT = _metric(
+    "Counter", "epicode_rate_limit_total",
+    "Decisiones del rate limiter", ("model", "result"))
+
+
+# --- Anotaciones desde el código ---
+
+def cache_lookup(cache, hit):
+    CACHE_REQUESTS.labels(cache, "hit" if hit else "miss").inc()
+
+
+def rate_limit(model, allowed):
+    RATE_LIMIT.labels(model, "allowed" if allowed else "limited").inc()
+
+
+def upstream_call(model, api, stream, seconds):
+    UPSTREAM_LATENCY.labels(model, api, "true" if stream else "false").observe(seconds)
+
+
+def upstream_error(model):
+    UPSTREAM_ERRORS.labels(model).inc()
+
+
+def stream_started(job):
+    job.started = time.monotonic()
+    STREAMS_IN_FLIGHT.inc()
+
+
+def first_token(job):
+    job.first_token_at = time.monotonic()
+    FIRST_TOKEN.labels(job.model).observe(job.first_token_at - job.started)
+
+
+def stream_finished(job, output_tokens, status):
+    """Al guardar la respuesta; no hace nada si el stream no llegó a abrirse."""
+    if job.started is None:
+        return
+    now = time.monotonic()
+    STREAMS_IN_FLIGHT.dec()
+    STREAM_DURATION.labels(job.model, status).observe(now - job.started)
+    if job.first_token_at is not None and output_tokens and now > job.first_token_at:
+        STREAM_RATE.labels(job.model).observe(output_tokens / (now - job.first_token_at))
+    job.started = None
+
+
+def observe_request(endpoint, method, status, seconds):
+    HTTP_LATENCY.labels(endpoint or "unmatched", method, str(status)).observe(seconds)
+
+
+# --- Pool de la BD ---
+
+class TimedQueuePool(QueuePool):
+    """QueuePool que mide la espera de cada checkout (incluye abrir conexión)."""
+
+    # Mismo logger que QueuePool: si no, SQLAlchemy lo nombraría por esta clase,
+    # fuera del nivel WARN de "sqlalchemy", y con el logging en DEBUG de
+    # manage.py cada checkout escribiría varias líneas
+    _sqla_logger_namespace = "sqlalchemy.pool.impl.QueuePool"
+
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            DB_CHECKOUT.observe(time.perf_counter() - started)
+
+
+# --- Exposición ---
+
+def render():
+    """(cuerpo, content type) de /metrics, o None sin prometheus_client."""
+    if prometheus_client is None:
+        return None
+    if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        registry = prometheus_client.CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = prometheus_client.REGISTRY
+    return prometheus_client.generate_latest(registry), prometheus_client.CONTENT_TYPE_LATEST
+
+
+def mark_process_dead(pid):
+    """Para el hook child_exit de gunicorn: descarta los gauges del worker muerto."""
+    if prometheus_client is not None and os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        multiprocess.mark_process_dead(pid)
+
+
+def init_metrics(app):
+    """
+    Antes de db.init_app: el pool de la BD se crea con TimedQueuePool (salvo
+    SQLite en memoria, que necesita su propio pool).
+    """
+    if not app.config.get("METRICS_ENABLED", True) or prometheus_client is None:
+        app.extensions["metrics"] = False
+        return False
+    uri = app.config.get("SQLALCHEMY_DATABASE_URI") or ""
+    if not (uri.startswith("sqlite") and (":memory:" in uri or uri.rstrip("/") == "sqlite:")):
+        options = dict(app.config.get("SQLALCHEMY_ENGINE_OPTIONS") or {})
+        options.setdefault("poolclass", TimedQueuePool)
+        app.config["SQLALCHEMY_ENGINE_OPTIONS"] = options
+
+    @app.before_request
+    def _start_timer():
+        g.metrics_started = time.perf_counter()
+
+    @app.after_request
+    def _observe_request(response):
+        started = g.pop("metrics_started", None)
+        if started is not None and not request.environ.get(NATIVE_ASYNC_KEY):
+            observe_request(request.endpoint, request.method, response.status_code,
+                            time.perf_counter() - started)
+        return response
+
+    app.extensions["metrics"] = True
+    return True
@@ -0,0 +1,26 @@
+"""add tier to users
+
+Revision ID: 2f2c81fe6241
+Revises: 2eddf33a1f09
+Create Date: 2026-10-18 13:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '2f2c81fe6241'
+down_revision = '2eddf33a1f09'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('users', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('tier', sa.String(length=20), nullable=False, server_default='free'))
+
+
+def downgrade():
+    with op.batch_alter_table('users', schema=None) as batch_op:
+        batch_op.drop_column('tier')
@@ -0,0 +1,23 @@
+"""add (user_id, created_at, id) index on conversations
+
+Revision ID: 32ce7f5ac5d4
+Revises: 2f2c81fe6241
+Create Date: 2026-10-18 14:00:00.000000
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = '32ce7f5ac5d4'
+down_revision = '2f2c81fe6241'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index('ix_conversations_user_created', 'conversations', ['user_id', 'created_at', 'id'])
+
+
+def downgrade():
+    op.drop_index('ix_conversations_user_created', table_name='conversations')
@@ -0,0 +1,29 @@
+"""index auth lookups and hash reset tokens
+
+Revision ID: 4b8e1d6f2c90
+Revises: 9c4e2b7f1a63
+Create Date: 2026-10-18 18:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '4b8e1d6f2c90'
+down_revision = '9c4e2b7f1a63'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Los tokens pendientes estaban en claro y ya no coincidirían con su hash:
+    # se invalidan (el usuario pide otro enlace)
+    op.execute("UPDATE users SET reset_token = NULL, reset_token_expiration = NULL")
+    op.create_index('ix_users_reset_token', 'users', ['reset_token'], unique=False)
+    op.create_index('ix_users_email_lower', 'users', [sa.text('lower(email)')], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_users_email_lower', table_name='users')
+    op.drop_index('ix_users_reset_token', table_name='users')
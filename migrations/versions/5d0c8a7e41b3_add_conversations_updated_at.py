@@ -0,0 +1,27 @@
+"""add updated_at to conversations
+
+Revision ID: 5d0c8a7e41b3
+Revises: 32ce7f5ac5d4
+Create Date: 2026-10-18 15:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5d0c8a7e41b3'
+down_revision = '32ce7f5ac5d4'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('conversations', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('updated_at', sa.DateTime(), nullable=True))
+    op.execute("UPDATE conversations SET updated_at = created_at")
+
+
+def downgrade():
+    with op.batch_alter_table('conversations', schema=None) as batch_op:
+        batch_op.drop_column('updated_at')
@@ -0,0 +1,67 @@
+"""full-text search over messages
+
+PostgreSQL: generated tsvector column + GIN index (adding a STORED column
+rewrites the table; on a large table run it in a maintenance window).
+SQLite: external-content FTS5 table kept in sync by triggers. Note that
+`batch_alter_table` on messages recreates the table in SQLite and drops the
+triggers: later migrations that do so must recreate them.
+
+Revision ID: b1d4f8a26c37
+Revises: e3a7c2d95b18
+Create Date: 2026-10-18 20:00:00.000000
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = 'b1d4f8a26c37'
+down_revision = 'e3a7c2d95b18'
+branch_labels = None
+depends_on = None
+
+# Igual que search.TS_CONFIG
+TS_CONFIG = 'simple'
+
+SQLITE_TRIGGERS = (
+    """CREATE TRIGGER messages_fts_ai AFTER INSERT ON messages BEGIN
+        INSERT INTO messages_fts(rowid, content) VALUES (new.id, new.content);
+    END""",
+    """CREATE TRIGGER messages_fts_ad AFTER DELETE ON messages BEGIN
+        INSERT INTO messages_fts(messages_fts, rowid, content) VALUES ('delete', old.id, old.content);
+    END""",
+    """CREATE TRIGGER messages_fts_au AFTER UPDATE OF content ON messages BEGIN
+        INSERT INTO messages_fts(messages_fts, rowid, content) VALUES ('delete', old.id, old.content);
+        INSERT INTO messages_fts(rowid, content) VALUES (new.id, new.content);
+    END""",
+)
+
+
+def upgrade():
+    if op.get_bind().dialect.name == 'sqlite':
+        op.execute(
+            "CREATE VIRTUAL TABLE messages_fts USING fts5("
+            "content, content='messages', content_rowid='id', "
+            "tokenize='unicode61 remove_diacritics 2')"
+        )
+        for trigger in SQLITE_TRIGGERS:
+            op.execute(trigger)
+        op.execute("INSERT INTO messages_fts(messages_fts) VALUES ('rebuild')")
+        return
+
+    op.execute(
+        "ALTER TABLE messages ADD COLUMN search_vector tsvector "
+        f"GENERATED ALWAYS AS (to_tsvector('{TS_CONFIG}', content)) STORED"
+    )
+    op.execute("CREATE INDEX ix_messages_search_vector ON messages USING GIN (search_vector)")
+
+
+def downgrade():
+    if op.get_bind().dialect.name == 'sqlite':
+        for name in ('messages_fts_au', 'messages_fts_ad', 'messages_fts_ai'):
+            op.execute(f"DROP TRIGGER IF EXISTS {name}")
+        op.execute("DROP TABLE IF EXISTS messages_fts")
+        return
+
+    op.execute("DROP INDEX IF EXISTS ix_messages_search_vector")
+    op.execute("ALTER TABLE messages DROP COLUMN search_vector")
@@ -0,0 +1,27 @@
+"""add token_count to messages
+
+Revision ID: b262b33e6e99
+Revises: befa3e2c275f, add_reset_token_fields
+Create Date: 2026-10-18 10:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b262b33e6e99'
+down_revision = ('befa3e2c275f', 'add_reset_token_fields')
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Nullable: las filas existentes se cuentan al vuelo la primera vez que se usan
+    with op.batch_alter_table('messages', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('token_count', sa.Integer(), nullable=True))
+
+
+def downgrade():
+    with op.batch_alter_table('messages', schema=None) as batch_op:
+        batch_op.drop_column('token_count')
@@ -0,0 +1,55 @@
+"""add conversations.next_turn and unique (conversation_id, turn_index)
+
+Revision ID: b65053eca243
+Revises: b262b33e6e99
+Create Date: 2026-10-18 11:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b65053eca243'
+down_revision = 'b262b33e6e99'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # 1) renumerar turnos duplicados que hayan dejado carreras anteriores
+    op.execute("""
+        UPDATE messages SET turn_index = (
+            SELECT r.rn - 1 FROM (
+                SELECT m2.id, ROW_NUMBER() OVER (ORDER BY m2.turn_index, m2.id) AS rn
+                FROM messages m2
+                WHERE m2.conversation_id = messages.conversation_id
+            ) r WHERE r.id = messages.id
+        )
+        WHERE conversation_id IN (
+            SELECT conversation_id FROM messages
+            GROUP BY conversation_id, turn_index
+            HAVING COUNT(*) > 1
+        )
+    """)
+
+    # 2) índice único compuesto: sirve para ordenar por turno y evita colisiones
+    with op.batch_alter_table('messages', schema=None) as batch_op:
+        batch_op.create_unique_constraint('uq_messages_conversation_turn', ['conversation_id', 'turn_index'])
+
+    # 3) contador por conversación, inicializado con el siguiente turno libre
+    with op.batch_alter_table('conversations', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('next_turn', sa.Integer(), nullable=False, server_default='0'))
+    op.execute("""
+        UPDATE conversations SET next_turn = COALESCE(
+            (SELECT MAX(turn_index) + 1 FROM messages WHERE messages.conversation_id = conversations.id),
+            0
+        )
+    """)
+
+
+def downgrade():
+    with op.batch_alter_table('conversations', schema=None) as batch_op:
+        batch_op.drop_column('next_turn')
+    with op.batch_alter_table('messages', schema=None) as batch_op:
+        batch_op.drop_constraint('uq_messages_conversation_turn', type_='unique')
@@ -0,0 +1,215 @@
+"""shared system prompts and compressed message archive
+
+Adds system_prompts / compression_dicts, the archive columns on messages,
+and moves the existing system messages to shared templates.
+
+Search keeps working on archived messages (whose `content` is emptied):
+- PostgreSQL: search_vector stops being a generated column and is
+  maintained by a trigger that leaves it alone when a row is archived.
+- SQLite: the FTS5 triggers skip archiving updates, so the index keeps
+  the terms of archived messages.
+
+Revision ID: d6f2a9c41e75
+Revises: b1d4f8a26c37
+Create Date: 2026-10-18 21:00:00.000000
+
+"""
+import hashlib
+import zlib
+from datetime import datetime
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd6f2a9c41e75'
+down_revision = 'b1d4f8a26c37'
+branch_labels = None
+depends_on = None
+
+TS_CONFIG = 'simple'
+
+# Mensajes que se desarchivan por lote en el downgrade
+UNARCHIVE_BATCH = 500
+
+PG_SEARCH_TRIGGER = f"""
+CREATE OR REPLACE FUNCTION messages_search_vector_update() RETURNS trigger AS $$
+BEGIN
+    IF NEW.content_archive IS NULL THEN
+        NEW.search_vector := to_tsvector('{TS_CONFIG}', NEW.content);
+    END IF;
+    RETURN NEW;
+END
+$$ LANGUAGE plpgsql
+"""
+
+SQLITE_TRIGGERS = (
+    """CREATE TRIGGER messages_fts_ai AFTER INSERT ON messages BEGIN
+        INSERT INTO messages_fts(rowid, content) VALUES (new.id, new.content);
+    END""",
+    # Los mensajes archivados tienen content vacío: su entrada la borra
+    # message_archive (after_delete del ORM) con el texto descomprimido
+    """CREATE TRIGGER messages_fts_ad AFTER DELETE ON messages WHEN old.content_archive IS NULL BEGIN
+        INSERT INTO messages_fts(messages_fts, rowid, content) VALUES ('delete', old.id, old.content);
+    END""",
+    """CREATE TRIGGER messages_fts_au AFTER UPDATE OF content ON messages WHEN new.content_archive IS NULL BEGIN
+        INSERT INTO messages_fts(messages_fts, rowid, content) VALUES ('delete', old.id, old.content);
+        INSERT INTO messages_fts(rowid, content) VALUES (new.id, new.content);
+    END""",
+)
+
+
+def upgrade():
+    bind = op.get_bind()
+    dialect = bind.dialect.name
+
+    op.create_table(
+        'system_prompts',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('content', sa.Text(), nullable=False),
+        sa.Column('content_hash', sa.String(length=64), nullable=False),
+        sa.Column('created_at', sa.DateTime(), nullable=True),
+        sa.PrimaryKeyConstraint('id'),
+        sa.UniqueConstraint('content_hash'),
+    )
+    op.create_table(
+        'compression_dicts',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('codec', sa.String(length=8), nullable=False),
+        sa.Column('data', sa.LargeBinary(), nullable=False),
+        sa.Column('created_at', sa.DateTime(), nullable=True),
+        sa.PrimaryKeyConstraint('id'),
+    )
+    # ADD COLUMN simple (sin batch): en SQLite recrear la tabla borraría los triggers FTS
+    op.add_column('messages', sa.Column('system_prompt_id', sa.Integer(), nullable=True))
+    op.add_column('messages', sa.Column('content_archive', sa.LargeBinary(), nullable=True))
+    op.add_column('messages', sa.Column('content_codec', sa.String(length=8), nullable=True))
+    op.add_column('messages', sa.Column('archive_dict_id', sa.Integer(), nullable=True))
+    if dialect != 'sqlite':
+        op.create_foreign_key('fk_messages_system_prompt_id', 'messages', 'system_prompts',
+                              ['system_prompt_id'], ['id'])
+        op.create_foreign_key('fk_messages_archive_dict_id', 'messages', 'compression_dicts',
+                              ['archive_dict_id'], ['id'])
+
+    # Los prompts de sistema existentes pasan a plantillas compartidas
+    prompts = bind.execute(sa.text(
+        "SELECT DISTINCT content FROM messages WHERE role = 'system' AND content <> ''"
+    )).scalars().all()
+    for content in prompts:
+        prompt_id = bind.execute(
+            sa.text("INSERT INTO system_prompts (content, content_hash, created_at) "
+                    "VALUES (:content, :hash, :now) RETURNING id"),
+            {"content": content, "hash": hashlib.sha256(content.encode("utf-8")).hexdigest(),
+             "now": datetime.utcnow()},
+        ).scalar_one()
+        bind.execute(
+            sa.text("UPDATE messages SET system_prompt_id = :id, content = '' "
+                    "WHERE role = 'system' AND content = :content"),
+            {"id": prompt_id, "content": content},
+        )
+
+    if dialect == 'sqlite':
+        for name in ('messages_fts_au', 'messages_fts_ad', 'messages_fts_ai'):
+            op.execute(f"DROP TRIGGER IF EXISTS {name}")
+        for trigger in SQLITE_TRIGGERS:
+            op.execute(trigger)
+        return
+
+    # Conserva los valores ya calculados y pasa a mantenerse por trigger
+    op.execute("ALTER TABLE messages ALTER COLUMN search_vector DROP EXPRESSION")
+    op.execute(PG_SEARCH_TRIGGER)
+    op.execute(
+        "CREATE TRIGGER messages_search_vector BEFORE INSERT OR UPDATE OF content, content_archive "
+        "ON messages FOR EACH ROW EXECUTE FUNCTION messages_search_vector_update()"
+    )
+
+
+def _decompress(blob, codec, dict_data):
+    # Copia de message_archive.decompress: la migración no depende del código de la app
+    blob = bytes(blob)
+    if codec == 'zstd':
+        try:
+            import zstandard
+        except ImportError:
+            raise RuntimeError(
+                "Hay mensajes archivados con zstd: instala zstandard para poder desarchivarlos "
+                "antes de este downgrade"
+            )
+        kwargs = {"dict_data": zstandard.ZstdCompressionDict(bytes(dict_data))} if dict_data else {}
+        return zstandard.ZstdDecompressor(**kwargs).decompress(blob).decode("utf-8")
+    decompressor = zlib.decompressobj(zdict=bytes(dict_data)) if dict_data else zlib.decompressobj()
+    return (decompressor.decompress(blob) + decompressor.flush()).decode("utf-8")
+
+
+def _unarchive(bind):
+    """Devuelve a `content` el texto de los mensajes archivados."""
+    dicts = dict(bind.execute(sa.text("SELECT id, data FROM compression_dicts")).all())
+    last_id = 0
+    while True:
+        rows = bind.execute(sa.text(
+            "SELECT id, content_archive, content_codec, archive_dict_id FROM messages "
+            "WHERE content_archive IS NOT NULL AND id > :last ORDER BY id LIMIT :n"
+        ), {"last": last_id, "n": UNARCHIVE_BATCH}).all()
+        if not rows:
+            return
+        bind.execute(
+            sa.text("UPDATE messages SET content = :content, content_archive = NULL, "
+                    "content_codec = NULL, archive_dict_id = NULL WHERE id = :id"),
+            [{"id": r.id, "content": _decompress(r.content_archive, r.content_codec,
+                                                 dicts.get(r.archive_dict_id))}
+             for r in rows],
+        )
+        last_id = rows[-1].id
+
+
+def downgrade():
+    bind = op.get_bind()
+    dialect = bind.dialect.name
+
+    if dialect == 'sqlite':
+        # El índice FTS se reconstruye al final; mientras se restaura el texto, sin triggers
+        for name in ('messages_fts_au', 'messages_fts_ad', 'messages_fts_ai'):
+            op.execute(f"DROP TRIGGER IF EXISTS {name}")
+
+    # Devuelve el texto a `content`: el de los archivados y el de las plantillas
+    _unarchive(bind)
+    bind.execute(sa.text(
+        "UPDATE messages SET content = (SELECT content FROM system_prompts "
+        "WHERE system_prompts.id = messages.system_prompt_id) WHERE system_prompt_id IS NOT NULL"
+    ))
+
+    if dialect != 'sqlite':
+        op.execute("DROP TRIGGER IF EXISTS messages_search_vector ON messages")
+        op.execute("DROP FUNCTION IF EXISTS messages_search_vector_update()")
+        op.execute("ALTER TABLE messages DROP COLUMN search_vector")
+        op.execute(
+            f"ALTER TABLE messages ADD COLUMN search_vector tsvector "
+            f"GENERATED ALWAYS AS (to_tsvector('{TS_CONFIG}', content)) STORED"
+        )
+        op.execute("CREATE INDEX ix_messages_search_vector ON messages USING GIN (search_vector)")
+        op.drop_constraint('fk_messages_archive_dict_id', 'messages', type_='foreignkey')
+        op.drop_constraint('fk_messages_system_prompt_id', 'messages', type_='foreignkey')
+
+    with op.batch_alter_table('messages', schema=None) as batch_op:
+        batch_op.drop_column('archive_dict_id')
+        batch_op.drop_column('content_codec')
+        batch_op.drop_column('content_archive')
+        batch_op.drop_column('system_prompt_id')
+
+    if dialect == 'sqlite':
+        # batch_alter_table recrea la tabla en SQLite: los triggers se crean de nuevo
+        op.execute("""CREATE TRIGGER messages_fts_ai AFTER INSERT ON messages BEGIN
+            INSERT INTO messages_fts(rowid, content) VALUES (new.id, new.content);
+        END""")
+        op.execute("""CREATE TRIGGER messages_fts_ad AFTER DELETE ON messages BEGIN
+            INSERT INTO messages_fts(messages_fts, rowid, content) VALUES ('delete', old.id, old.content);
+        END""")
+        op.execute("""CREATE TRIGGER messages_fts_au AFTER UPDATE OF content ON messages BEGIN
+            INSERT INTO messages_fts(messages_fts, rowid, content) VALUES ('delete', old.id, old.content);
+            INSERT INTO messages_fts(rowid, content) VALUES (new.id, new.content);
+        END""")
+        op.execute("INSERT INTO messages_fts(messages_fts) VALUES ('rebuild')")
+
+    op.drop_table('compression_dicts')
+    op.drop_table('system_prompts')
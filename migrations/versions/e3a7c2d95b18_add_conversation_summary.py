@@ -0,0 +1,28 @@
+"""add rolling summary to conversations
+
+Revision ID: e3a7c2d95b18
+Revises: 4b8e1d6f2c90
+Create Date: 2026-10-18 19:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e3a7c2d95b18'
+down_revision = '4b8e1d6f2c90'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('conversations', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('summary', sa.Text(), nullable=True))
+        batch_op.add_column(sa.Column('summary_turn', sa.Integer(), nullable=True))
+
+
+def downgrade():
+    with op.batch_alter_table('conversations', schema=None) as batch_op:
+        batch_op.drop_column('summary_turn')
+        batch_op.drop_column('summary')
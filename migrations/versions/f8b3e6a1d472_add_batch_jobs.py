@@ -0,0 +1,64 @@
+"""add batch jobs
+
+Revision ID: f8b3e6a1d472
+Revises: d6f2a9c41e75
+Create Date: 2026-10-18 22:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f8b3e6a1d472'
+down_revision = 'd6f2a9c41e75'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'batch_jobs',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('user_id', sa.Integer(), nullable=False),
+        sa.Column('model', sa.String(length=80), nullable=False),
+        sa.Column('status', sa.String(length=16), nullable=False, server_default='pending'),
+        sa.Column('openai_batch_id', sa.String(length=64), nullable=True),
+        sa.Column('input_file_id', sa.String(length=64), nullable=True),
+        sa.Column('total', sa.Integer(), nullable=False),
+        sa.Column('completed', sa.Integer(), nullable=False, server_default='0'),
+        sa.Column('failed', sa.Integer(), nullable=False, server_default='0'),
+        sa.Column('cancel_requested', sa.Boolean(), nullable=False, server_default=sa.false()),
+        sa.Column('error', sa.Text(), nullable=True),
+        sa.Column('next_poll_at', sa.DateTime(), nullable=False),
+        sa.Column('created_at', sa.DateTime(), nullable=True),
+        sa.Column('submitted_at', sa.DateTime(), nullable=True),
+        sa.Column('finished_at', sa.DateTime(), nullable=True),
+        sa.ForeignKeyConstraint(['user_id'], ['users.id'], ondelete='CASCADE'),
+        sa.PrimaryKeyConstraint('id'),
+    )
+    op.create_index('ix_batch_jobs_user_id', 'batch_jobs', ['user_id', 'id'], unique=False)
+    op.create_index('ix_batch_jobs_status_next', 'batch_jobs', ['status', 'next_poll_at'], unique=False)
+    op.create_table(
+        'batch_items',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('job_id', sa.Integer(), nullable=False),
+        sa.Column('idx', sa.Integer(), nullable=False),
+        sa.Column('request', sa.Text(), nullable=False),
+        sa.Column('status', sa.String(length=16), nullable=False, server_default='pending'),
+        sa.Column('answer', sa.Text(), nullable=True),
+        sa.Column('error', sa.Text(), nullable=True),
+        sa.Column('input_tokens', sa.Integer(), nullable=True),
+        sa.Column('cached_input_tokens', sa.Integer(), nullable=True),
+        sa.Column('output_tokens', sa.Integer(), nullable=True),
+        sa.ForeignKeyConstraint(['job_id'], ['batch_jobs.id'], ondelete='CASCADE'),
+        sa.PrimaryKeyConstraint('id'),
+        sa.UniqueConstraint('job_id', 'idx', name='uq_batch_items_job_idx'),
+    )
+
+
+def downgrade():
+    op.drop_table('batch_items')
+    op.drop_index('ix_batch_jobs_status_next', table_name='batch_jobs')
+    op.drop_index('ix_batch_jobs_user_id', table_name='batch_jobs')
+    op.drop_table('batch_jobs')
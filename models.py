@@ -1,9 +1,12 @@
 # models.py
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import DDL, event, func
 from datetime import datetime
 import enum
+import hashlib
 from flask_login import UserMixin
 from werkzeug.security import generate_password_hash, check_password_hash
+from config.tokenizer import count_text
 
 # Define db here, but don't initialize it yet
 db = SQLAlchemy()
@@ -13,6 +16,11 @@ class RoleEnum(enum.Enum):
     user = "user"
     assistant = "assistant"
 
+class MessageStatusEnum(enum.Enum):
+    streaming = "streaming"      # respuesta en curso (texto parcial por checkpoints)
+    complete = "complete"
+    interrupted = "interrupted"  # error o desconexión antes de terminar
+
 class User(db.Model, UserMixin):
     __tablename__ = "users"
     id = db.Column(db.Integer, primary_key=True)
@@ -22,7 +30,10 @@ class User(db.Model, UserMixin):
     conversations = db.relationship("Conversation", back_populates="user", cascade="all, delete-orphan")
     is_approved = db.Column(db.Boolean, default=False)
     is_admin = db.Column(db.Boolean, default=False)
-    reset_token = db.Column(db.String(256), nullable=True)
+    # Tier de rate_limits_tpm (allowed_models.json) que se aplica al usuario
+    tier = db.Column(db.String(20), nullable=False, default="free", server_default="free")
+    # SHA-256 del token enviado por correo; el token en claro no se guarda
+    reset_token = db.Column(db.String(256), nullable=True, index=True)
     reset_token_expiration = db.Column(db.DateTime, nullable=True)
 
     def set_password(self, password):
@@ -31,27 +42,240 @@ class User(db.Model, UserMixin):
     def check_password(self, password):
         return check_password_hash(self.password_hash, password)
 
+    @staticmethod
+    def hash_reset_token(token):
+        return hashlib.sha256(token.encode("utf-8")).hexdigest()
+
+    @classmethod
+    def find_by_login(cls, username_or_email):
+        """Usuario por nombre exacto o por email (sin distinguir mayúsculas)."""
+        return cls.query.filter(
+            (cls.username == username_or_email)
+            | (func.lower(cls.email) == username_or_email.lower())
+        ).first()
+
+# Login y restablecimiento buscan el email sin distinguir mayúsculas
+db.Index("ix_users_email_lower", func.lower(User.email))
+
 class Conversation(db.Model):
     __tablename__ = "conversations"
+    __table_args__ = (
+        db.Index("ix_conversations_user_created", "user_id", "created_at", "id"),
+    )
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey("users.id", ondelete="CASCADE"), nullable=False)
     title = db.Column(db.String, default="Sin título")
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    # Siguiente turn_index libre; se avanza con un UPDATE atómico (allocate_turns)
+    next_turn = db.Column(db.Integer, nullable=False, default=0, server_default="0")
+    # Última modificación de la conversación o de sus mensajes (forma parte del ETag)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    # Resumen incremental de los turnos antiguos (summarizer.py): cubre los
+    # mensajes con turn_index <= summary_turn, que ya no se envían al modelo
+    summary = db.Column(db.Text, nullable=True)
+    summary_turn = db.Column(db.Integer, nullable=True)
     user = db.relationship("User", back_populates="conversations")
     messages = db.relationship(
         "Message", back_populates="conversation",
         cascade="all, delete-orphan", order_by="Message.turn_index"
     )
 
+    @staticmethod
+    def allocate_turns(conv_id, count=1):
+        """
+        Reserva `count` turnos consecutivos para la conversación y devuelve el
+        primero. Es un único UPDATE ... RETURNING sobre la fila de la
+        conversación, así que dos peticiones concurrentes nunca obtienen el
+        mismo turn_index (la segunda espera al commit de la primera).
+        """
+        table = Conversation.__table__
+        stmt = table.update()\
+            .where(table.c.id == conv_id)\
+            .values(next_turn=table.c.next_turn + count, updated_at=datetime.utcnow())\
+            .returning(table.c.next_turn)
+        new_next = db.session.execute(stmt).scalar_one()
+        return new_next - count
+
+    @staticmethod
+    def touch(conv_id):
+        """Marca la conversación como modificada (p. ej. al guardar una respuesta)."""
+        table = Conversation.__table__
+        db.session.execute(
+            table.update().where(table.c.id == conv_id).values(updated_at=datetime.utcnow())
+        )
+
+class SystemPrompt(db.Model):
+    """Texto de sistema compartido: los mensajes de sistema lo referencian en lugar de copiarlo."""
+    __tablename__ = "system_prompts"
+    id = db.Column(db.Integer, primary_key=True)
+    content = db.Column(db.Text, nullable=False)
+    # SHA-256 del contenido, para deduplicar
+    content_hash = db.Column(db.String(64), nullable=False, unique=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+
+class CompressionDict(db.Model):
+    """Diccionario compartido del archivador; inmutable una vez creado."""
+    __tablename__ = "compression_dicts"
+    id = db.Column(db.Integer, primary_key=True)
+    codec = db.Column(db.String(8), nullable=False)
+    data = db.Column(db.LargeBinary, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+
 class Message(db.Model):
     __tablename__ = "messages"
+    __table_args__ = (
+        db.UniqueConstraint("conversation_id", "turn_index", name="uq_messages_conversation_turn"),
+    )
     id = db.Column(db.Integer, primary_key=True)
     conversation_id = db.Column(
         db.Integer, db.ForeignKey("conversations.id", ondelete="CASCADE"),
         nullable=False
     )
     role = db.Column(db.Enum(RoleEnum), nullable=False)
+    # Vacío si el texto está en una plantilla (system_prompt_id) o archivado
+    # (content_archive); para leerlo usar message_archive.message_text()
     content = db.Column(db.Text, nullable=False)
+    system_prompt_id = db.Column(db.Integer, db.ForeignKey("system_prompts.id"), nullable=True)
+    # Texto comprimido por el archivador (zstd o zlib, con diccionario opcional)
+    content_archive = db.Column(db.LargeBinary, nullable=True)
+    content_codec = db.Column(db.String(8), nullable=True)
+    archive_dict_id = db.Column(db.Integer, db.ForeignKey("compression_dicts.id"), nullable=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     turn_index = db.Column(db.Integer, nullable=False)
+    # Tokens de `content`, calculados al escribir para no re-tokenizar el historial
+    token_count = db.Column(db.Integer, nullable=True)
+    # Guardado como texto (VARCHAR) para poder añadir estados sin tocar tipos de la BD
+    status = db.Column(
+        db.Enum(MessageStatusEnum, native_enum=False, length=16),
+        nullable=False, default=MessageStatusEnum.complete, server_default="complete"
+    )
     conversation = db.relationship("Conversation", back_populates="messages")
+
+
+# Búsqueda en SQLite (search.py): tabla FTS5 de contenido externo y sus
+# triggers. Las BD migradas las reciben de b1d4f8a26c37 (triggers según
+# d6f2a9c41e75); con db.create_all() (TestingConfig) se crean aquí junto con
+# `messages`.
+MESSAGES_FTS_DDL = (
+    "CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5("
+    "content, content='messages', content_rowid='id', "
+    "tokenize='unicode61 remove_diacritics 2')",
+    """CREATE TRIGGER IF NOT EXISTS messages_fts_ai AFTER INSERT ON messages BEGIN
+        INSERT INTO messages_fts(rowid, content) VALUES (new.id, new.content);
+    END""",
+    # Los mensajes archivados tienen content vacío: su entrada la borra
+    # message_archive (after_delete del ORM) con el texto descomprimido
+    """CREATE TRIGGER IF NOT EXISTS messages_fts_ad AFTER DELETE ON messages WHEN old.content_archive IS NULL BEGIN
+        INSERT INTO messages_fts(messages_fts, rowid, content) VALUES ('delete', old.id, old.content);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS messages_fts_au AFTER UPDATE OF content ON messages WHEN new.content_archive IS NULL BEGIN
+        INSERT INTO messages_fts(messages_fts, rowid, content) VALUES ('delete', old.id, old.content);
+        INSERT INTO messages_fts(rowid, content) VALUES (new.id, new.content);
+    END""",
+)
+for _statement in MESSAGES_FTS_DDL:
+    event.listen(Message.__table__, "after_create", DDL(_statement).execute_if(dialect="sqlite"))
+event.listen(Message.__table__, "before_drop",
+             DDL("DROP TABLE IF EXISTS messages_fts").execute_if(dialect="sqlite"))
+
+
+@event.listens_for(Message, "before_insert")
+def _fill_token_count(mapper, connection, target):
+    if target.token_count is None:
+        target.token_count = count_text(target.content)
+
+
+class UsageRecord(db.Model):
+    """Consumo de una llamada a OpenAI (una por mensaje o petición a /api/ask)."""
+    __tablename__ = "usage_records"
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey("users.id", ondelete="CASCADE"), nullable=False, index=True)
+    message_id = db.Column(db.Integer, db.ForeignKey("messages.id", ondelete="SET NULL"), nullable=True)
+    model = db.Column(db.String(80), nullable=False)
+    input_tokens = db.Column(db.Integer, nullable=False, default=0)
+    cached_input_tokens = db.Column(db.Integer, nullable=False, default=0)
+    output_tokens = db.Column(db.Integer, nullable=False, default=0)
+    cost_usd = db.Column(db.Float, nullable=False, default=0.0)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+
+class UsageDaily(db.Model):
+    """Acumulado diario por usuario y modelo; model="*" es el total del usuario."""
+    __tablename__ = "usage_daily"
+    user_id = db.Column(db.Integer, db.ForeignKey("users.id", ondelete="CASCADE"), primary_key=True)
+    model = db.Column(db.String(80), primary_key=True)
+    day = db.Column(db.Date, primary_key=True)
+    requests = db.Column(db.Integer, nullable=False, default=0)
+    input_tokens = db.Column(db.Integer, nullable=False, default=0)
+    cached_input_tokens = db.Column(db.Integer, nullable=False, default=0)
+    output_tokens = db.Column(db.Integer, nullable=False, default=0)
+    cost_usd = db.Column(db.Float, nullable=False, default=0.0)
+
+
+class OutboxEmail(db.Model):
+    """Correo pendiente de envío; lo vacía en segundo plano `mail_outbox.MailOutbox`."""
+    __tablename__ = "outbox_emails"
+    __table_args__ = (
+        db.Index("ix_outbox_emails_status_next", "status", "next_attempt_at"),
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    recipient = db.Column(db.String(255), nullable=False)
+    subject = db.Column(db.String(255), nullable=False)
+    body = db.Column(db.Text, nullable=False)
+    # pending -> sent | failed
+    status = db.Column(db.String(16), nullable=False, default="pending", server_default="pending")
+    attempts = db.Column(db.Integer, nullable=False, default=0, server_default="0")
+    # Próximo intento; al reclamarlo se adelanta un "lease" por si el worker muere enviando
+    next_attempt_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    last_error = db.Column(db.Text, nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    sent_at = db.Column(db.DateTime, nullable=True)
+
+
+class BatchJob(db.Model):
+    """Lote de prompts enviado a la Batch API de OpenAI (ver batch_jobs.py)."""
+    __tablename__ = "batch_jobs"
+    __table_args__ = (
+        db.Index("ix_batch_jobs_user_id", "user_id", "id"),
+        db.Index("ix_batch_jobs_status_next", "status", "next_poll_at"),
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey("users.id", ondelete="CASCADE"), nullable=False)
+    model = db.Column(db.String(80), nullable=False)
+    # pending -> submitted -> completed | failed | expired | cancelled (ver batch_jobs)
+    status = db.Column(db.String(16), nullable=False, default="pending", server_default="pending")
+    openai_batch_id = db.Column(db.String(64), nullable=True)
+    input_file_id = db.Column(db.String(64), nullable=True)
+    total = db.Column(db.Integer, nullable=False, default=0)
+    completed = db.Column(db.Integer, nullable=False, default=0, server_default="0")
+    failed = db.Column(db.Integer, nullable=False, default=0, server_default="0")
+    cancel_requested = db.Column(db.Boolean, nullable=False, default=False, server_default=db.false())
+    error = db.Column(db.Text, nullable=True)
+    # Próxima vez que el runner lo mira; al reclamarlo se adelanta un "lease"
+    next_poll_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    submitted_at = db.Column(db.DateTime, nullable=True)
+    finished_at = db.Column(db.DateTime, nullable=True)
+
+
+class BatchItem(db.Model):
+    """Un prompt de un BatchJob y su resultado."""
+    __tablename__ = "batch_items"
+    __table_args__ = (
+        db.UniqueConstraint("job_id", "idx", name="uq_batch_items_job_idx"),
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    job_id = db.Column(db.Integer, db.ForeignKey("batch_jobs.id", ondelete="CASCADE"), nullable=False)
+    # Posición en el lote (orden de los prompts enviados)
+    idx = db.Column(db.Integer, nullable=False)
+    # JSON con el `input` de la Responses API
+    request = db.Column(db.Text, nullable=False)
+    # pending -> completed | failed
+    status = db.Column(db.String(16), nullable=False, default="pending", server_default="pending")
+    answer = db.Column(db.Text, nullable=True)
+    error = db.Column(db.Text, nullable=True)
+    input_tokens = db.Column(db.Integer, nullable=True)
+    cached_input_tokens = db.Column(db.Integer, nullable=True)
+    output_tokens = db.Column(db.Integer, nullable=True)
@@ -0,0 +1,31 @@
+# pagination.py
+"""Utilidades para paginación por cursor (keyset) en los endpoints JSON."""
+import base64
+import json
+
+
+def encode_cursor(*values):
+    """Cursor opaco a partir de los valores de la última fila devuelta."""
+    raw = json.dumps(values, separators=(",", ":"), default=str).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor):
+    """Valores del cursor, o None si no es válido."""
+    if not cursor:
+        return None
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        values = json.loads(raw)
+    except (ValueError, TypeError):
+        return None
+    return values if isinstance(values, list) else None
+
+
+def page_limit(value, default, maximum):
+    """Tamaño de página pedido por el cliente, acotado a [1, maximum]."""
+    try:
+        limit = int(value)
+    except (TypeError, ValueError):
+        return default
+    return max(1, min(limit, maximum))
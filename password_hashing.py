@@ -0,0 +1,73 @@
+# password_hashing.py
+"""
+Verificación de contraseñas fuera del hilo de la petición.
+
+Hashear una contraseña (scrypt/pbkdf2) cuesta decenas de milisegundos de CPU.
+Una ráfaga de logins que lo hiciera en los hilos de petición dejaría sin CPU
+al tráfico del chat. Aquí todo el hashing del proceso pasa por un pool de
+AUTH_HASH_WORKERS hilos. hashlib suelta el GIL mientras calcula, así que el
+pool limita los núcleos dedicados al hashing. Si ya hay
+AUTH_HASH_MAX_PENDING verificaciones en cola, se rechaza al momento con
+`HasherBusy` en lugar de encolar sin límite.
+
+Un login con un usuario inexistente verifica contra un hash ficticio del
+mismo método. Cuesta lo mismo que uno con contraseña incorrecta, así que el
+tiempo de respuesta no revela qué usuarios existen.
+"""
+import secrets
+import threading
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+
+from werkzeug.security import check_password_hash, generate_password_hash
+
+
+class HasherBusy(Exception):
+    """Demasiadas verificaciones en cola: se pide al cliente que reintente."""
+
+
+class PasswordHasher:
+    def __init__(self, workers=2, max_pending=32, timeout=10.0):
+        self.timeout = timeout
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="password-hash")
+        self._slots = threading.BoundedSemaphore(max_pending)
+        # Se genera al arrancar: si se hiciera en el primer login con usuario
+        # inexistente, esa respuesta tardaría el doble y delataría el caso
+        self._dummy_hash = generate_password_hash(secrets.token_urlsafe(16))
+
+    def _submit(self, fn, *args):
+        if not self._slots.acquire(blocking=False):
+            raise HasherBusy()
+        try:
+            future = self._executor.submit(fn, *args)
+        except BaseException:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+        try:
+            return future.result(self.timeout)
+        except FutureTimeout:
+            future.cancel()
+            raise HasherBusy()
+
+    def _verify(self, pwhash, password):
+        if pwhash is None:
+            check_password_hash(self._dummy_hash, password)
+            return False
+        return check_password_hash(pwhash, password)
+
+    def verify(self, user, password):
+        """True si `password` es la del usuario; con `user=None` cuesta lo mismo y da False."""
+        return self._submit(self._verify, user.password_hash if user is not None else None, password)
+
+    def hash(self, password):
+        return self._submit(generate_password_hash, password)
+
+
+def init_password_hashing(app):
+    hasher = PasswordHasher(
+        workers=app.config.get("AUTH_HASH_WORKERS", 2),
+        max_pending=app.config.get("AUTH_HASH_MAX_PENDING", 32),
+        timeout=app.config.get("AUTH_HASH_TIMEOUT", 10),
+    )
+    app.extensions["password_hasher"] = hasher
+    return hasher
@@ -0,0 +1,209 @@
+# response_cache.py
+"""
+Caché de respuestas para el endpoint sin estado /api/ask.
+
+La clave es un hash del modelo, los mensajes normalizados y los parámetros de
+generación, así que dos peticiones idénticas comparten respuesta. Es opt-in
+(RESPONSE_CACHE_BACKEND) y cada petición puede saltársela con
+`"cache": false` en el cuerpo o la cabecera `Cache-Control: no-cache`.
+
+Backends:
+  - "memory": LRU + TTL en el propio proceso.
+  - "sqlite": fichero local compartido por todos los workers (local_store).
+"""
+import hashlib
+import json
+import logging
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from local_store import LocalStore
+
+logger = logging.getLogger(__name__)
+
+
+def _normalize_content(content):
+    if isinstance(content, str):
+        return "\n".join(line.rstrip() for line in content.strip().splitlines())
+    return content
+
+
+def cache_key(params):
+    """
+    Clave estable para unos parámetros de responses.create: modelo, mensajes
+    normalizados (espacios finales, saltos de línea) y el resto de opciones.
+    """
+    normalized = dict(params)
+    normalized["input"] = [
+        {"role": m.get("role"), "content": _normalize_content(m.get("content"))}
+        for m in params.get("input", [])
+    ]
+    raw = json.dumps(normalized, sort_keys=True, ensure_ascii=False, separators=(",", ":"))
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+class MemoryBackend:
+    """LRU + TTL en memoria, acotado por número de entradas y bytes."""
+
+    def __init__(self, max_entries, max_bytes):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._data = OrderedDict()  # key -> (expires_at, value)
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            if item[0] < time.time():
+                self._remove(key)
+                return None
+            self._data.move_to_end(key)
+            return item[1]
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            if key in self._data:
+                self._remove(key)
+            self._data[key] = (time.time() + ttl, value)
+            self._bytes += len(value)
+            while self._data and (len(self._data) > self.max_entries or self._bytes > self.max_bytes):
+                self._remove(next(iter(self._data)))
+
+    def delete(self, key):
+        with self._lock:
+            if key in self._data:
+                self._remove(key)
+
+    def _remove(self, key):
+        _, value = self._data.pop(key)
+        self._bytes -= len(value)
+
+
+class SQLiteBackend:
+    """LRU + TTL en un fichero SQLite (WAL) compartido por los workers."""
+
+    SCHEMA = (
+        """CREATE TABLE IF NOT EXISTS response_cache (
+            key TEXT PRIMARY KEY,
+            value BLOB NOT NULL,
+            size INTEGER NOT NULL,
+            expires_at REAL NOT NULL,
+            last_access REAL NOT NULL
+        )""",
+        "CREATE INDEX IF NOT EXISTS ix_response_cache_last_access ON response_cache (last_access)",
+    )
+    # La limpieza de expirados/excedentes se hace cada N escrituras
+    EVICT_EVERY = 32
+
+    def __init__(self, path, max_entries, max_bytes):
+        self.store = LocalStore(path, self.SCHEMA)
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._writes = 0
+
+    def get(self, key):
+        now = time.time()
+        row = self.store.execute(
+            "SELECT value FROM response_cache WHERE key = ? AND expires_at > ?", (key, now)
+        ).fetchone()
+        if row is None:
+            return None
+        self.store.execute("UPDATE response_cache SET last_access = ? WHERE key = ?", (now, key))
+        return row[0]
+
+    def set(self, key, value, ttl):
+        now = time.time()
+        self.store.execute(
+            "INSERT OR REPLACE INTO response_cache (key, value, size, expires_at, last_access) "
+            "VALUES (?, ?, ?, ?, ?)",
+            (key, value, len(value), now + ttl, now),
+        )
+        self._writes += 1
+        if self._writes % self.EVICT_EVERY == 0:
+            self.evict()
+
+    def delete(self, key):
+        self.store.execute("DELETE FROM response_cache WHERE key = ?", (key,))
+
+    def evict(self):
+        with self.store.transaction() as conn:
+            conn.execute("DELETE FROM response_cache WHERE expires_at <= ?", (time.time(),))
+            count, total = conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM response_cache"
+            ).fetchone()
+            excess = count - self.max_entries
+            if excess > 0:
+                conn.execute(
+                    "DELETE FROM response_cache WHERE key IN "
+                    "(SELECT key FROM response_cache ORDER BY last_access LIMIT ?)", (excess,)
+                )
+                total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM response_cache").fetchone()[0]
+            while total > self.max_bytes:
+                oldest = conn.execute(
+                    "SELECT key, size FROM response_cache ORDER BY last_access LIMIT 64"
+                ).fetchall()
+                if not oldest:
+                    break
+                for key, size in oldest:
+                    conn.execute("DELETE FROM response_cache WHERE key = ?", (key,))
+                    total -= size
+                    if total <= self.max_bytes:
+                        break
+
+
+class ResponseCache:
+    def __init__(self, backend, ttl):
+        self.backend = backend
+        self.ttl = ttl
+
+    # Un fallo de la caché nunca debe tumbar la petición: se registra y se sigue
+    def get(self, key):
+        try:
+            value = self.backend.get(key)
+        except sqlite3.Error as e:
+            logger.warning(f"Response cache read failed: {e}")
+            return None
+        return json.loads(value) if value is not None else None
+
+    def set(self, key, result):
+        value = json.dumps(result, ensure_ascii=False).encode("utf-8")
+        try:
+            self.backend.set(key, value, self.ttl)
+        except sqlite3.Error as e:
+            logger.warning(f"Response cache write failed: {e}")
+
+    def delete(self, key):
+        try:
+            self.backend.delete(key)
+        except sqlite3.Error as e:
+            logger.warning(f"Response cache delete failed: {e}")
+
+
+def build_cache(kind, path, ttl, max_entries, max_bytes):
+    """Crea una caché JSON con el backend indicado, o None si está desactivada."""
+    kind = (kind or "").lower()
+    if kind == "memory":
+        backend = MemoryBackend(max_entries, max_bytes)
+    elif kind == "sqlite":
+        backend = SQLiteBackend(path, max_entries, max_bytes)
+    else:
+        return None
+    return ResponseCache(backend, ttl)
+
+
+def init_response_cache(app):
+    """Crea la caché según la configuración y la deja en app.extensions."""
+    cache = build_cache(
+        app.config.get("RESPONSE_CACHE_BACKEND"),
+        app.config.get("RESPONSE_CACHE_PATH"),
+        app.config.get("RESPONSE_CACHE_TTL", 3600),
+        app.config.get("RESPONSE_CACHE_MAX_ENTRIES", 1000),
+        app.config.get("RESPONSE_CACHE_MAX_BYTES", 64 * 1024 * 1024),
+    )
+    app.extensions["response_cache"] = cache
+    return cache
@@ -1,262 +1,946 @@
 import os
+import hashlib
+import hmac
+import math
+import threading
+import time
+from datetime import datetime
 import openai                                    # para capturar openai.BadRequestError
 from flask import (
     request, jsonify, render_template,
-    current_app, Response, stream_with_context,
+    current_app, g, Response, stream_with_context,
     url_for, redirect, flash
 )
 from flask_login import login_required, current_user
-from models import db, Conversation, Message, RoleEnum, User
-from openai import OpenAI
+from models import db, BatchJob, Conversation, Message, MessageStatusEnum, RoleEnum, User
+from sqlalchemy import select, tuple_
 from decorators import admin_required
+from context_builder import build_context
+from config.tokenizer import count_text
+from response_cache import build_cache, cache_key, init_response_cache
+from pagination import encode_cursor, decode_cursor, page_limit
+from usage import init_usage_ledger, quota_required, record_usage, usage_from_response
+from upstream import init_upstream, UpstreamUnavailable
+from single_flight import init_single_flight
+from summarizer import init_summarizer, schedule_summary
+from search import search_messages
+from message_archive import TEXT_COLUMNS, message_text, system_prompt_id
+from conversation_io import ImportFormatError, export_chunks, import_ndjson, open_ndjson
+from batch_jobs import BatchError, create_job, init_batch_runner, item_page, job_page, job_payload, request_cancel
+from stream_buffer import init_stream_buffer, parse_last_event_id, sse_event, SSE_KEEPALIVE
+import metrics
 
-MAX_TURNOS = 6
+# Tokens de salida pedidos al modelo en cada endpoint (se reservan en la ventana)
+MESSAGES_MAX_OUTPUT_TOKENS = 4096
+STREAM_MAX_OUTPUT_TOKENS = 4096
+CHAT_STREAM_MAX_TOKENS = 1024
+
+# Listado de conversaciones (barra lateral)
+CONVERSATIONS_PAGE_SIZE = 50
+CONVERSATIONS_MAX_PAGE_SIZE = 200
+
+# Historial de mensajes
+MESSAGES_PAGE_SIZE = 50
+MESSAGES_MAX_PAGE_SIZE = 500
+
+# Resultados de /api/search
+SEARCH_PAGE_SIZE = 20
+SEARCH_MAX_PAGE_SIZE = 100
+
+# Trabajos por lotes y sus resultados
+BATCHES_PAGE_SIZE = 20
+BATCHES_MAX_PAGE_SIZE = 100
+BATCH_ITEMS_PAGE_SIZE = 50
+BATCH_ITEMS_MAX_PAGE_SIZE = 500
+
+from config.model_utils import get_model_config
+from config.middleware import model_constraints_middleware, refund_rate_limit
+from config.rate_limit import init_rate_limiter
+from config.model_router import init_model_router
+
+model_config = get_model_config()
+
+SYSTEM_PROMPT = "Eres un asistente de programación muy hábil. Responde de forma clara y concisa."
+
+
+# --- Helpers compartidos entre las vistas síncronas y el modo async (async_app.py) ---
+
+class AskJob:
+    """Parámetros ya validados de una llamada a /api/ask."""
+    def __init__(self, model, params, user_id, cache_key=None, flight_key=None):
+        self.model = model
+        self.params = params
+        self.user_id = user_id
+        # Clave en la caché de respuestas; None si la caché no aplica
+        self.cache_key = cache_key
+        # Clave para coalescer peticiones idénticas en vuelo (single_flight)
+        self.flight_key = flight_key
+        # Lo cobrado al rate limiter: se devuelve si la respuesta llega coalescida
+        self.rate_limit_charge = g.get("rate_limit_charge")
+
+
+class StreamJob:
+    """Lo necesario para emitir y guardar una respuesta en streaming."""
+    def __init__(self, conv_id, turn_index, model, payload, user_id, message_id=None):
+        self.conv_id = conv_id
+        self.turn_index = turn_index
+        self.model = model
+        self.payload = payload
+        self.user_id = user_id
+        # Los modelos de razonamiento van por la Responses API; el resto, por chat
+        self.reasoning_effort = model_config.reasoning_effort(model)
+        # Fila del asistente (status=streaming) que se va completando
+        self.message_id = message_id
+        # (input, cached_input, output) si el stream la informa al final
+        self.usage = None
+        # True si el modelo cortó la respuesta por max_tokens
+        self.truncated = False
+        # Instantes (monotonic) de apertura del stream y del primer token, para /metrics
+        self.started = None
+        self.first_token_at = None
+
+
+class StreamCheckpoint:
+    """
+    Texto de una respuesta en streaming. Se acumula en memoria y se vuelca a
+    la fila del asistente cada `interval` segundos o `max_chars` caracteres,
+    en transacciones cortas: entre volcados la petición no retiene ninguna
+    conexión del pool, y si el worker muere queda guardado el texto parcial.
+    """
+    def __init__(self, job, interval, max_chars):
+        self.job = job
+        self.interval = interval
+        self.max_chars = max_chars
+        self.parts = []
+        self._pending = []
+        self._pending_chars = 0
+        self._last_flush = time.monotonic()
+
+    def add(self, delta):
+        """Añade un fragmento; devuelve True si toca hacer checkpoint."""
+        self.parts.append(delta)
+        self._pending.append(delta)
+        self._pending_chars += len(delta)
+        return (self._pending_chars >= self.max_chars
+                or time.monotonic() - self._last_flush >= self.interval)
+
+    def text(self):
+        return "".join(self.parts)
+
+    def flush(self):
+        """Añade a la fila lo pendiente (content = content || :delta)."""
+        if not self._pending:
+            return
+        table = Message.__table__
+        try:
+            db.session.execute(
+                table.update()
+                .where(table.c.id == self.job.message_id)
+                .values(content=table.c.content + "".join(self._pending))
+            )
+            Conversation.touch(self.job.conv_id)
+            db.session.commit()
+        except Exception as e:
+            # Lo pendiente se reintenta en el siguiente checkpoint; el guardado
+            # final escribe el texto completo igualmente
+            db.session.rollback()
+            current_app.logger.warning("Checkpoint de stream fallido: %s", e)
+            return
+        self._pending = []
+        self._pending_chars = 0
+        self._last_flush = time.monotonic()
+
+
+def stream_checkpoint(job):
+    config = current_app.config
+    return StreamCheckpoint(
+        job,
+        interval=config.get("STREAM_CHECKPOINT_INTERVAL", 1.0),
+        max_chars=config.get("STREAM_CHECKPOINT_CHARS", 2048),
+    )
+
+
+def prepare_ask():
+    """
+    Lee el cuerpo de /api/ask y arma los parámetros para responses.create.
+    Si la respuesta ya está en caché devuelve directamente la Response.
+    """
+    data = request.get_json()
+    mensajes = data.get("messages", [])
+    model = data.get("model", model_config.default_model)
+    current_app.extensions["upstream"].ensure_available(model)
+
+    if not mensajes or mensajes[0].get("role") != "system":
+        mensajes.insert(0, {"role": "system", "content": SYSTEM_PROMPT})
+
+    params = {
+        "model": model,
+        "input": mensajes,
+        "max_output_tokens": 25000
+    }
+    effort = model_config.reasoning_effort(model)
+    if effort:
+        params["reasoning"] = {"effort": effort}
+
+    key = cache_key(params)
+    cache = current_app.extensions.get("response_cache")
+    bypass = data.get("cache") is False or \
+        "no-cache" in request.headers.get("Cache-Control", "")
+    if cache is None or bypass:
+        return AskJob(model, params, current_user.id, flight_key=key)
+
+    cached = cache.get(key)
+    metrics.cache_lookup("response", cached is not None)
+    if cached is not None:
+        # No se llega a llamar a OpenAI: no cuenta para el rate limit
+        refund_rate_limit(g.get("rate_limit_charge"))
+        cached["cached"] = True
+        return jsonify(cached)
+    return AskJob(model, params, current_user.id, cache_key=key, flight_key=key)
+
+
+def ask_result(job, resp):
+    """
+    Convierte la respuesta de OpenAI en el cuerpo JSON de /api/ask y la guarda
+    en la caché si procede.
+    """
+    current_app.logger.debug("Respuesta completa de OpenAI: %s", resp)
+    record_usage(job.user_id, job.model, resp)
+
+    truncated = False
+    if getattr(resp, "status", None) == "incomplete" and \
+       getattr(resp, "incomplete_details", None) and \
+       resp.incomplete_details.reason == "max_output_tokens":
+        truncated = True
+        current_app.logger.warning("Ran out of tokens")
+        if resp.output_text:
+            current_app.logger.warning("Partial output: %s", resp.output_text)
+
+    contenido = resp.output_text.strip()
+    current_app.logger.debug("Contenido generado: %s", contenido)
+    result = {"answer": contenido, "truncated": truncated}
+    if job.cache_key and not truncated:
+        current_app.extensions["response_cache"].set(job.cache_key, result)
+    return dict(result, cached=False)
+
+
+def prepare_stream(conv_id):
+    """
+    Valida la conversación, guarda el turno del usuario y arma el payload.
+    Devuelve un StreamJob, o una respuesta de error si no procede.
+    """
+    conv = Conversation.query.get_or_404(conv_id)
+    if conv.user_id != current_user.id:
+        return jsonify({"error": "Acceso no autorizado"}), 403
+
+    data = request.get_json()
+    user_text = data.get("content", "")
+    model     = data.get("model", model_config.default_model)
+    # Con el circuito abierto no se reserva nada: 503 inmediato
+    current_app.extensions["upstream"].ensure_available(model)
+
+    # Turnos del usuario y del asistente, reservados de una vez
+    idx = Conversation.allocate_turns(conv.id, 2)
+
+    user_msg = Message(
+        conversation_id=conv.id,
+        role=RoleEnum.user,
+        content=user_text,
+        turn_index=idx
+    )
+    db.session.add(user_msg)
+    db.session.flush()
+
+    reserved = STREAM_MAX_OUTPUT_TOKENS if model_config.reasoning_effort(model) else CHAT_STREAM_MAX_TOKENS
+    payload = build_context(conv.id, model, reserved,
+                            current_app.config.get("CONTEXT_MAX_INPUT_TOKENS"))
+
+    # La fila del asistente se crea vacía (después de armar el contexto, para
+    # no incluirla) y se irá rellenando con checkpoints.
+    assistant_msg = Message(
+        conversation_id=conv.id,
+        role=RoleEnum.assistant,
+        content="",
+        turn_index=idx + 1,
+        status=MessageStatusEnum.streaming
+    )
+    db.session.add(assistant_msg)
+
+    # Todo se confirma antes de abrir el stream: el commit devuelve la conexión
+    # al pool y la sesión de la petición queda libre mientras fluyen tokens.
+    db.session.commit()
+    return StreamJob(conv.id, idx + 1, model, payload, current_user.id, assistant_msg.id)
+
+
+def stream_request(job):
+    """
+    Devuelve (api, kwargs) para abrir el stream con el cliente sync o async.
+    Desde aquí el stream cuenta como abierto en /metrics.
+    """
+    metrics.stream_started(job)
+    if job.reasoning_effort:
+        return "responses", {
+            "model": job.model,
+            "input": job.payload,
+            "stream": True,
+            "max_output_tokens": STREAM_MAX_OUTPUT_TOKENS,
+            "reasoning": {"effort": job.reasoning_effort}
+        }
+    return "chat", {
+        "model": job.model,
+        "messages": job.payload,
+        "stream": True,
+        "stream_options": {"include_usage": True},
+        "max_tokens": CHAT_STREAM_MAX_TOKENS
+    }
+
+
+def stream_delta(job, chunk):
+    """
+    Extrae el texto incremental de un chunk del stream. Si el chunk trae el
+    consumo final de tokens, lo anota en `job.usage`.
+    """
+    delta = _chunk_text(job, chunk)
+    if delta and job.first_token_at is None:
+        metrics.first_token(job)
+    return delta
+
+
+def _chunk_text(job, chunk):
+    if job.reasoning_effort:
+        kind = getattr(chunk, "type", None)
+        if kind in ("response.completed", "response.incomplete"):
+            job.usage = usage_from_response(chunk.response)
+            details = getattr(chunk.response, "incomplete_details", None)
+            job.truncated = getattr(details, "reason", None) == "max_output_tokens"
+        return getattr(chunk, "text", "")
+    if getattr(chunk, "usage", None):
+        job.usage = usage_from_response(chunk)
+    if not chunk.choices:
+        return ""
+    if chunk.choices[0].finish_reason == "length":
+        job.truncated = True
+    return getattr(chunk.choices[0].delta, "content", "") or ""
+
+
+def save_stream_answer(job, text, status=MessageStatusEnum.complete):
+    """Escribe el texto final y el estado de la respuesta al terminar (o cortarse) el stream."""
+    table = Message.__table__
+    token_count = count_text(text)
+    db.session.execute(
+        table.update()
+        .where(table.c.id == job.message_id)
+        .values(content=text, token_count=token_count, status=status)
+    )
+    Conversation.touch(job.conv_id)
+    db.session.commit()
+    current_app.logger.debug("Respuesta stream guardada (%s).", status.value)
+    metrics.stream_finished(job, job.usage[2] if job.usage else token_count, status.value)
+
+    ledger = current_app.extensions.get("usage_ledger")
+    if ledger is not None:
+        ledger.record(job.user_id, job.model, job.usage, job.message_id)
+    if status == MessageStatusEnum.complete:
+        schedule_summary(job.conv_id, job.user_id)
+
+
+def stream_metadata(job, status):
+    """Datos del evento final `done` del modo SSE."""
+    usage = None
+    if job.usage is not None:
+        usage = dict(zip(("input_tokens", "cached_input_tokens", "output_tokens"), job.usage))
+    return {
+        "message_id": job.message_id,
+        "turn_index": job.turn_index,
+        "status": status.value,
+        "truncated": job.truncated,
+        "usage": usage,
+    }
+
+
+def wants_sse():
+    return "text/event-stream" in request.headers.get("Accept", "")
+
+
+def _sse_response(events):
+    return Response(
+        (e.encode("utf-8") for e in events),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache, no-transform", "X-Accel-Buffering": "no"}
+    )
+
+
+def run_generation(app, upstream, job, checkpoint, gen):
+    """
+    Productor del modo SSE: itera el stream de OpenAI en su propio hilo y
+    publica cada fragmento en `gen`. No depende de la conexión del cliente,
+    así que la respuesta se completa aunque este se desconecte.
+    """
+    with app.app_context():
+        status = MessageStatusEnum.interrupted
+        try:
+            api, kwargs = stream_request(job)
+            stream_resp = upstream.create(api, **kwargs)
+
+            for chunk in stream_resp:
+                delta = stream_delta(job, chunk)
+                if not delta:
+                    continue
+                due = checkpoint.add(delta)
+                gen.publish(delta)
+                if due:
+                    checkpoint.flush()
+            status = MessageStatusEnum.complete
+        except Exception as e:
+            upstream.report_failure(job.model, e)
+            current_app.logger.error("Error en stream: %s", e, exc_info=True)
+        finally:
+            try:
+                save_stream_answer(job, checkpoint.text(), status)
+            finally:
+                gen.finish(stream_metadata(job, status))
+
+
+def sse_from_generation(gen, after, keepalive):
+    """Eventos SSE de una generación del proceso, desde el offset `after`."""
+    while True:
+        events, done, meta = gen.wait(after, keepalive)
+        for offset, delta in events:
+            yield sse_event({"delta": delta}, event_id=offset)
+            after = offset
+        if done:
+            yield sse_event(meta, event_id=after, event="done")
+            return
+        if not events:
+            yield SSE_KEEPALIVE
+
+
+def sse_from_database(message_id, after, poll_interval, idle_timeout):
+    """
+    Reenganche cuando la generación no está en este proceso (otro worker, o
+    ya caducó del buffer): se sirve el texto de los checkpoints, sondeando la
+    fila hasta que deje de estar en streaming.
+    """
+    last_change = time.monotonic()
+    while True:
+        row = db.session.execute(
+            select(Message.status, Message.turn_index, *TEXT_COLUMNS)
+            .where(Message.id == message_id)
+        ).one()
+        content = message_text(row)
+        # Fin de la transacción: la conexión vuelve al pool entre sondeos
+        db.session.rollback()
+        if len(content) > after:
+            yield sse_event({"delta": content[after:]}, event_id=len(content))
+            after = len(content)
+            last_change = time.monotonic()
+        if row.status != MessageStatusEnum.streaming or time.monotonic() - last_change > idle_timeout:
+            yield sse_event({
+                "message_id": message_id,
+                "turn_index": row.turn_index,
+                "status": row.status.value,
+                "truncated": None,
+                "usage": None,
+            }, event_id=after, event="done")
+            return
+        time.sleep(poll_interval)
+
+
+def upstream_unavailable_response(e):
+    response = jsonify({
+        "error_code": "UPSTREAM_UNAVAILABLE",
+        "error": "El modelo no está disponible en este momento. Inténtalo de nuevo en unos segundos.",
+    })
+    response.status_code = 503
+    response.headers["Retry-After"] = str(max(math.ceil(e.retry_after), 1))
+    return response
+
+
+def upstream_error_response(e, endpoint):
+    """Respuesta JSON para un fallo de la llamada a OpenAI en `endpoint`."""
+    if isinstance(e, UpstreamUnavailable):
+        return upstream_unavailable_response(e)
+    if isinstance(e, openai.BadRequestError):
+        current_app.logger.error("BadRequest en %s: %s", endpoint, e, exc_info=True)
+        return jsonify({"error": e._message}), 400
+    if isinstance(e, (openai.APIConnectionError, openai.InternalServerError)):
+        current_app.logger.error("OpenAI no responde en %s: %s", endpoint, e, exc_info=True)
+        return jsonify({"error": "OpenAI no responde. Inténtalo de nuevo."}), 502
+    current_app.logger.error("Error en %s: %s", endpoint, e, exc_info=True)
+    return jsonify({"error": "Error interno del servidor. Revisa los registros."}), 500
+
+
+def _conversation_list_key(user_id):
+    return f"convlist:{user_id}"
+
+
+def _invalidate_conversation_list(user_id):
+    cache = current_app.extensions.get("conversation_list_cache")
+    if cache is not None:
+        cache.delete(_conversation_list_key(user_id))
+
+
+def _conversation_page(user_id, limit, after=None):
+    """
+    Página del listado de conversaciones ordenada por (created_at, id)
+    descendente, usando keyset pagination a partir de `after`
+    (created_at, id) de la última fila de la página anterior.
+    """
+    query = Conversation.query\
+        .with_entities(Conversation.id, Conversation.title, Conversation.created_at)\
+        .filter(Conversation.user_id == user_id)
+    if after:
+        query = query.filter(
+            tuple_(Conversation.created_at, Conversation.id) < tuple_(*after)
+        )
+    rows = query.order_by(Conversation.created_at.desc(), Conversation.id.desc())\
+        .limit(limit + 1)\
+        .all()
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(rows[-1].created_at.isoformat(), rows[-1].id)
+    return {
+        "items": [{
+            "id": c.id,
+            "title": c.title,
+            "created_at": c.created_at.isoformat()
+        } for c in rows],
+        "next_cursor": next_cursor,
+    }
+
+
+def _messages_etag(conv, *params):
+    """ETag del historial: último turno + fecha de modificación + parámetros de la página."""
+    updated = conv.updated_at.isoformat() if conv.updated_at else ""
+    raw = f"{conv.id}:{conv.next_turn}:{updated}:{params}"
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+
+def _message_page(conv_id, limit, before_turn=None, after_turn=None):
+    """
+    Página de mensajes por turn_index.
+    - Por defecto (o con `before_turn`): los `limit` últimos anteriores al
+      cursor; X-Next-Cursor apunta a la página anterior.
+    - Con `after_turn`: los `limit` siguientes a ese turno, para sincronizar
+      solo lo nuevo; has_more indica si quedan más.
+    """
+    query = Message.query\
+        .with_entities(Message.turn_index, Message.role, Message.status, Message.created_at,
+                       *TEXT_COLUMNS)\
+        .filter(Message.conversation_id == conv_id)
+
+    next_cursor = None
+    has_more = False
+    if after_turn is not None:
+        rows = query.filter(Message.turn_index > after_turn)\
+            .order_by(Message.turn_index.asc())\
+            .limit(limit + 1)\
+            .all()
+        if len(rows) > limit:
+            rows = rows[:limit]
+            has_more = True
+    else:
+        if before_turn is not None:
+            query = query.filter(Message.turn_index < before_turn)
+        rows = query.order_by(Message.turn_index.desc()).limit(limit + 1).all()
+        if len(rows) > limit:
+            rows = rows[:limit]
+            next_cursor = encode_cursor(rows[-1].turn_index)
+        rows.reverse()
+
+    return {
+        "items": [{
+            "turn_index": m.turn_index,
+            "role": m.role.value,
+            "content": message_text(m),
+            "status": m.status.value,
+            "created_at": m.created_at.isoformat()
+        } for m in rows],
+        "next_cursor": next_cursor,
+        "has_more": has_more,
+    }
 
-import sys
-import os
-sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "config")))
 
-from model_utils import ModelConfig
-from middleware import model_constraints_middleware
 def init_app(app_instance):
-    # Configura cliente OpenAI y modelos permitidos
-    client = OpenAI(api_key=app_instance.config.get("OPENAI_API_KEY"))
-    model_config = ModelConfig()
-    ALLOWED_MODELS = list(model_config.models.keys())
+    # Cliente OpenAI del proceso (pool, timeouts, reintentos y circuit breaker)
+    upstream = init_upstream(app_instance)
+    app_instance.register_error_handler(UpstreamUnavailable, upstream_unavailable_response)
+    init_response_cache(app_instance)
+    init_usage_ledger(app_instance)
+    init_rate_limiter(app_instance)
+    init_model_router(app_instance)
+    init_stream_buffer(app_instance)
+    init_single_flight(app_instance)
+    init_summarizer(app_instance, upstream)
+    init_batch_runner(app_instance, upstream)
+    app_instance.extensions["conversation_list_cache"] = build_cache(
+        app_instance.config.get("CONVERSATION_LIST_CACHE_BACKEND"),
+        app_instance.config.get("CONVERSATION_LIST_CACHE_PATH"),
+        app_instance.config.get("CONVERSATION_LIST_CACHE_TTL", 30),
+        max_entries=10000,
+        max_bytes=32 * 1024 * 1024,
+    )
 
     # Ruta pública
     @app_instance.route("/")
     @login_required
     def index():
+        models = model_config.current   # un único snapshot para toda la plantilla
         return render_template(
             "index.html",
-            models=ALLOWED_MODELS,
-            default_model="chatgpt-4o-latest"
+            models=models.model_names,
+            context_windows=models.context_windows,
+            default_model=models.default_model
         )
 
     # Endpoint genérico de ask (requiere login)
     @app_instance.route("/api/ask", methods=["POST"])
     @login_required
+    @quota_required
     @model_constraints_middleware
     def ask():
-        data = request.get_json()
-        mensajes = data.get("messages", [])
-        model = data.get("model", "chatgpt-4o-latest")
-
-        if not mensajes or mensajes[0].get("role") != "system":
-            mensajes.insert(0, {
-                "role": "system",
-                "content": "Eres un asistente de programación muy hábil. Responde de forma clara y concisa."
-            })
+        job = prepare_ask()
+        if not isinstance(job, AskJob):
+            return job
+        def call():
+            return ask_result(job, upstream.create("responses", **job.params))
 
         try:
-            params = {
-                "model": model,
-                "input": mensajes,
-                "max_output_tokens": 25000
-            }
-            if model == "o4-mini":
-                params["reasoning"] = {"effort": "medium"}
-
-            resp = client.responses.create(**params)
-            current_app.logger.debug("Respuesta completa de OpenAI: %s", resp)
-
-            truncated = False
-            if getattr(resp, "status", None) == "incomplete" and \
-               getattr(resp, "incomplete_details", None) and \
-               resp.incomplete_details.reason == "max_output_tokens":
-                truncated = True
-                current_app.logger.warning("Ran out of tokens")
-                if resp.output_text:
-                    current_app.logger.warning("Partial output: %s", resp.output_text)
-
-            contenido = resp.output_text.strip()
-            current_app.logger.debug("Contenido generado: %s", contenido)
-
-            return jsonify({"answer": contenido, "truncated": truncated})
-
-        except openai.BadRequestError as e:
-            current_app.logger.error("BadRequest en /api/ask: %s", e, exc_info=True)
-            return jsonify({"error": e._message}), 400
+            flight = current_app.extensions.get("single_flight")
+            if flight is None:
+                return jsonify(dict(call(), coalesced=False))
+            # Peticiones idénticas simultáneas comparten una sola llamada
+            result, coalesced = flight.do(job.flight_key, call)
+            if coalesced:
+                refund_rate_limit(job.rate_limit_charge)
+            return jsonify(dict(result, coalesced=coalesced))
+
         except Exception as e:
-            current_app.logger.error("Error en /api/ask: %s", e, exc_info=True)
-            return jsonify({"error": "Error interno del servidor. Revisa los registros."}), 500
+            return upstream_error_response(e, "/api/ask")
 
     # Listar y crear conversaciones propias
     @app_instance.route("/api/conversations", methods=["GET", "POST"])
     @login_required
     def conversations():
         if request.method == "GET":
-            convs = Conversation.query\
-                .filter_by(user_id=current_user.id)\
-                .order_by(Conversation.created_at.desc())\
-                .all()
-            return jsonify([{
-                "id": c.id,
-                "title": c.title,
-                "created_at": c.created_at.isoformat()
-            } for c in convs])
+            limit = page_limit(request.args.get("limit"), CONVERSATIONS_PAGE_SIZE, CONVERSATIONS_MAX_PAGE_SIZE)
+            cursor = request.args.get("cursor")
+            first_page = not cursor and limit == CONVERSATIONS_PAGE_SIZE
+            cache = current_app.extensions.get("conversation_list_cache")
+
+            after = None
+            if cursor:
+                values = decode_cursor(cursor)
+                try:
+                    after = (datetime.fromisoformat(values[0]), int(values[1]))
+                except (TypeError, ValueError, IndexError):
+                    return jsonify({"error": "Cursor inválido"}), 400
+
+            page = None
+            if cache and first_page:
+                page = cache.get(_conversation_list_key(current_user.id))
+                metrics.cache_lookup("conversation_list", page is not None)
+            if page is None:
+                page = _conversation_page(current_user.id, limit, after)
+                if cache and first_page:
+                    cache.set(_conversation_list_key(current_user.id), page)
+
+            response = jsonify(page["items"])
+            if page["next_cursor"]:
+                response.headers["X-Next-Cursor"] = page["next_cursor"]
+            return response
 
         # POST -> nueva conversación para el usuario actual
-        conv = Conversation(user_id=current_user.id)
+        conv = Conversation(user_id=current_user.id, next_turn=1)
         db.session.add(conv)
         db.session.flush()
 
+        # El texto vive en una plantilla compartida; el mensaje solo la referencia
         sys_msg = Message(
             conversation_id=conv.id,
             role=RoleEnum.system,
-            content="Eres un asistente de programación muy hábil. Responde de forma clara y concisa.",
+            content="",
+            system_prompt_id=system_prompt_id(SYSTEM_PROMPT),
+            token_count=count_text(SYSTEM_PROMPT),
             turn_index=0
         )
         db.session.add(sys_msg)
         db.session.commit()
+        _invalidate_conversation_list(current_user.id)
         return jsonify({"id": conv.id}), 201
 
+    # Búsqueda de texto completo en los mensajes del usuario
+    @app_instance.route("/api/search", methods=["GET"])
+    @login_required
+    def search():
+        query = (request.args.get("q") or "").strip()
+        if not query:
+            return jsonify({"error": "Falta el parámetro q"}), 400
+        limit = page_limit(request.args.get("limit"), SEARCH_PAGE_SIZE, SEARCH_MAX_PAGE_SIZE)
+        after = None
+        if request.args.get("cursor"):
+            values = decode_cursor(request.args["cursor"])
+            try:
+                after = (float(values[0]), int(values[1]))
+            except (TypeError, ValueError, IndexError):
+                return jsonify({"error": "Cursor inválido"}), 400
+
+        page = search_messages(current_user.id, query, limit, after)
+        response = jsonify(page["items"])
+        if page["next_cursor"]:
+            response.headers["X-Next-Cursor"] = page["next_cursor"]
+        response.headers["Cache-Control"] = "private, no-cache"
+        return response
+
+    # Copia de seguridad del historial en NDJSON (?gzip=1 para comprimir)
+    @app_instance.route("/api/export", methods=["GET"])
+    @login_required
+    def export_conversations():
+        compress = request.args.get("gzip", "").lower() in ("1", "true")
+        filename = f"conversaciones-{datetime.utcnow():%Y%m%d}.ndjson" + (".gz" if compress else "")
+        return Response(
+            stream_with_context(export_chunks(current_user.id, compress)),
+            mimetype="application/gzip" if compress else "application/x-ndjson",
+            headers={"Content-Disposition": f'attachment; filename="{filename}"',
+                     "Cache-Control": "no-store"},
+        )
+
+    # Importa un NDJSON (plano o gzip) como conversaciones nuevas del usuario
+    @app_instance.route("/api/import", methods=["POST"])
+    @login_required
+    def import_conversations():
+        try:
+            result = import_ndjson(open_ndjson(request.stream), current_user.id)
+        except (ImportFormatError, UnicodeDecodeError, OSError) as e:
+            return jsonify({"error": str(e)}), 400
+        _invalidate_conversation_list(current_user.id)
+        return jsonify(result), 201
+
+    # Trabajos por lotes: muchos prompts a la Batch API (respuesta en < 24 h)
+    @app_instance.route("/api/batches", methods=["GET", "POST"])
+    @login_required
+    @quota_required
+    def batches():
+        if request.method == "GET":
+            limit = page_limit(request.args.get("limit"), BATCHES_PAGE_SIZE, BATCHES_MAX_PAGE_SIZE)
+            before_id = None
+            if request.args.get("cursor"):
+                values = decode_cursor(request.args["cursor"])
+                if not values or not isinstance(values[0], int):
+                    return jsonify({"error": "Cursor inválido"}), 400
+                before_id = values[0]
+            page = job_page(current_user.id, limit, before_id)
+            response = jsonify(page["items"])
+            if page["next_cursor"]:
+                response.headers["X-Next-Cursor"] = page["next_cursor"]
+            return response
+
+        data = request.get_json(silent=True) or {}
+        prompts = data.get("prompts")
+        if not isinstance(prompts, list):
+            return jsonify({"error": "Falta la lista prompts"}), 400
+        try:
+            job = create_job(
+                current_user.id,
+                data.get("model", model_config.default_model),
+                prompts,
+                SYSTEM_PROMPT,
+                max_items=current_app.config.get("BATCH_MAX_ITEMS", 5000),
+                router=current_app.extensions.get("model_router"),
+            )
+        except BatchError as e:
+            return jsonify({"error": str(e)}), 400
+        current_app.extensions["batch_runner"].notify()
+        return jsonify(job_payload(job)), 202
+
+    @app_instance.route("/api/batches/<int:job_id>", methods=["GET"])
+    @login_required
+    def batch_detail(job_id):
+        job = BatchJob.query.get_or_404(job_id)
+        if job.user_id != current_user.id:
+            return jsonify({"error": "Acceso no autorizado"}), 403
+        return jsonify(job_payload(job))
+
+    # Resultados por item, en el orden de los prompts (?status=failed para los fallidos)
+    @app_instance.route("/api/batches/<int:job_id>/items", methods=["GET"])
+    @login_required
+    def batch_items(job_id):
+        job = BatchJob.query.get_or_404(job_id)
+        if job.user_id != current_user.id:
+            return jsonify({"error": "Acceso no autorizado"}), 403
+        limit = page_limit(request.args.get("limit"), BATCH_ITEMS_PAGE_SIZE, BATCH_ITEMS_MAX_PAGE_SIZE)
+        after_idx = None
+        if request.args.get("cursor"):
+            values = decode_cursor(request.args["cursor"])
+            if not values or not isinstance(values[0], int):
+                return jsonify({"error": "Cursor inválido"}), 400
+            after_idx = values[0]
+        page = item_page(job.id, limit, after_idx, request.args.get("status"))
+        response = jsonify(page["items"])
+        if page["next_cursor"]:
+            response.headers["X-Next-Cursor"] = page["next_cursor"]
+        return response
+
+    @app_instance.route("/api/batches/<int:job_id>/cancel", methods=["POST"])
+    @login_required
+    def batch_cancel(job_id):
+        job = BatchJob.query.get_or_404(job_id)
+        if job.user_id != current_user.id:
+            return jsonify({"error": "Acceso no autorizado"}), 403
+        request_cancel(job)
+        current_app.extensions["batch_runner"].notify()
+        db.session.refresh(job)
+        return jsonify(job_payload(job)), 202
+
     # Obtener o añadir mensajes de una conversación
     @app_instance.route("/api/conversations/<int:conv_id>/messages", methods=["GET", "POST"])
     @login_required
+    @quota_required
+    @model_constraints_middleware
     def messages(conv_id):
         conv = Conversation.query.get_or_404(conv_id)
         if conv.user_id != current_user.id:
             return jsonify({"error": "Acceso no autorizado"}), 403
 
         if request.method == "GET":
-            msgs = [{
-                "role": m.role.value,
-                "content": m.content,
-                "created_at": m.created_at.isoformat()
-            } for m in conv.messages]
-            return jsonify(msgs)
+            limit = page_limit(request.args.get("limit"), MESSAGES_PAGE_SIZE, MESSAGES_MAX_PAGE_SIZE)
+            after_turn = request.args.get("after_turn", type=int)
+            before_turn = None
+            if request.args.get("cursor"):
+                values = decode_cursor(request.args["cursor"])
+                if not values or not isinstance(values[0], int):
+                    return jsonify({"error": "Cursor inválido"}), 400
+                before_turn = values[0]
+
+            # El ETag sale de la fila de la conversación: si no ha cambiado no
+            # se llega a leer ningún mensaje.
+            etag = _messages_etag(conv, limit, before_turn, after_turn)
+            if request.if_none_match.contains(etag):
+                response = Response(status=304)
+                response.set_etag(etag)
+                response.headers["Cache-Control"] = "private, no-cache"
+                return response
+
+            page = _message_page(conv.id, limit, before_turn, after_turn)
+            response = jsonify(page["items"])
+            if page["next_cursor"]:
+                response.headers["X-Next-Cursor"] = page["next_cursor"]
+            if page["has_more"]:
+                response.headers["X-Has-More"] = "true"
+            response.set_etag(etag)
+            response.headers["Cache-Control"] = "private, no-cache"
+            return response
 
         # POST -> guardar user + llamar OpenAI + guardar assistant
         data = request.get_json()
         user_text = data.get("content")
-        model = data.get("model", "chatgpt-4o-latest")
+        model = data.get("model", model_config.default_model)
 
-        last_message = Message.query.filter_by(conversation_id=conv.id)\
-                          .order_by(Message.turn_index.desc())\
-                          .first()
-        last_index = last_message.turn_index if last_message else -1
+        idx = Conversation.allocate_turns(conv.id, 2)
 
         user_msg = Message(
             conversation_id=conv.id,
             role=RoleEnum.user,
             content=user_text,
-            turn_index=last_index + 1
+            turn_index=idx
         )
         db.session.add(user_msg)
         db.session.flush()
 
-        all_messages = Message.query.filter_by(conversation_id=conv.id)\
-                            .order_by(Message.turn_index.asc())\
-                            .all()
-
-        system_msg = next((m for m in all_messages if m.role == RoleEnum.system), None)
-        context = [m for m in all_messages if m.role != RoleEnum.system]
-        últimos = context[-MAX_TURNOS:]
-
-        payload = []
-        if system_msg:
-            payload.append({"role": system_msg.role.value, "content": system_msg.content})
-        payload += [{"role": m.role.value, "content": m.content} for m in últimos]
+        payload = build_context(conv.id, model, MESSAGES_MAX_OUTPUT_TOKENS,
+                                current_app.config.get("CONTEXT_MAX_INPUT_TOKENS"))
+        # Se confirma antes de llamar a OpenAI para no retener el bloqueo de la conversación
+        db.session.commit()
 
-        params = {"model": model, "input": payload, "max_output_tokens": 4096}
-        if model == "o4-mini":
-            params["reasoning"] = {"effort": "medium"}
+        params = {"model": model, "input": payload, "max_output_tokens": MESSAGES_MAX_OUTPUT_TOKENS}
+        effort = model_config.reasoning_effort(model)
+        if effort:
+            params["reasoning"] = {"effort": effort}
 
-        resp = client.responses.create(**params)
+        try:
+            resp = upstream.create("responses", **params)
+        except Exception as e:
+            # El turno del usuario ya está confirmado: como en el stream, el del
+            # asistente queda como interrumpido para no dejar un hueco en idx + 1
+            db.session.add(Message(
+                conversation_id=conv.id,
+                role=RoleEnum.assistant,
+                content="",
+                turn_index=idx + 1,
+                status=MessageStatusEnum.interrupted
+            ))
+            Conversation.touch(conv.id)
+            db.session.commit()
+            return upstream_error_response(e, request.path)
         answer = resp.output_text.strip()
 
         assistant_msg = Message(
             conversation_id=conv.id,
             role=RoleEnum.assistant,
             content=answer,
-            turn_index=last_index + 2
+            turn_index=idx + 1
         )
         db.session.add(assistant_msg)
+        Conversation.touch(conv.id)
         db.session.commit()
+        record_usage(current_user.id, model, resp, assistant_msg.id)
+        schedule_summary(conv.id, current_user.id)
 
         return jsonify({"answer": answer})
 
     # Streaming de mensajes
     @app_instance.route("/api/conversations/<int:conv_id>/messages/stream", methods=["POST"])
     @login_required
+    @quota_required
+    @model_constraints_middleware
     def stream_messages(conv_id):
-        conv = Conversation.query.get_or_404(conv_id)
-        if conv.user_id != current_user.id:
-            return jsonify({"error": "Acceso no autorizado"}), 403
-
-        data = request.get_json()
-        user_text = data.get("content", "")
-        model     = data.get("model", "chatgpt-4o-latest")
+        job = prepare_stream(conv_id)
+        if not isinstance(job, StreamJob):
+            return job
 
-        last_msg = Message.query.filter_by(conversation_id=conv.id)\
-                                 .order_by(Message.turn_index.desc())\
-                                 .first()
-        idx = last_msg.turn_index if last_msg else -1
-
-        user_msg = Message(
-            conversation_id=conv.id,
-            role=RoleEnum.user,
-            content=user_text,
-            turn_index=idx + 1
-        )
-        db.session.add(user_msg)
-        db.session.flush()
+        if wants_sse():
+            checkpoint = stream_checkpoint(job)
+            gen = current_app.extensions["stream_generations"].create(
+                job.message_id, job.conv_id, job.user_id, checkpoint.text
+            )
+            threading.Thread(
+                target=run_generation,
+                args=(current_app._get_current_object(), upstream, job, checkpoint, gen),
+                name=f"stream-{job.message_id}",
+                daemon=True,
+            ).start()
 
-        all_msgs = Message.query.filter_by(conversation_id=conv.id)\
-                                .order_by(Message.turn_index.asc())\
-                                .all()
-        system_msg = next((m for m in all_msgs if m.role == RoleEnum.system), None)
-        history    = [m for m in all_msgs if m.role != RoleEnum.system][-MAX_TURNOS:]
+            def events():
+                yield sse_event(stream_metadata(job, MessageStatusEnum.streaming), event_id=0, event="start")
+                yield from sse_from_generation(gen, 0, current_app.config.get("STREAM_SSE_KEEPALIVE", 15))
 
-        payload = []
-        if system_msg:
-            payload.append({"role":"system", "content":system_msg.content})
-        payload += [{"role":m.role.value, "content":m.content} for m in history]
+            return _sse_response(stream_with_context(events()))
 
         def generate():
-            full_resp = ""
+            checkpoint = stream_checkpoint(job)
+            # Si el cliente se desconecta (GeneratorExit) queda como interrumpida
+            status = MessageStatusEnum.interrupted
             try:
-                if model == "o4-mini":
-                    stream_resp = client.responses.create(
-                        model=model,
-                        input=payload,
-                        stream=True,
-                        max_output_tokens=4096,
-                        reasoning={"effort":"medium"}
-                    )
-                else:
-                    stream_resp = client.chat.completions.create(
-                        model=model,
-                        messages=payload,
-                        stream=True,
-                        max_tokens=1024
-                    )
+                api, kwargs = stream_request(job)
+                stream_resp = upstream.create(api, **kwargs)
 
                 for chunk in stream_resp:
-                    if model == "o4-mini":
-                        delta = getattr(chunk, "text", "")
-                    else:
-                        delta = getattr(chunk.choices[0].delta, "content", "") or ""
+                    delta = stream_delta(job, chunk)
                     if not delta:
                         continue
-                    full_resp += delta
+                    if checkpoint.add(delta):
+                        checkpoint.flush()
                     yield delta.encode("utf-8")
+                status = MessageStatusEnum.complete
 
             except Exception as e:
+                upstream.report_failure(job.model, e)
                 current_app.logger.error("Error en stream: %s", e, exc_info=True)
                 yield f"\n\n[Stream interrumpido: {e}]\n".encode("utf-8")
             finally:
-                assistant_msg = Message(
-                    conversation_id=conv.id,
-                    role=RoleEnum.assistant,
-                    content=full_resp,
-                    turn_index=idx + 2
-                )
-                db.session.add(assistant_msg)
-                db.session.commit()
-                current_app.logger.debug("Respuesta stream guardada.")
+                save_stream_answer(job, checkpoint.text(), status)
 
         return Response(
             stream_with_context(generate()),
@@ -264,6 +948,37 @@ def init_app(app_instance):
             headers={"Cache-Control":"no-transform"}
         )
 
+    # Reenganche a una respuesta SSE en curso (Last-Event-ID = offset ya recibido)
+    @app_instance.route("/api/conversations/<int:conv_id>/messages/<int:message_id>/stream", methods=["GET"])
+    @login_required
+    def resume_stream(conv_id, message_id):
+        after = parse_last_event_id(
+            request.headers.get("Last-Event-ID") or request.args.get("last_event_id")
+        )
+        config = current_app.config
+        gen = current_app.extensions["stream_generations"].get(message_id)
+        if gen is not None:
+            if gen.user_id != current_user.id or gen.conv_id != conv_id:
+                return jsonify({"error": "Acceso no autorizado"}), 403
+            return _sse_response(sse_from_generation(gen, after, config.get("STREAM_SSE_KEEPALIVE", 15)))
+
+        owner = db.session.execute(
+            select(Conversation.user_id)
+            .join(Message, Message.conversation_id == Conversation.id)
+            .where(Message.id == message_id, Conversation.id == conv_id,
+                   Message.role == RoleEnum.assistant)
+        ).scalar_one_or_none()
+        if owner is None:
+            return jsonify({"error": "Mensaje no encontrado"}), 404
+        if owner != current_user.id:
+            return jsonify({"error": "Acceso no autorizado"}), 403
+        db.session.rollback()
+        return _sse_response(stream_with_context(sse_from_database(
+            message_id, after,
+            poll_interval=config.get("STREAM_RESUME_POLL_INTERVAL", 0.5),
+            idle_timeout=config.get("STREAM_RESUME_IDLE_TIMEOUT", 120),
+        )))
+
     # Renombrar conversación
     @app_instance.route("/api/conversations/<int:conv_id>", methods=["PATCH"])
     @login_required
@@ -276,6 +991,7 @@ def init_app(app_instance):
         new_title = data.get("title", "").strip()
         conv.title = new_title if new_title else "Sin título"
         db.session.commit()
+        _invalidate_conversation_list(current_user.id)
         return jsonify({"id": conv.id, "title": conv.title})
 
     # Borrar conversación
@@ -288,9 +1004,22 @@ def init_app(app_instance):
 
         db.session.delete(conv)
         db.session.commit()
+        _invalidate_conversation_list(current_user.id)
         return jsonify({"success": True}), 200
 
     # Health check público
     @app_instance.route("/health")
     def health():
         return jsonify({"status": "OK"})
+
+    # Métricas Prometheus de todos los workers (METRICS_TOKEN: Authorization: Bearer ...)
+    @app_instance.route("/metrics")
+    def metrics_endpoint():
+        token = current_app.config.get("METRICS_TOKEN")
+        if token and not hmac.compare_digest(request.headers.get("Authorization", ""), f"Bearer {token}"):
+            return jsonify({"error": "Acceso no autorizado"}), 401
+        rendered = metrics.render() if current_app.extensions.get("metrics") else None
+        if rendered is None:
+            return jsonify({"error": "Métricas desactivadas"}), 404
+        body, content_type = rendered
+        return Response(body, content_type=content_type, headers={"Cache-Control": "no-store"})
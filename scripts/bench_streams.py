@@ -0,0 +1,112 @@
+# scripts/bench_streams.py
+"""
+Benchmark de streams concurrentes: modo sync (wsgi:app) vs async (asgi:app).
+
+Abre N streams a la vez contra /api/conversations/<id>/messages/stream y mide
+cuántos llegan a estar abiertos simultáneamente, el tiempo hasta el primer
+byte y el tiempo total.
+
+Preparación (ver README, sección "Modo asíncrono"):
+    python scripts/fake_openai.py --port 9100 --chunks 50 --delay 0.1
+    export OPENAI_BASE_URL=http://127.0.0.1:9100/v1
+
+    # Modo sync
+    gunicorn -c gunicorn_conf.py -b 127.0.0.1:5002 wsgi:app
+    # Modo async
+    gunicorn -c gunicorn_async_conf.py -b 127.0.0.1:5003 asgi:app
+
+Uso:
+    python scripts/bench_streams.py --url http://127.0.0.1:5002 \\
+        --username admin --password secreto --concurrency 200
+"""
+import argparse
+import asyncio
+import re
+import statistics
+import time
+
+import httpx
+
+CSRF_INPUT = re.compile(r'name="csrf_token"[^>]*value="([^"]+)"')
+
+
+async def login(client, username, password):
+    page = await client.get("/auth/login")
+    token = CSRF_INPUT.search(page.text).group(1)
+    resp = await client.post("/auth/login", data={
+        "csrf_token": token, "username": username, "password": password,
+    })
+    if "/auth/login" in str(resp.url):
+        raise SystemExit("Login fallido: revisa usuario y contraseña")
+    index = await client.get("/")
+    return re.search(r'name="csrf-token" content="([^"]+)"', index.text).group(1)
+
+
+async def one_stream(client, headers, conv_id, model, state):
+    started = time.perf_counter()
+    first_byte = None
+    size = 0
+    async with client.stream(
+        "POST", f"/api/conversations/{conv_id}/messages/stream",
+        json={"content": "benchmark", "model": model}, headers=headers,
+    ) as resp:
+        if resp.status_code != 200:
+            return None
+        state["open"] += 1
+        state["peak"] = max(state["peak"], state["open"])
+        try:
+            async for chunk in resp.aiter_bytes():
+                if first_byte is None:
+                    first_byte = time.perf_counter() - started
+                size += len(chunk)
+        finally:
+            state["open"] -= 1
+    return first_byte, time.perf_counter() - started, size
+
+
+async def run(args):
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    timeout = httpx.Timeout(args.timeout)
+    async with httpx.AsyncClient(base_url=args.url, limits=limits, timeout=timeout,
+                                 follow_redirects=True) as client:
+        csrf = await login(client, args.username, args.password)
+        headers = {"X-CSRFToken": csrf}
+        conv = await client.post("/api/conversations", headers=headers)
+        conv_id = conv.json()["id"]
+
+        state = {"open": 0, "peak": 0}
+        started = time.perf_counter()
+        results = await asyncio.gather(
+            *(one_stream(client, headers, conv_id, args.model, state) for _ in range(args.concurrency)),
+            return_exceptions=True,
+        )
+        wall = time.perf_counter() - started
+
+    ok = [r for r in results if isinstance(r, tuple) and r[0] is not None]
+    failed = len(results) - len(ok)
+    print(f"URL:                 {args.url}")
+    print(f"Streams lanzados:    {args.concurrency}")
+    print(f"Completados / fallos: {len(ok)} / {failed}")
+    print(f"Pico de concurrentes: {state['peak']}")
+    print(f"Tiempo total:        {wall:.2f}s")
+    if ok:
+        ttfb = sorted(r[0] for r in ok)
+        total = sorted(r[1] for r in ok)
+        p95 = lambda xs: xs[min(len(xs) - 1, int(len(xs) * 0.95))]
+        print(f"TTFB p50 / p95:      {statistics.median(ttfb):.2f}s / {p95(ttfb):.2f}s")
+        print(f"Duración p50 / p95:  {statistics.median(total):.2f}s / {p95(total):.2f}s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default="http://127.0.0.1:5002")
+    parser.add_argument("--username", required=True)
+    parser.add_argument("--password", required=True)
+    parser.add_argument("--model", default="gpt-4.1-mini-2025-04-14")
+    parser.add_argument("--concurrency", type=int, default=100)
+    parser.add_argument("--timeout", type=float, default=300)
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
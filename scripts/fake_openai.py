@@ -0,0 +1,294 @@
+# scripts/fake_openai.py
+"""
+Servidor OpenAI falso para benchmarks y pruebas locales.
+
+Emula lo justo de la API que usa la app:
+  - POST /v1/chat/completions   (con y sin stream)
+  - POST /v1/responses          (con y sin stream)
+  - POST /v1/files, GET /v1/files/{id}/content
+  - POST /v1/batches, GET /v1/batches[/{id}], POST /v1/batches/{id}/cancel
+
+Cada chunk de un stream se emite tras `--delay` segundos, así que un stream
+dura aproximadamente `--chunks * --delay`.
+
+Para probar reintentos, timeouts y circuit breaker:
+  --fail-rate 0.3 --fail-status 503   un 30% de peticiones responde 503
+  --first-token-delay 40              espera antes del primer chunk
+
+Los batches avanzan con el tiempo: cada uno tarda `--batch-duration` segundos
+en completarse y sus peticiones se van dando por hechas de forma lineal.
+
+Uso:
+    python scripts/fake_openai.py --port 9100 --chunks 50 --delay 0.1
+    export OPENAI_BASE_URL=http://127.0.0.1:9100/v1
+"""
+import argparse
+import itertools
+import json
+import random
+import threading
+import time
+from email import policy
+from email.parser import BytesParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class FakeOpenAIHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    chunks = 50
+    delay = 0.1
+    fail_rate = 0.0
+    fail_status = 503
+    first_token_delay = 0.0
+    batch_duration = 30.0
+    # Estado compartido por todas las conexiones
+    files = {}
+    batches = {}
+    ids = itertools.count(1)
+    state_lock = threading.RLock()
+
+    def log_message(self, fmt, *args):
+        pass
+
+    def _read_json(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        return json.loads(self.rfile.read(length) or b"{}")
+
+    def _send_json(self, status, body):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _start_sse(self):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+    def _sse(self, payload):
+        data = ("data: %s\n\n" % payload).encode("utf-8")
+        self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+        self.wfile.flush()
+
+    def _end_sse(self):
+        self._sse("[DONE]")
+        self.wfile.write(b"0\r\n\r\n")
+        self.wfile.flush()
+
+    def _not_found(self):
+        self._send_json(404, {"error": {"message": "not found", "type": "invalid_request_error"}})
+
+    def do_GET(self):
+        path = self.path.split("?")[0].rstrip("/")
+        parts = path.split("/")
+        if path.endswith("/batches"):
+            with self.state_lock:
+                data = [self._batch_view(b) for b in reversed(list(self.batches.values()))][:100]
+            return self._send_json(200, {"object": "list", "data": data, "has_more": False,
+                                         "first_id": data[0]["id"] if data else None,
+                                         "last_id": data[-1]["id"] if data else None})
+        if len(parts) >= 2 and parts[-2] == "batches":
+            with self.state_lock:
+                batch = self.batches.get(parts[-1])
+                view = self._batch_view(batch) if batch else None
+            return self._send_json(200, view) if view else self._not_found()
+        if path.endswith("/content") and parts[-3] == "files":
+            entry = self.files.get(parts[-2])
+            if entry is None:
+                return self._not_found()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/octet-stream")
+            self.send_header("Content-Length", str(len(entry["data"])))
+            self.end_headers()
+            return self.wfile.write(entry["data"])
+        # Warm-up del cliente (GET /v1/models)
+        self._send_json(200, {"object": "list", "data": []})
+
+    def do_POST(self):
+        if random.random() < self.fail_rate:
+            self.rfile.read(int(self.headers.get("Content-Length") or 0))
+            return self._send_json(self.fail_status, {"error": {
+                "message": "fallo inyectado", "type": "server_error", "code": None}})
+        if self.path.endswith("/files"):
+            return self._upload()
+        body = self._read_json()
+        if self.path.endswith("/batches"):
+            return self._create_batch(body)
+        if self.path.endswith("/cancel"):
+            return self._cancel_batch(self.path.split("/")[-2])
+        model = body.get("model", "fake")
+        time.sleep(self.first_token_delay)
+        if self.path.endswith("/chat/completions"):
+            return self._chat(model, body)
+        if self.path.endswith("/responses"):
+            return self._responses(model, body)
+        self._not_found()
+
+    # --- Ficheros y batches ---
+
+    def _new_id(self, prefix):
+        return f"{prefix}_fake{next(self.ids)}"
+
+    def _store_file(self, data, filename, purpose):
+        file_id = self._new_id("file")
+        entry = {"id": file_id, "object": "file", "bytes": len(data), "created_at": int(time.time()),
+                 "filename": filename, "purpose": purpose, "status": "processed"}
+        with self.state_lock:
+            self.files[file_id] = dict(entry, data=data)
+        return entry
+
+    def _upload(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        raw = b"Content-Type: " + self.headers["Content-Type"].encode("latin-1") + b"\r\n\r\n" \
+            + self.rfile.read(length)
+        form = BytesParser(policy=policy.HTTP).parsebytes(raw)
+        data, filename, purpose = b"", "upload.jsonl", "batch"
+        for part in form.iter_parts():
+            name = part.get_param("name", header="content-disposition")
+            if name == "file":
+                data = part.get_payload(decode=True) or b""
+                filename = part.get_filename() or filename
+            elif name == "purpose":
+                purpose = (part.get_payload(decode=True) or b"batch").decode()
+        self._send_json(200, self._store_file(data, filename, purpose))
+
+    def _create_batch(self, body):
+        entry = self.files.get(body.get("input_file_id"))
+        if entry is None:
+            return self._send_json(400, {"error": {"message": "input_file_id desconocido",
+                                                   "type": "invalid_request_error"}})
+        requests = [json.loads(line) for line in entry["data"].splitlines() if line.strip()]
+        batch = {
+            "id": self._new_id("batch"), "object": "batch", "endpoint": body.get("endpoint"),
+            "input_file_id": entry["id"], "completion_window": body.get("completion_window", "24h"),
+            "created_at": int(time.time()), "metadata": body.get("metadata"),
+            "status": "in_progress", "output_file_id": None, "error_file_id": None,
+            "errors": None, "requests": requests, "started": time.monotonic(),
+        }
+        with self.state_lock:
+            self.batches[batch["id"]] = batch
+            view = self._batch_view(batch)
+        self._send_json(200, view)
+
+    def _cancel_batch(self, batch_id):
+        with self.state_lock:
+            batch = self.batches.get(batch_id)
+            if batch is None:
+                return self._not_found()
+            self._batch_view(batch)   # puede haberse completado ya
+            if batch["status"] == "in_progress":
+                self._finish_batch(batch, "cancelled")
+            view = self._batch_view(batch)
+        self._send_json(200, view)
+
+    def _done(self, batch):
+        if batch["status"] != "in_progress":
+            return batch["done"]
+        elapsed = time.monotonic() - batch["started"]
+        total = len(batch["requests"])
+        return total if elapsed >= self.batch_duration else int(total * elapsed / self.batch_duration)
+
+    def _finish_batch(self, batch, status):
+        done = self._done(batch)
+        lines = []
+        for request in batch["requests"][:done]:
+            body = self._response_body(request.get("body", {}).get("model", "fake"))
+            lines.append(json.dumps({"id": self._new_id("batch_req"), "custom_id": request["custom_id"],
+                                     "response": {"status_code": 200, "request_id": "req_fake",
+                                                  "body": body},
+                                     "error": None}))
+        batch["done"] = done
+        batch["status"] = status
+        if lines:
+            data = ("\n".join(lines) + "\n").encode("utf-8")
+            batch["output_file_id"] = self._store_file(data, "output.jsonl", "batch_output")["id"]
+
+    def _batch_view(self, batch):
+        """Objeto Batch de la API; completa el batch si ya ha pasado su duración."""
+        done = self._done(batch)
+        if batch["status"] == "in_progress" and done == len(batch["requests"]):
+            self._finish_batch(batch, "completed")
+        view = {k: v for k, v in batch.items() if k not in ("requests", "started", "done")}
+        view["request_counts"] = {"total": len(batch["requests"]), "completed": done, "failed": 0}
+        return view
+
+    def _chat(self, model, body):
+        if not body.get("stream"):
+            text = "tok " * self.chunks
+            return self._send_json(200, {
+                "id": "chatcmpl-fake", "object": "chat.completion", "created": int(time.time()),
+                "model": model,
+                "choices": [{"index": 0, "finish_reason": "stop",
+                             "message": {"role": "assistant", "content": text}}],
+                "usage": {"prompt_tokens": 10, "completion_tokens": self.chunks,
+                          "total_tokens": 10 + self.chunks},
+            })
+        self._start_sse()
+        for _ in range(self.chunks):
+            time.sleep(self.delay)
+            self._sse(json.dumps({
+                "id": "chatcmpl-fake", "object": "chat.completion.chunk",
+                "created": int(time.time()), "model": model,
+                "choices": [{"index": 0, "delta": {"content": "tok "}, "finish_reason": None}],
+            }))
+        self._end_sse()
+
+    def _response_body(self, model):
+        text = "tok " * self.chunks
+        return {
+            "id": "resp_fake", "object": "response", "created_at": int(time.time()),
+            "model": model, "status": "completed", "incomplete_details": None,
+            "output": [{"type": "message", "id": "msg_fake", "status": "completed",
+                        "role": "assistant",
+                        "content": [{"type": "output_text", "text": text, "annotations": []}]}],
+            "usage": {"input_tokens": 10, "output_tokens": self.chunks, "total_tokens": 10 + self.chunks,
+                      "input_tokens_details": {"cached_tokens": 0},
+                      "output_tokens_details": {"reasoning_tokens": 0}},
+            "parallel_tool_calls": False, "tool_choice": "auto", "tools": [],
+        }
+
+    def _responses(self, model, body):
+        response = self._response_body(model)
+        if not body.get("stream"):
+            time.sleep(self.delay * self.chunks)
+            return self._send_json(200, response)
+        self._start_sse()
+        for i in range(self.chunks):
+            time.sleep(self.delay)
+            self._sse(json.dumps({"type": "response.output_text.delta", "item_id": "msg_fake",
+                                  "output_index": 0, "content_index": 0,
+                                  "sequence_number": i, "delta": "tok "}))
+        self._sse(json.dumps({"type": "response.completed", "sequence_number": self.chunks,
+                              "response": response}))
+        self._end_sse()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9100)
+    parser.add_argument("--chunks", type=int, default=50)
+    parser.add_argument("--delay", type=float, default=0.1)
+    parser.add_argument("--fail-rate", type=float, default=0.0)
+    parser.add_argument("--fail-status", type=int, default=503)
+    parser.add_argument("--first-token-delay", type=float, default=0.0)
+    parser.add_argument("--batch-duration", type=float, default=30.0)
+    args = parser.parse_args()
+
+    FakeOpenAIHandler.chunks = args.chunks
+    FakeOpenAIHandler.delay = args.delay
+    FakeOpenAIHandler.fail_rate = args.fail_rate
+    FakeOpenAIHandler.fail_status = args.fail_status
+    FakeOpenAIHandler.first_token_delay = args.first_token_delay
+    FakeOpenAIHandler.batch_duration = args.batch_duration
+    server = ThreadingHTTPServer((args.host, args.port), FakeOpenAIHandler)
+    server.daemon_threads = True
+    print(f"Fake OpenAI escuchando en http://{args.host}:{args.port}/v1")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,173 @@
+# search.py
+"""
+Búsqueda de texto completo en los mensajes de un usuario.
+
+- PostgreSQL: columna generada `messages.search_vector` (tsvector) con índice
+  GIN. La columna se recalcula en cada escritura de `content`, también en los
+  checkpoints del streaming. Ranking con ts_rank_cd y fragmentos con
+  ts_headline, que solo se calculan para las filas de la página.
+- SQLite (TestingConfig / desarrollo): tabla FTS5 `messages_fts` de contenido
+  externo, mantenida con triggers. Ranking con bm25 y fragmentos con snippet().
+
+Ambas las crea la migración b1d4f8a26c37; la de SQLite también
+db.create_all() (models.py). Los mensajes archivados
+(message_archive.py) siguen indexados, pero su `content` está vacío: su
+fragmento se arma aquí tras descomprimir el texto. Por lo mismo, un 'rebuild'
+de messages_fts los dejaría sin términos: hay que usar
+`flask archive-messages --rebuild-search`. La paginación es por cursor sobre
+(puntuación, id). Los fragmentos llegan con el texto escapado y las
+coincidencias marcadas con <mark>.
+"""
+import re
+
+from markupsafe import escape
+from sqlalchemy import select, text
+
+from models import db, Message, RoleEnum
+from pagination import encode_cursor
+from message_archive import TEXT_COLUMNS, message_text
+
+# Configuración de texto de PostgreSQL: sin stemming, sirve igual para
+# español, inglés y código. Debe coincidir con la de la migración.
+TS_CONFIG = "simple"
+
+# Delimitadores de las coincidencias en los fragmentos; se sustituyen por
+# <mark> después de escapar el texto
+_START, _STOP = "\x01", "\x02"
+
+_WORD = re.compile(r"\w+", re.UNICODE)
+
+# Caracteres a cada lado de la primera coincidencia en fragmentos de archivados
+EXCERPT_CONTEXT = 120
+
+_PG_SEARCH = f"""
+    WITH q AS (SELECT websearch_to_tsquery('{TS_CONFIG}', :q) AS query),
+    hits AS (
+        SELECT m.id, m.conversation_id, m.turn_index, m.role, c.title,
+               m.content_archive IS NOT NULL AS archived,
+               ts_rank_cd(m.search_vector, q.query) AS score
+        FROM q, messages m
+        JOIN conversations c ON c.id = m.conversation_id
+        WHERE c.user_id = :user_id
+          AND m.role != :system
+          AND m.search_vector @@ q.query
+    ),
+    page AS (
+        SELECT * FROM hits
+        WHERE :after_score IS NULL
+           OR (score, id) < (CAST(:after_score AS real), :after_id)
+        ORDER BY score DESC, id DESC
+        LIMIT :limit
+    )
+    SELECT page.*,
+           ts_headline('{TS_CONFIG}', m.content, q.query,
+                       'StartSel={_START}, StopSel={_STOP}, MaxFragments=2, MaxWords=24, MinWords=8') AS snippet
+    FROM page JOIN messages m ON m.id = page.id, q
+    ORDER BY page.score DESC, page.id DESC
+"""
+
+_SQLITE_SEARCH = f"""
+    WITH hits AS (
+        SELECT m.id, m.conversation_id, m.turn_index, m.role, c.title,
+               m.content_archive IS NOT NULL AS archived,
+               -bm25(messages_fts) AS score,
+               snippet(messages_fts, 0, '{_START}', '{_STOP}', '…', 24) AS snippet
+        FROM messages_fts
+        JOIN messages m ON m.id = messages_fts.rowid
+        JOIN conversations c ON c.id = m.conversation_id
+        WHERE messages_fts MATCH :q
+          AND c.user_id = :user_id
+          AND m.role != :system
+    )
+    SELECT * FROM hits
+    WHERE :after_score IS NULL
+       OR score < :after_score
+       OR (score = :after_score AND id < :after_id)
+    ORDER BY score DESC, id DESC
+    LIMIT :limit
+"""
+
+
+def fts5_query(query):
+    """
+    Consulta FTS5 a partir de texto libre: todas las palabras (AND), la
+    última como prefijo. Evita errores de sintaxis con comillas u operadores.
+    """
+    words = _WORD.findall(query)
+    if not words:
+        return None
+    terms = [f'"{w}"' for w in words[:-1]] + [f'"{words[-1]}"*']
+    return " ".join(terms)
+
+
+def highlight(snippet):
+    """Escapa el fragmento y marca las coincidencias con <mark>."""
+    html = str(escape(snippet or ""))
+    return html.replace(_START, "<mark>").replace(_STOP, "</mark>")
+
+
+def _excerpt(content, query):
+    """Fragmento alrededor de la primera coincidencia, con las palabras marcadas."""
+    words = [w for w in _WORD.findall(query) if len(w) > 1]
+    pattern = re.compile("|".join(re.escape(w) for w in words), re.IGNORECASE) if words else None
+    match = pattern.search(content) if pattern else None
+    start = max((match.start() if match else 0) - EXCERPT_CONTEXT, 0)
+    piece = content[start:start + 2 * EXCERPT_CONTEXT]
+    if pattern:
+        piece = pattern.sub(lambda m: f"{_START}{m.group(0)}{_STOP}", piece)
+    return ("…" if start else "") + piece + ("…" if start + 2 * EXCERPT_CONTEXT < len(content) else "")
+
+
+def _archived_snippets(rows, query):
+    """Fragmentos de las filas de la página cuyo texto está archivado."""
+    # No basta con mirar si el fragmento está vacío: snippet() de SQLite
+    # devuelve "……" para un `content` vacío
+    ids = [r.id for r in rows if r.archived]
+    if not ids:
+        return {}
+    archived = db.session.execute(
+        select(Message.id, *TEXT_COLUMNS).where(Message.id.in_(ids))
+    ).all()
+    return {r.id: _excerpt(message_text(r), query) for r in archived}
+
+
+def search_messages(user_id, query, limit, after=None):
+    """
+    Mensajes del usuario que coinciden con `query`, de más a menos relevante.
+    `after` es (puntuación, id) de la última fila de la página anterior.
+    """
+    dialect = db.engine.dialect.name
+    if dialect == "sqlite":
+        sql, q = _SQLITE_SEARCH, fts5_query(query)
+        if q is None:
+            return {"items": [], "next_cursor": None}
+    else:
+        sql, q = _PG_SEARCH, query
+
+    after_score, after_id = after if after else (None, None)
+    rows = db.session.execute(text(sql), {
+        "q": q,
+        "user_id": user_id,
+        "system": RoleEnum.system.name,
+        "after_score": after_score,
+        "after_id": after_id,
+        "limit": limit + 1,
+    }).all()
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(rows[-1].score, rows[-1].id)
+    snippets = _archived_snippets(rows, query)
+    return {
+        "items": [{
+            "message_id": r.id,
+            "conversation_id": r.conversation_id,
+            "conversation_title": r.title,
+            "turn_index": r.turn_index,
+            "role": RoleEnum[r.role].value,
+            "snippet": highlight(snippets.get(r.id, r.snippet)),
+            "score": r.score,
+        } for r in rows],
+        "next_cursor": next_cursor,
+    }
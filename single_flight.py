@@ -0,0 +1,238 @@
+# single_flight.py
+"""
+Coalescencia de peticiones idénticas en vuelo para /api/ask.
+
+Si llegan a la vez N peticiones con la misma clave (modelo + mensajes
+normalizados + parámetros, ver `response_cache.cache_key`), solo una llama a
+OpenAI; el resto espera y recibe el mismo resultado.
+
+- Dentro del proceso: un evento (hilos) o un Future (event loop) por clave.
+- Entre workers de la máquina: un lock por clave en un fichero SQLite
+  compartido (local_store). El líder deja el resultado unos segundos en una
+  tabla de traspaso para quien estuviera esperando en otro worker.
+
+No es una caché: el resultado solo se comparte con quien esperaba mientras
+la llamada estaba en curso. Si el almacén compartido falla se sigue sin
+coalescer entre workers.
+"""
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+from local_store import LocalStore
+
+logger = logging.getLogger(__name__)
+
+
+class _Call:
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    SCHEMA = (
+        """CREATE TABLE IF NOT EXISTS inflight (
+            key TEXT PRIMARY KEY,
+            owner TEXT NOT NULL,
+            started REAL NOT NULL
+        )""",
+        """CREATE TABLE IF NOT EXISTS inflight_results (
+            key TEXT PRIMARY KEY,
+            value TEXT NOT NULL,
+            expires_at REAL NOT NULL
+        )""",
+    )
+
+    def __init__(self, path=None, wait_timeout=120.0, result_ttl=10.0, poll_interval=0.05):
+        # Sin path solo se coalesce dentro del proceso
+        self.store = LocalStore(path, self.SCHEMA) if path else None
+        self.wait_timeout = wait_timeout
+        self.result_ttl = result_ttl
+        self.poll_interval = poll_interval
+        self._calls = {}
+        self._futures = {}
+        self._lock = threading.Lock()
+
+    # --- Síncrono (vistas Flask) ---
+
+    def do(self, key, fn):
+        """
+        Ejecuta `fn()` una sola vez por clave entre las llamadas concurrentes.
+        Devuelve (resultado, coalesced); coalesced=True si otro hizo la llamada.
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+        if not leader:
+            if not call.event.wait(self.wait_timeout):
+                return fn(), False
+            if call.error is not None:
+                raise call.error
+            return call.result, True
+
+        try:
+            call.result, coalesced = self._lead(key, fn)
+            return call.result, coalesced
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.event.set()
+
+    def _lead(self, key, fn):
+        deadline = time.monotonic() + self.wait_timeout
+        while True:
+            state = self._acquire(key)
+            if state is None:
+                return fn(), False
+            if state == "locked":
+                try:
+                    result = fn()
+                except Exception:
+                    self._release(key, None)
+                    raise
+                self._release(key, result)
+                return result, False
+            # Otro worker tiene la llamada en curso
+            while time.monotonic() < deadline:
+                time.sleep(self.poll_interval)
+                state, value = self._poll(key)
+                if state == "done":
+                    return value, True
+                if state == "missing":
+                    break   # el líder falló: se intenta ser líder
+            else:
+                return fn(), False
+
+    # --- Asíncrono (modo ASGI; los futures viven en el hilo del event loop) ---
+
+    async def do_async(self, key, coro_fn):
+        while True:
+            future = self._futures.get(key)
+            if future is None:
+                break
+            try:
+                return await asyncio.shield(future), True
+            except asyncio.CancelledError:
+                if not future.cancelled() or asyncio.current_task().cancelling():
+                    raise   # se canceló esta petición
+                # Se canceló la petición del líder: los que esperaban no se
+                # quedan sin respuesta, uno pasa a ser el nuevo líder
+
+        future = asyncio.get_running_loop().create_future()
+        self._futures[key] = future
+        try:
+            result, coalesced = await self._lead_async(key, coro_fn)
+            future.set_result(result)
+            return result, coalesced
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            # Evita "Future exception was never retrieved" si nadie esperaba
+            future.exception()
+            raise
+        finally:
+            del self._futures[key]
+
+    async def _lead_async(self, key, coro_fn):
+        if self.store is None:
+            return await coro_fn(), False
+        # El almacén es SQLite síncrono (BEGIN IMMEDIATE puede esperar hasta
+        # busy_timeout): sus llamadas van a un hilo para no parar el event loop
+        deadline = time.monotonic() + self.wait_timeout
+        while True:
+            state = await asyncio.to_thread(self._acquire, key)
+            if state is None:
+                return await coro_fn(), False
+            if state == "locked":
+                try:
+                    result = await coro_fn()
+                except BaseException:
+                    await asyncio.shield(asyncio.to_thread(self._release, key, None))
+                    raise
+                await asyncio.shield(asyncio.to_thread(self._release, key, result))
+                return result, False
+            while time.monotonic() < deadline:
+                await asyncio.sleep(self.poll_interval)
+                state, value = await asyncio.to_thread(self._poll, key)
+                if state == "done":
+                    return value, True
+                if state == "missing":
+                    break
+            else:
+                return await coro_fn(), False
+
+    # --- Almacén compartido entre workers ---
+
+    def _acquire(self, key):
+        """"locked" si este proceso es el líder, "busy" si lo es otro, None sin almacén."""
+        if self.store is None:
+            return None
+        now = time.time()
+        try:
+            with self.store.transaction() as conn:
+                # Un líder que murió sin liberar no bloquea más allá del timeout
+                conn.execute("DELETE FROM inflight WHERE key = ? AND started < ?",
+                             (key, now - self.wait_timeout))
+                cur = conn.execute("INSERT OR IGNORE INTO inflight (key, owner, started) VALUES (?, ?, ?)",
+                                   (key, str(os.getpid()), now))
+                if cur.rowcount != 1:
+                    return "busy"
+                # Resultado de una llamada anterior con la misma clave: ya no vale
+                conn.execute("DELETE FROM inflight_results WHERE key = ?", (key,))
+                return "locked"
+        except sqlite3.Error as e:
+            logger.warning(f"Single-flight store unavailable: {e}")
+            return None
+
+    def _release(self, key, result):
+        now = time.time()
+        try:
+            with self.store.transaction() as conn:
+                if result is not None:
+                    conn.execute(
+                        "INSERT OR REPLACE INTO inflight_results (key, value, expires_at) VALUES (?, ?, ?)",
+                        (key, json.dumps(result, ensure_ascii=False), now + self.result_ttl),
+                    )
+                conn.execute("DELETE FROM inflight WHERE key = ?", (key,))
+                conn.execute("DELETE FROM inflight_results WHERE expires_at <= ?", (now,))
+        except sqlite3.Error as e:
+            logger.warning(f"Single-flight release failed: {e}")
+
+    def _poll(self, key):
+        """("running", None), ("done", resultado) o ("missing", None)."""
+        try:
+            if self.store.execute("SELECT 1 FROM inflight WHERE key = ?", (key,)).fetchone():
+                return "running", None
+            row = self.store.execute(
+                "SELECT value FROM inflight_results WHERE key = ? AND expires_at > ?", (key, time.time())
+            ).fetchone()
+        except sqlite3.Error as e:
+            logger.warning(f"Single-flight poll failed: {e}")
+            return "missing", None
+        if row is None:
+            return "missing", None
+        return "done", json.loads(row[0])
+
+
+def init_single_flight(app):
+    flight = None
+    if app.config.get("SINGLE_FLIGHT_ENABLED", True):
+        flight = SingleFlight(
+            path=app.config.get("SINGLE_FLIGHT_PATH") or None,
+            wait_timeout=app.config.get("SINGLE_FLIGHT_TIMEOUT", 120),
+        )
+    app.extensions["single_flight"] = flight
+    return flight
@@ -0,0 +1,175 @@
+# sql_profiler.py
+"""
+Perfilador de SQL por petición, basado en los eventos de SQLAlchemy.
+
+Con SQL_PROFILER_ENABLED se escuchan before/after_cursor_execute en los
+engines de la aplicación y, por petición:
+
+- se cuentan las sentencias y el tiempo de BD;
+- se agrupan por forma (el SQL con literales y listas IN normalizados); una
+  forma que se repite SQL_PROFILER_REPEAT_THRESHOLD veces o más se avisa
+  como posible N+1 (p. ej. `conv.messages` cargado en un bucle);
+- las sentencias de más de SQL_PROFILER_SLOW_MS se registran, dentro o fuera
+  de una petición, con los parámetros sustituidos por su tipo y longitud.
+
+Con SQL_PROFILER_HEADER los admins reciben los totales en la cabecera
+X-SQL-Profile. La cabecera se calcula en after_request, así que en streams
+solo cuenta hasta las cabeceras; el aviso de N+1 se emite en el teardown y
+cubre también el cuerpo del stream (stream_with_context).
+
+Desactivado no se registra ningún listener: coste cero.
+"""
+import logging
+import re
+import time
+from collections import Counter
+from functools import lru_cache
+
+from flask import g, has_request_context, request
+from flask_login import current_user
+from sqlalchemy import event
+
+from models import db
+
+logger = logging.getLogger(__name__)
+
+# Formas distintas que se guardan por petición (una petición patológica no
+# debe crecer sin límite)
+MAX_SHAPES = 500
+
+_STRING = re.compile(r"'(?:[^']|'')*'")
+_NUMBER = re.compile(r"\b\d+(?:\.\d+)?\b")
+_PLACEHOLDER = re.compile(r"\?|%\(\w+\)s|%s|:\w+|\$\d+")
+_IN_LIST = re.compile(r"\(\s*\?(?:\s*,\s*\?)+\s*\)")
+_SPACES = re.compile(r"\s+")
+
+
+@lru_cache(maxsize=2048)
+def statement_shape(statement):
+    """SQL normalizado: literales y parámetros como ?, listas IN como (?...)."""
+    shape = _STRING.sub("?", statement)
+    shape = _PLACEHOLDER.sub("?", shape)
+    shape = _NUMBER.sub("?", shape)
+    shape = _IN_LIST.sub("(?...)", shape)
+    return _SPACES.sub(" ", shape).strip()
+
+
+def _redact_value(value):
+    if value is None:
+        return None
+    if isinstance(value, (str, bytes, bytearray, memoryview)):
+        return f"<{type(value).__name__} len={len(value)}>"
+    return f"<{type(value).__name__}>"
+
+
+def redact(parameters):
+    """Parámetros con cada valor sustituido por su tipo (y longitud)."""
+    if isinstance(parameters, dict):
+        return {k: _redact_value(v) for k, v in parameters.items()}
+    if isinstance(parameters, (list, tuple)):
+        if parameters and isinstance(parameters[0], (dict, list, tuple)):
+            # executemany: la primera fila basta para ver la forma
+            return [redact(parameters[0]), f"... {len(parameters)} filas"]
+        return [_redact_value(v) for v in parameters]
+    return _redact_value(parameters)
+
+
+class RequestProfile:
+    __slots__ = ("queries", "seconds", "shapes")
+
+    def __init__(self):
+        self.queries = 0
+        self.seconds = 0.0
+        self.shapes = Counter()   # sentencia -> apariciones
+
+    def add(self, statement, seconds):
+        self.queries += 1
+        self.seconds += seconds
+        if statement in self.shapes or len(self.shapes) < MAX_SHAPES:
+            self.shapes[statement] += 1
+
+    def repeated(self, threshold):
+        """[(forma, apariciones)] de las sentencias repetidas, más frecuentes primero."""
+        counts = Counter()
+        for statement, n in self.shapes.items():
+            counts[statement_shape(statement)] += n
+        return [(shape, n) for shape, n in counts.most_common() if n >= threshold]
+
+
+class SQLProfiler:
+    def __init__(self, slow_ms=100.0, repeat_threshold=5, header=False):
+        self.slow_seconds = slow_ms / 1000
+        self.repeat_threshold = repeat_threshold
+        self.header = header
+
+    def attach(self, engine):
+        event.listen(engine, "before_cursor_execute", self._before)
+        event.listen(engine, "after_cursor_execute", self._after)
+        event.listen(engine, "handle_error", self._error)
+
+    def _before(self, conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("sql_profiler_started", []).append(time.perf_counter())
+
+    def _after(self, conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info["sql_profiler_started"].pop()
+        in_request = has_request_context()
+        if in_request:
+            profile = g.get("sql_profile")
+            if profile is None:
+                profile = g.sql_profile = RequestProfile()
+            profile.add(statement, elapsed)
+        if elapsed >= self.slow_seconds:
+            logger.warning(
+                "SQL lenta (%.1f ms)%s: %s | parámetros: %s",
+                elapsed * 1000,
+                f" en {request.method} {request.path}" if in_request else "",
+                _SPACES.sub(" ", statement).strip(), redact(parameters))
+
+    def _error(self, exc_context):
+        # La sentencia falló: after_cursor_execute no llega a ejecutarse
+        conn = exc_context.connection
+        started = conn.info.get("sql_profiler_started") if conn is not None else None
+        if started:
+            started.pop()
+
+    def add_header(self, response):
+        profile = g.get("sql_profile")
+        if profile is not None and current_user.is_authenticated and current_user.is_admin:
+            repeated = profile.repeated(self.repeat_threshold)
+            response.headers["X-SQL-Profile"] = (
+                f"queries={profile.queries}; time_ms={profile.seconds * 1000:.1f}; "
+                f"repeated={len(repeated)}")
+        return response
+
+    def report(self, exc=None):
+        profile = g.pop("sql_profile", None)
+        if profile is None:
+            return
+        repeated = profile.repeated(self.repeat_threshold)
+        summary = (f"{request.method} {request.path}: {profile.queries} consultas SQL, "
+                   f"{profile.seconds * 1000:.1f} ms")
+        if not repeated:
+            logger.debug(summary)
+            return
+        logger.warning("Posible N+1 en %s; repetidas: %s", summary,
+                       "; ".join(f"{n}x {shape}" for shape, n in repeated[:5]))
+
+
+def init_sql_profiler(app):
+    """Después de db.init_app. Devuelve el perfilador, o None si está desactivado."""
+    if not app.config.get("SQL_PROFILER_ENABLED", False):
+        app.extensions["sql_profiler"] = None
+        return None
+    profiler = SQLProfiler(
+        slow_ms=app.config.get("SQL_PROFILER_SLOW_MS", 100),
+        repeat_threshold=app.config.get("SQL_PROFILER_REPEAT_THRESHOLD", 5),
+        header=app.config.get("SQL_PROFILER_HEADER", False),
+    )
+    with app.app_context():
+        for engine in db.engines.values():
+            profiler.attach(engine)
+    if profiler.header:
+        app.after_request(profiler.add_header)
+    app.teardown_request(profiler.report)
+    app.extensions["sql_profiler"] = profiler
+    return profiler
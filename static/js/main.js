@@ -16,9 +16,45 @@ const SYSTEM_MESSAGE_CONTENT = "Eres un asistente de programación muy hábil. R
 
 let conversations = [];            // Array of { id, title, created_at } from the backend
 let currentConvId = null;          // ID of the active conversation
+let nextConvCursor = null;         // Cursor of the next page of conversations (null = no more)
 
 // --- Helpers for interacting with the Backend ---
 
+const STREAM_MAX_RETRIES = 5;        // Reconexiones del stream SSE antes de rendirse
+
+/**
+ * Reads a Server-Sent Events body and calls onEvent({ id, event, data })
+ * for each event (data is parsed as JSON). Comment lines are ignored.
+ * @param {Response} res - fetch response with a text/event-stream body.
+ * @param {Function} onEvent - Callback for each event.
+ */
+async function readSSE(res, onEvent) {
+  const reader = res.body.getReader();
+  const decoder = new TextDecoder("utf-8");
+  let buffer = "";
+  while (true) {
+    const { value, done } = await reader.read();
+    if (done) return;
+    buffer += decoder.decode(value, { stream: true });
+    let sep;
+    while ((sep = buffer.indexOf("\n\n")) !== -1) {
+      const raw = buffer.slice(0, sep);
+      buffer = buffer.slice(sep + 2);
+      const evt = { id: null, event: "message", data: "" };
+      for (const line of raw.split("\n")) {
+        if (!line || line.startsWith(":")) continue;
+        const idx = line.indexOf(":");
+        const field = line.slice(0, idx);
+        const val = line.slice(idx + 1).replace(/^ /, "");
+        if (field === "data") evt.data += val;
+        else if (field === "id") evt.id = val;
+        else if (field === "event") evt.event = val;
+      }
+      if (evt.data) onEvent({ ...evt, data: JSON.parse(evt.data) });
+    }
+  }
+}
+
 // Añade esta función justo antes de tu listener de sendBtn
 async function sendWithStream(convId, pregunta, model) {
   const csrfToken = document.querySelector('meta[name="csrf-token"]').getAttribute("content");
@@ -28,6 +64,7 @@ async function sendWithStream(convId, pregunta, model) {
       method: "POST",
       headers: { 
         "Content-Type": "application/json",
+        "Accept": "text/event-stream",
         "X-CSRFToken": csrfToken
       },
       body: JSON.stringify({ content: pregunta, model })
@@ -52,22 +89,53 @@ async function sendWithStream(convId, pregunta, model) {
   scrollToBottom();
   const streamDiv = streamingDiv;
 
-  // Leemos el body en chunks
-  const reader = res.body.getReader();
-  const decoder = new TextDecoder("utf-8");
   let fullText = "";
-  
-  while (true) {
-    const { value, done } = await reader.read();
-    if (done) break;
-    // 1) Acumulas el trozo
-    fullText += decoder.decode(value, { stream: true });
-    // 2) parseas TODO el markdown
-    const dirty = marked.parse(fullText);
-    streamDiv.innerHTML = DOMPurify.sanitize(dirty);
-    // 3) resaltas el código
-    hljs.highlightAll();
-    scrollToBottom();
+  let lastEventId = 0;      // offset del texto ya recibido (para Last-Event-ID)
+  let messageId = null;
+  let finished = false;
+
+  const onEvent = (evt) => {
+    if (evt.id !== null) lastEventId = parseInt(evt.id, 10) || lastEventId;
+    if (evt.event === "start") {
+      messageId = evt.data.message_id;
+    } else if (evt.event === "done") {
+      finished = true;
+      if (evt.data.status === "interrupted" || evt.data.truncated) {
+        botDiv.insertAdjacentHTML("beforeend", '<div class="text-muted small">[Respuesta incompleta]</div>');
+      }
+    } else if (evt.data.delta) {
+      // 1) Acumulas el trozo
+      fullText += evt.data.delta;
+      // 2) parseas TODO el markdown
+      const dirty = marked.parse(fullText);
+      streamDiv.innerHTML = DOMPurify.sanitize(dirty);
+      // 3) resaltas el código
+      hljs.highlightAll();
+      scrollToBottom();
+    }
+  };
+
+  // Si la conexión se corta, nos reenganchamos a la misma generación:
+  // el servidor sigue desde Last-Event-ID sin volver a llamar al modelo.
+  let response = res;
+  for (let attempt = 0; ; attempt++) {
+    if (response) {
+      try {
+        await readSSE(response, onEvent);
+      } catch (err) {
+        console.warn("Stream cortado, reintentando…", err);
+      }
+    }
+    if (finished) return;
+    if (messageId === null || attempt >= STREAM_MAX_RETRIES) {
+      throw new Error("Stream interrumpido");
+    }
+    await new Promise(resolve => setTimeout(resolve, 1000 * (attempt + 1)));
+    response = await fetch(
+      `/api/conversations/${convId}/messages/${messageId}/stream`,
+      { headers: { "Accept": "text/event-stream", "Last-Event-ID": String(lastEventId) } }
+    ).catch(() => null);
+    if (response && !response.ok) response = null;
   }
 }
 
@@ -78,6 +146,7 @@ async function loadConversations() {
   try {
     const response = await axios.get("/api/conversations");
     conversations = response.data;
+    nextConvCursor = response.headers["x-next-cursor"] || null;
     // Ensure titles are strings, handle potential nulls from DB if any
     conversations.forEach(conv => {
       conv.title = conv.title || "Sin título";
@@ -90,6 +159,25 @@ async function loadConversations() {
   }
 }
 
+/**
+ * Loads the next page of conversations (keyset cursor) and appends it to the sidebar.
+ */
+async function loadMoreConversations() {
+  if (!nextConvCursor) return;
+  try {
+    const response = await axios.get("/api/conversations", { params: { cursor: nextConvCursor } });
+    response.data.forEach(conv => {
+      conv.title = conv.title || "Sin título";
+      conversations.push(conv);
+    });
+    nextConvCursor = response.headers["x-next-cursor"] || null;
+    renderConversationList();
+  } catch (error) {
+    console.error("Error al cargar más conversaciones:", error);
+    document.getElementById("statusMsg").textContent = "Error al cargar más conversaciones.";
+  }
+}
+
 /**
  * Saves (updates the title of) a conversation in the backend.
  * @param {number} convId - The ID of the conversation to update.
@@ -216,6 +304,14 @@ function renderConversationList() {
     li.onclick = () => selectConversation(conv.id);
     ul.appendChild(li);
   });
+
+  if (nextConvCursor) {
+    const moreLi = document.createElement("li");
+    moreLi.className = "text-muted";
+    moreLi.textContent = "Cargar más…";
+    moreLi.onclick = loadMoreConversations;
+    ul.appendChild(moreLi);
+  }
 }
 
 /**
@@ -290,15 +386,9 @@ async function renderChat() {
         chatContainer.innerHTML = "<p class='text-muted text-center mt-5'>¡Hola! Soy tu asistente de programación. ¿En qué puedo ayudarte hoy?</p>";
     } else {
         history.filter(msg => msg.role !== "system").forEach(msg => { // Filter out system messages for display
-            const div = document.createElement("div");
-            div.classList.add("chat-message", msg.role === "user" ? "chat-user" : "chat-bot");
-            const who = msg.role === "user" ? "Tú" : "Asistente";
-            const content = msg.role === "assistant"
-              ? DOMPurify.sanitize(marked.parse(msg.content))
-              : msg.content;
-            div.innerHTML = `<strong>${who}:</strong> ${content}`;
-            chatContainer.appendChild(div);
+            chatContainer.appendChild(renderMessage(msg));
         });
+        addLoadOlderButton(response.headers["x-next-cursor"]);
     }
 
     scrollToBottom();
@@ -311,6 +401,55 @@ async function renderChat() {
   }
 }
 
+/**
+ * Builds the DOM node for a stored message.
+ * @param {object} msg - { role, content } as returned by the backend.
+ */
+function renderMessage(msg) {
+  const div = document.createElement("div");
+  div.classList.add("chat-message", msg.role === "user" ? "chat-user" : "chat-bot");
+  const who = msg.role === "user" ? "Tú" : "Asistente";
+  const content = msg.role === "assistant"
+    ? DOMPurify.sanitize(marked.parse(msg.content))
+    : msg.content;
+  div.innerHTML = `<strong>${who}:</strong> ${content}`;
+  if (msg.status === "interrupted") {
+    div.insertAdjacentHTML("beforeend", '<div class="text-muted small">[Respuesta interrumpida]</div>');
+  }
+  return div;
+}
+
+/**
+ * Adds a "load older messages" button at the top of the chat when the
+ * backend reports an older page (X-Next-Cursor).
+ * @param {string|undefined} cursor - Cursor of the older page.
+ */
+function addLoadOlderButton(cursor) {
+  if (!cursor) return;
+  const chatContainer = document.getElementById("chatContainer");
+  const convId = currentConvId;
+  const btn = document.createElement("button");
+  btn.className = "btn btn-sm btn-secondary w-100";
+  btn.textContent = "Cargar mensajes anteriores";
+  btn.onclick = async () => {
+    try {
+      const response = await axios.get(`/api/conversations/${convId}/messages`, { params: { cursor } });
+      if (convId !== currentConvId) return;
+      btn.remove();
+      const firstChild = chatContainer.firstChild;
+      response.data.filter(msg => msg.role !== "system").forEach(msg => {
+        chatContainer.insertBefore(renderMessage(msg), firstChild);
+      });
+      addLoadOlderButton(response.headers["x-next-cursor"]);
+      hljs.highlightAll();
+    } catch (error) {
+      console.error("Error al cargar mensajes anteriores:", error);
+      document.getElementById("statusMsg").textContent = "Error al cargar mensajes anteriores.";
+    }
+  };
+  chatContainer.insertBefore(btn, chatContainer.firstChild);
+}
+
 /**
  * Scrolls the chat container to the bottom.
  */
@@ -389,15 +528,9 @@ document.addEventListener("DOMContentLoaded", async () => {
     const tokens = countTokens(text);
     tokenCountSpan.textContent = tokens;
 
-    // Set token limit based on selected model
-    const model = modelSelect.value;
-    // Hardcoded limits for demo; ideally fetch from backend or config
-    const modelLimits = {
-      "chatgpt-4o-latest": 8192,
-      "o4-mini": 2048,
-      "chatgpt-3.5-turbo": 4096
-    };
-    const limit = modelLimits[model] || 4096;
+    // Token limit of the selected model (context_window from allowed_models.json)
+    const option = modelSelect.selectedOptions[0];
+    const limit = parseInt(option && option.dataset.contextWindow, 10) || 4096;
     tokenLimitSpan.textContent = limit;
 
     // Change color if close to limit
@@ -0,0 +1,151 @@
+# stream_buffer.py
+"""
+Buffer de generaciones en curso para el modo SSE del streaming.
+
+La llamada a OpenAI no corre dentro de la petición HTTP: un productor (hilo o
+tarea asyncio) itera el stream y publica cada fragmento en una `Generation`.
+Las conexiones del cliente solo leen de ahí, así que si se corta la conexión
+la generación sigue y el cliente puede reengancharse con `Last-Event-ID` sin
+una nueva llamada upstream.
+
+El id de cada evento es el offset (en caracteres) del texto tras ese
+fragmento. Los últimos `max_events` fragmentos se guardan en un ring buffer;
+si el cliente pide algo anterior, el hueco se rellena de una vez con el texto
+completo que mantiene el productor.
+"""
+import json
+import threading
+import time
+from collections import deque
+
+
+def sse_event(data, event_id=None, event=None):
+    """Serializa un evento SSE; `data` se envía como JSON en una sola línea."""
+    lines = []
+    if event:
+        lines.append(f"event: {event}")
+    if event_id is not None:
+        lines.append(f"id: {event_id}")
+    lines.append("data: " + json.dumps(data, ensure_ascii=False))
+    return "\n".join(lines) + "\n\n"
+
+
+# Comentario SSE para que proxies y navegadores no cierren una conexión ociosa
+SSE_KEEPALIVE = ": keepalive\n\n"
+
+
+def parse_last_event_id(value):
+    try:
+        return max(int(value), 0)
+    except (TypeError, ValueError):
+        return 0
+
+
+class Generation:
+    """Una respuesta en curso: ring buffer de fragmentos + metadatos finales."""
+
+    def __init__(self, message_id, conv_id, user_id, text, max_events):
+        self.message_id = message_id
+        self.conv_id = conv_id
+        self.user_id = user_id
+        # Callable que devuelve el texto completo generado hasta ahora
+        self._text = text
+        self._events = deque(maxlen=max_events)  # (offset tras el fragmento, fragmento)
+        self._cond = threading.Condition()
+        self._listeners = []
+        self.offset = 0
+        self.done = False
+        self.meta = None
+        self.finished_at = None
+
+    # --- Productor ---
+
+    def publish(self, delta):
+        with self._cond:
+            self.offset += len(delta)
+            self._events.append((self.offset, delta))
+            self._cond.notify_all()
+            listeners = list(self._listeners)
+        for wake in listeners:
+            wake()
+
+    def finish(self, meta):
+        with self._cond:
+            self.done = True
+            self.meta = meta
+            self.finished_at = time.monotonic()
+            self._cond.notify_all()
+            listeners = list(self._listeners)
+        for wake in listeners:
+            wake()
+
+    # --- Lectores ---
+
+    def since(self, after):
+        """Fragmentos posteriores al offset `after`: ([(offset, texto)], done, meta)."""
+        with self._cond:
+            events = [e for e in self._events if e[0] > after]
+            done, meta = self.done, self.meta
+        if events:
+            start = events[0][0] - len(events[0][1])
+            if start > after:
+                # Ya salió del ring buffer: se envía el tramo que falta de una vez
+                events.insert(0, (start, self._text()[after:start]))
+            elif start < after:
+                # Offset a mitad de un fragmento: solo lo que falta de él
+                events[0] = (events[0][0], events[0][1][after - start:])
+        return events, done, meta
+
+    def wait(self, after, timeout):
+        """Como `since`, pero bloquea hasta que haya algo nuevo o `timeout`."""
+        with self._cond:
+            self._cond.wait_for(lambda: self.offset > after or self.done, timeout)
+        return self.since(after)
+
+    def add_listener(self, wake):
+        """`wake()` se llama en cada publicación (lectores asyncio)."""
+        with self._cond:
+            self._listeners.append(wake)
+
+    def remove_listener(self, wake):
+        with self._cond:
+            if wake in self._listeners:
+                self._listeners.remove(wake)
+
+
+class GenerationRegistry:
+    """Generaciones del proceso, por id de mensaje; las terminadas caducan."""
+
+    def __init__(self, max_events=1024, retention=60.0):
+        self.max_events = max_events
+        self.retention = retention
+        self._items = {}
+        self._lock = threading.Lock()
+
+    def create(self, message_id, conv_id, user_id, text):
+        gen = Generation(message_id, conv_id, user_id, text, self.max_events)
+        with self._lock:
+            self._prune()
+            self._items[message_id] = gen
+        return gen
+
+    def get(self, message_id):
+        with self._lock:
+            self._prune()
+            return self._items.get(message_id)
+
+    def _prune(self):
+        now = time.monotonic()
+        expired = [k for k, g in self._items.items()
+                   if g.finished_at is not None and now - g.finished_at > self.retention]
+        for k in expired:
+            del self._items[k]
+
+
+def init_stream_buffer(app):
+    registry = GenerationRegistry(
+        max_events=app.config.get("STREAM_BUFFER_EVENTS", 1024),
+        retention=app.config.get("STREAM_BUFFER_RETENTION", 60),
+    )
+    app.extensions["stream_generations"] = registry
+    return registry
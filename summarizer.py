@@ -0,0 +1,220 @@
+# summarizer.py
+"""
+Resúmenes incrementales de conversaciones largas.
+
+Cuando los mensajes de una conversación que aún no están resumidos suman
+más de SUMMARY_TRIGGER_TOKENS, un hilo de fondo pliega los más antiguos en
+`Conversation.summary`. Los últimos SUMMARY_KEEP_TOKENS se dejan literales.
+El resumen se genera con el modelo barato de allowed_models.json
+(`summary_model`) a partir del resumen anterior y de los turnos nuevos, así
+que cada pasada solo procesa lo que no estaba resumido.
+
+Se programa al guardar una respuesta y nunca retrasa la respuesta actual.
+`build_context` envía después sistema + resumen + turnos posteriores a
+`summary_turn`. Si dos workers resumen a la vez la misma conversación, el
+UPDATE condicional deja solo uno de los resultados.
+"""
+import atexit
+import logging
+import os
+import threading
+from collections import deque
+
+from flask import current_app
+from sqlalchemy import func
+
+from models import db, Conversation, Message, MessageStatusEnum, RoleEnum
+from config.model_utils import get_model_config
+from config.tokenizer import TOKENS_PER_MESSAGE, count_text
+from usage import usage_from_response
+from message_archive import message_text
+
+model_config = get_model_config()
+logger = logging.getLogger(__name__)
+
+SUMMARY_PREFIX = "Resumen de la conversación hasta este punto:\n"
+
+SUMMARY_INSTRUCTIONS = (
+    "Resume la conversación para que un asistente pueda continuarla sin el "
+    "historial. Conserva hechos, decisiones, nombres y firmas de código "
+    "relevantes, preferencias del usuario y preguntas abiertas. Integra el "
+    "resumen previo con los turnos nuevos. Responde solo con el resumen."
+)
+
+
+def summary_payload(conv):
+    """Mensaje {"role", "content"} con el resumen de `conv`, o None."""
+    if not conv or not conv.summary:
+        return None
+    return {"role": "system", "content": SUMMARY_PREFIX + conv.summary}
+
+
+def summary_tokens(conv, model=None):
+    message = summary_payload(conv)
+    if message is None:
+        return 0
+    return count_text(message["content"], model) + TOKENS_PER_MESSAGE
+
+
+class Summarizer:
+    def __init__(self, app, upstream, trigger_tokens=8000, keep_tokens=3000,
+                 max_fold_tokens=12000, max_output_tokens=800):
+        self.app = app
+        self.upstream = upstream
+        self.trigger_tokens = trigger_tokens
+        self.keep_tokens = keep_tokens
+        self.max_fold_tokens = max_fold_tokens
+        self.max_output_tokens = max_output_tokens
+        self._queue = deque()
+        self._queued = set()
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopping = False
+        self._thread = None
+        self._pid = None
+        atexit.register(self._stop)
+
+    def schedule(self, conv_id, user_id=None):
+        """Encola la conversación si no lo estaba ya; no bloquea."""
+        with self._lock:
+            if conv_id in self._queued:
+                return
+            self._queued.add(conv_id)
+            self._queue.append((conv_id, user_id))
+        self._ensure_thread()
+        self._wakeup.set()
+
+    def _ensure_thread(self):
+        # Tras un fork de gunicorn el hilo del padre no existe en el hijo
+        if self._thread is not None and self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._thread is not None and self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name="summarizer", daemon=True)
+            self._thread.start()
+
+    def _stop(self):
+        self._stopping = True
+        self._wakeup.set()
+
+    def _run(self):
+        while not self._stopping:
+            self._wakeup.wait()
+            self._wakeup.clear()
+            while not self._stopping:
+                with self._lock:
+                    if not self._queue:
+                        break
+                    conv_id, user_id = self._queue.popleft()
+                    self._queued.discard(conv_id)
+                try:
+                    with self.app.app_context():
+                        self.summarize(conv_id, user_id)
+                except Exception as e:
+                    logger.error(f"Resumen de la conversación {conv_id} fallido: {e}", exc_info=True)
+
+    # --- Trabajo ---
+
+    def _pending_tokens(self, conv_id, after):
+        query = db.session.query(func.coalesce(func.sum(Message.token_count), 0))\
+            .filter(Message.conversation_id == conv_id, Message.role != RoleEnum.system)
+        if after is not None:
+            query = query.filter(Message.turn_index > after)
+        return query.scalar()
+
+    def _to_fold(self, conv_id, after):
+        """Mensajes a plegar: los más antiguos sin resumir, dejando la cola reciente."""
+        query = Message.query\
+            .filter(Message.conversation_id == conv_id, Message.role != RoleEnum.system)
+        if after is not None:
+            query = query.filter(Message.turn_index > after)
+        messages = query.order_by(Message.turn_index.desc()).all()
+
+        kept = 0
+        while messages and kept < self.keep_tokens:
+            kept += messages.pop(0).token_count or 0
+        messages.reverse()
+
+        fold, tokens = [], 0
+        for m in messages:
+            if m.status == MessageStatusEnum.streaming:
+                break
+            if fold and tokens + (m.token_count or 0) > self.max_fold_tokens:
+                break
+            fold.append(m)
+            tokens += m.token_count or 0
+        # Se corta tras una respuesta para no separar pregunta y respuesta
+        while fold and fold[-1].role != RoleEnum.assistant:
+            fold.pop()
+        return fold
+
+    def summarize(self, conv_id, user_id=None):
+        """Pliega turnos antiguos en el resumen si se supera el umbral. True si lo actualiza."""
+        conv = db.session.get(Conversation, conv_id)
+        if conv is None:
+            return False
+        previous_turn = conv.summary_turn
+        if self._pending_tokens(conv_id, previous_turn) <= self.trigger_tokens:
+            return False
+        fold = self._to_fold(conv_id, previous_turn)
+        if not fold:
+            return False
+
+        transcript = "\n\n".join(f"{m.role.value}: {message_text(m)}" for m in fold)
+        prompt = (f"Resumen previo:\n{conv.summary}\n\n" if conv.summary else "") \
+            + f"Turnos nuevos:\n{transcript}"
+        last_turn = fold[-1].turn_index
+        model = model_config.summary_model
+        # Se suelta la conexión antes de la llamada, que puede tardar segundos
+        db.session.rollback()
+
+        resp = self.upstream.create(
+            "chat",
+            model=model,
+            messages=[{"role": "system", "content": SUMMARY_INSTRUCTIONS},
+                      {"role": "user", "content": prompt}],
+            max_tokens=self.max_output_tokens,
+        )
+        summary = (resp.choices[0].message.content or "").strip()
+        if not summary:
+            return False
+
+        table = Conversation.__table__
+        current = table.c.summary_turn.is_(None) if previous_turn is None \
+            else table.c.summary_turn == previous_turn
+        result = db.session.execute(
+            table.update()
+            .where(table.c.id == conv_id, current)
+            # El resumen no cambia lo que ve el cliente: se conserva updated_at (ETag)
+            .values(summary=summary, summary_turn=last_turn, updated_at=table.c.updated_at)
+        )
+        db.session.commit()
+
+        ledger = self.app.extensions.get("usage_ledger")
+        if ledger is not None:
+            ledger.record(user_id, model, usage_from_response(resp))
+        return result.rowcount == 1
+
+
+def schedule_summary(conv_id, user_id=None):
+    """Tras guardar una respuesta: programa el resumen si está activado."""
+    summarizer = current_app.extensions.get("summarizer")
+    if summarizer is not None:
+        summarizer.schedule(conv_id, user_id)
+
+
+def init_summarizer(app, upstream):
+    summarizer = None
+    if app.config.get("SUMMARY_ENABLED", False):
+        summarizer = Summarizer(
+            app,
+            upstream,
+            trigger_tokens=app.config.get("SUMMARY_TRIGGER_TOKENS", 8000),
+            keep_tokens=app.config.get("SUMMARY_KEEP_TOKENS", 3000),
+            max_fold_tokens=app.config.get("SUMMARY_MAX_FOLD_TOKENS", 12000),
+            max_output_tokens=app.config.get("SUMMARY_MAX_OUTPUT_TOKENS", 800),
+        )
+    app.extensions["summarizer"] = summarizer
+    return summarizer
@@ -0,0 +1,31 @@
+# tests/__init__.py
+"""
+Pruebas de integración contra servidores falsos locales (SMTP, OpenAI), sin
+dependencias extra:
+
+    python -m unittest discover -s tests -t .
+"""
+import importlib.util
+import os
+
+from flask import Flask
+
+from models import db
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# config.py queda tapado por el paquete config/: se carga como en manage.py
+_spec = importlib.util.spec_from_file_location("app_config", os.path.join(ROOT, "config.py"))
+app_config = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(app_config)
+
+
+def make_app(**overrides):
+    """App mínima con TestingConfig (SQLite en memoria) y el esquema creado."""
+    app = Flask(__name__)
+    app.config.from_object(app_config.config["testing"])
+    app.config.update(overrides)
+    db.init_app(app)
+    with app.app_context():
+        db.create_all()
+    return app
@@ -0,0 +1,92 @@
+# tests/test_batch_jobs.py
+import importlib.util
+import os
+import threading
+import time
+import unittest
+from http.server import ThreadingHTTPServer
+
+from models import db, BatchJob, User
+from batch_jobs import COMPLETED, SUBMITTED, BatchRunner, create_job, item_page
+from tests import ROOT, make_app
+
+_spec = importlib.util.spec_from_file_location("fake_openai", os.path.join(ROOT, "scripts", "fake_openai.py"))
+fake_openai = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(fake_openai)
+
+MODEL = "gpt-4.1-mini-2025-04-14"
+BATCH_DURATION = 0.5
+
+
+class BatchJobsTest(unittest.TestCase):
+    def setUp(self):
+        fake_openai.FakeOpenAIHandler.batch_duration = BATCH_DURATION
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), fake_openai.FakeOpenAIHandler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+        # El SDK toma la URL base del entorno, como al usar fake_openai a mano
+        self._base_url = os.environ.get("OPENAI_BASE_URL")
+        os.environ["OPENAI_BASE_URL"] = f"http://127.0.0.1:{self.server.server_address[1]}/v1"
+        from upstream import init_upstream
+        self.app = make_app(OPENAI_API_KEY="sk-test", UPSTREAM_RETRY_BASE_DELAY=0.01)
+        self.runner = BatchRunner(self.app, init_upstream(self.app), poll_interval=0)
+
+        with self.app.app_context():
+            user = User(username="batch", email="batch@example.com", password_hash="x", is_approved=True)
+            db.session.add(user)
+            db.session.commit()
+            self.user_id = user.id
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        if self._base_url is None:
+            os.environ.pop("OPENAI_BASE_URL", None)
+        else:
+            os.environ["OPENAI_BASE_URL"] = self._base_url
+
+    def _job(self, job_id):
+        with self.app.app_context():
+            job = db.session.get(BatchJob, job_id)
+            db.session.expunge(job)
+            return job
+
+    def test_submit_poll_and_collect(self):
+        prompts = ["Resume este fichero", "Escribe un test", "Explica el error"]
+        with self.app.app_context():
+            job_id = create_job(self.user_id, MODEL, prompts, "Eres un asistente.").id
+
+        # Primera pasada: sube el JSONL y crea el batch
+        self.runner.run_once()
+        job = self._job(job_id)
+        self.assertEqual(job.status, SUBMITTED)
+        self.assertTrue(job.input_file_id)
+        self.assertTrue(job.openai_batch_id)
+
+        # Siguientes pasadas: consulta hasta que el batch termina y recoge la salida
+        deadline = time.monotonic() + BATCH_DURATION + 10
+        while job.status == SUBMITTED and time.monotonic() < deadline:
+            # Con poll_interval=0 el trabajo vuelve a estar vencido en cada pasada
+            time.sleep(0.1)
+            self.runner.run_once()
+            job = self._job(job_id)
+
+        self.assertEqual(job.status, COMPLETED)
+        self.assertEqual((job.total, job.completed, job.failed), (3, 3, 0))
+        self.assertIsNotNone(job.finished_at)
+
+        with self.app.app_context():
+            items = item_page(job_id, 10)["items"]
+        self.assertEqual([i["idx"] for i in items], [0, 1, 2])
+        for item in items:
+            self.assertEqual(item["status"], COMPLETED)
+            self.assertTrue(item["answer"])
+            self.assertGreater(item["output_tokens"], 0)
+
+        # Un trabajo terminado no se vuelve a reclamar
+        self.assertFalse(self.runner.run_once())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,147 @@
+# tests/test_conversation_io.py
+import json
+import re
+import unittest
+from unittest import mock
+
+import conversation_io
+from conversation_io import import_ndjson
+from message_archive import message_text
+from models import db, Message, User
+from tests import make_app
+
+
+def _pg_csv_records(text):
+    """
+    Registros de un CSV según las reglas de COPY de PostgreSQL: cada campo es
+    (valor, entre_comillas), porque un campo vacío sin comillas es NULL.
+    """
+    records, fields, value, quoted, in_quotes, i = [], [], [], False, False, 0
+    while i < len(text):
+        ch = text[i]
+        if in_quotes:
+            if ch == '"' and text[i + 1:i + 2] == '"':
+                value.append('"')
+                i += 1
+            elif ch == '"':
+                in_quotes = False
+            else:
+                value.append(ch)
+        elif ch == '"':
+            in_quotes = quoted = True
+        elif ch in ",\r\n":
+            if ch == "\r" and text[i + 1:i + 2] == "\n":
+                i += 1
+            fields.append(("".join(value), quoted))
+            value, quoted = [], False
+            if ch != ",":
+                records.append(fields)
+                fields = []
+        else:
+            value.append(ch)
+        i += 1
+    if fields or value:
+        fields.append(("".join(value), quoted))
+        records.append(fields)
+    return records
+
+
+class _PgCopyCursor:
+    """Cursor con `copy_expert` que aplica la semántica de NULL de COPY ... (FORMAT csv)."""
+
+    def __init__(self, dbapi_connection):
+        self.dbapi_connection = dbapi_connection
+
+    def copy_expert(self, sql, buffer):
+        match = re.match(r"COPY (\w+) \(([^)]*)\) FROM STDIN WITH \((.*)\)$", sql)
+        table, columns, options = match.group(1), match.group(2).split(", "), match.group(3)
+        forced = re.search(r"FORCE_NOT_NULL \(([^)]*)\)", options)
+        not_null = set(forced.group(1).split(", ")) if forced else set()
+        rows = [
+            [value if value or quoted or column in not_null else None
+             for column, (value, quoted) in zip(columns, record)]
+            for record in _pg_csv_records(buffer.read())
+        ]
+        self.dbapi_connection.executemany(
+            f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})", rows
+        )
+
+    def close(self):
+        pass
+
+
+class _CopyConnection:
+    """Connection de SQLAlchemy cuya conexión DBAPI ofrece el cursor de COPY."""
+
+    def __init__(self, connection):
+        self._connection = connection
+        self.connection = mock.Mock(cursor=lambda: _PgCopyCursor(connection.connection.dbapi_connection))
+
+    def __getattr__(self, name):
+        return getattr(self._connection, name)
+
+
+class CopyImportTest(unittest.TestCase):
+    """Importación por el camino de COPY (PostgreSQL) sobre SQLite."""
+
+    def setUp(self):
+        self.app = make_app()
+        with self.app.app_context():
+            user = User(username="io", email="io@example.com", password_hash="x", is_approved=True)
+            db.session.add(user)
+            db.session.commit()
+            self.user_id = user.id
+
+        original_init = conversation_io._Importer.__init__
+
+        def init(importer, *args, **kwargs):
+            original_init(importer, *args, **kwargs)
+            importer.use_copy = True
+            importer.connection = _CopyConnection(importer.connection)
+
+        patcher = mock.patch.object(conversation_io._Importer, "__init__", init)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _import(self, *records):
+        lines = [json.dumps(r) for r in records]
+        with self.app.app_context():
+            return import_ndjson(lines, self.user_id)
+
+    def _messages(self):
+        with self.app.app_context():
+            return [(m.role.value, m.content, message_text(m), m.status.value)
+                    for m in Message.query.order_by(Message.turn_index)]
+
+    def test_empty_content_is_not_null(self):
+        result = self._import(
+            {"type": "conversation", "id": 1, "title": "Stream cortado"},
+            {"type": "message", "conversation_id": 1, "role": "user", "content": "Hola"},
+            {"type": "message", "conversation_id": 1, "role": "assistant", "content": "",
+             "status": "interrupted"},
+        )
+
+        self.assertEqual(result, {"conversations": 1, "messages": 2})
+        self.assertEqual(self._messages(), [
+            ("user", "Hola", "Hola", "complete"),
+            ("assistant", "", "", "interrupted"),
+        ])
+
+    def test_system_turn_through_copy(self):
+        prompt = "Eres un asistente conciso."
+        self._import(
+            {"type": "conversation", "id": 1, "title": "Con sistema"},
+            {"type": "message", "conversation_id": 1, "role": "system", "content": prompt},
+            {"type": "message", "conversation_id": 1, "role": "user", "content": "Hola"},
+        )
+
+        self.assertEqual(self._messages(), [
+            ("system", "", prompt, "complete"),
+            ("user", "Hola", "Hola", "complete"),
+        ])
+        with self.app.app_context():
+            self.assertIsNotNone(Message.query.filter_by(turn_index=0).one().system_prompt_id)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,126 @@
+# tests/test_mail_outbox.py
+import socketserver
+import threading
+import unittest
+
+from models import db, OutboxEmail
+from mail_outbox import FAILED, SENT, MailOutbox, enqueue_email
+from tests import make_app
+
+
+class _SMTPHandler(socketserver.StreamRequestHandler):
+    """Lo justo de SMTP para smtplib: EHLO, MAIL, RCPT, DATA, NOOP, QUIT."""
+
+    def _reply(self, line):
+        self.wfile.write(line.encode("ascii") + b"\r\n")
+
+    def handle(self):
+        server = self.server
+        with server.lock:
+            server.connections += 1
+        self._reply("220 fake ESMTP")
+        recipient, lines, in_data = None, [], False
+        for raw in self.rfile:
+            line = raw.decode("utf-8").rstrip("\r\n")
+            if in_data:
+                if line == ".":
+                    with server.lock:
+                        server.messages.append((recipient, "\n".join(lines)))
+                    recipient, lines, in_data = None, [], False
+                    self._reply("250 OK")
+                else:
+                    lines.append(line[1:] if line.startswith("..") else line)
+                continue
+            command = line[:4].upper()
+            if command in ("EHLO", "HELO"):
+                self._reply("250 fake")
+            elif command == "RCPT":
+                recipient = line.split(":", 1)[1].strip(" <>")
+                if recipient.startswith("rechazado@"):
+                    self._reply("550 No such user")
+                else:
+                    self._reply("250 OK")
+            elif command == "DATA":
+                in_data = True
+                self._reply("354 End data with <CR><LF>.<CR><LF>")
+            elif command == "QUIT":
+                self._reply("221 Bye")
+                return
+            else:
+                self._reply("250 OK")
+
+
+class FakeSMTPServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), _SMTPHandler)
+        self.lock = threading.Lock()
+        self.connections = 0
+        self.messages = []
+
+
+class MailOutboxTest(unittest.TestCase):
+    def setUp(self):
+        self.smtp = FakeSMTPServer()
+        threading.Thread(target=self.smtp.serve_forever, daemon=True).start()
+        self.app = make_app(
+            MAIL_SERVER="127.0.0.1",
+            MAIL_PORT=self.smtp.server_address[1],
+            MAIL_USERNAME="",
+            MAIL_DEFAULT_SENDER="noreply@example.com",
+        )
+        self.outbox = MailOutbox(self.app, batch_size=2)
+
+    def tearDown(self):
+        self.outbox.smtp.close()
+        self.smtp.shutdown()
+        self.smtp.server_close()
+
+    def _enqueue(self, *recipients):
+        with self.app.app_context():
+            for recipient in recipients:
+                enqueue_email("Restablecer contraseña", recipient, f"<p>Hola {recipient}</p>")
+            db.session.commit()
+
+    def _drain(self):
+        batches = 0
+        while self.outbox.drain_once():
+            batches += 1
+        return batches + 1
+
+    def _statuses(self):
+        with self.app.app_context():
+            return {e.recipient: (e.status, e.attempts) for e in OutboxEmail.query.all()}
+
+    def test_drain_sends_every_email_over_one_connection(self):
+        self._enqueue("a@example.com", "b@example.com", "c@example.com")
+
+        self.assertEqual(self._drain(), 2)   # lotes de 2: uno lleno y otro con el resto
+
+        self.assertEqual(self._statuses(), {
+            "a@example.com": (SENT, 1),
+            "b@example.com": (SENT, 1),
+            "c@example.com": (SENT, 1),
+        })
+        self.assertEqual(sorted(r for r, _ in self.smtp.messages),
+                         ["a@example.com", "b@example.com", "c@example.com"])
+        self.assertIn("Subject:", self.smtp.messages[0][1])
+        self.assertEqual(self.smtp.connections, 1)
+        # Ya no queda nada que reclamar
+        self.assertFalse(self.outbox.drain_once())
+
+    def test_rejected_recipient_fails_without_retry(self):
+        self._enqueue("rechazado@example.com", "ok@example.com")
+
+        self._drain()
+
+        statuses = self._statuses()
+        self.assertEqual(statuses["rechazado@example.com"], (FAILED, 1))
+        self.assertEqual(statuses["ok@example.com"], (SENT, 1))
+        self.assertEqual([r for r, _ in self.smtp.messages], ["ok@example.com"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,68 @@
+# tests/test_message_archive.py
+import unittest
+
+from sqlalchemy import text
+
+from message_archive import Archiver, CODEC_ZLIB, rebuild_search_index
+from models import db, Conversation, Message, RoleEnum, User
+from tests import make_app
+
+
+class ArchivedSearchIndexTest(unittest.TestCase):
+    """Entradas FTS5 de los mensajes archivados (content vacío)."""
+
+    def setUp(self):
+        self.app = make_app()
+        self.ctx = self.app.app_context()
+        self.ctx.push()
+        self.addCleanup(self.ctx.pop)
+        user = User(username="fts", email="fts@example.com", password_hash="x", is_approved=True)
+        db.session.add(user)
+        db.session.flush()
+        self.conv = Conversation(user_id=user.id, title="Archivo")
+        db.session.add(self.conv)
+        db.session.flush()
+        db.session.add_all([
+            Message(conversation_id=self.conv.id, role=RoleEnum.user, turn_index=0,
+                    content="zanahoria archivada " * 20),
+            Message(conversation_id=self.conv.id, role=RoleEnum.assistant, turn_index=1,
+                    content="respuesta corta"),
+        ])
+        db.session.commit()
+        Archiver(after_days=0, min_chars=100, codec=CODEC_ZLIB).run()
+
+    def _hits(self, term):
+        return db.session.execute(
+            text("SELECT rowid FROM messages_fts WHERE messages_fts MATCH :q"), {"q": term}
+        ).scalars().all()
+
+    def _integrity_check(self):
+        # Compara el índice con `messages`: solo vale sin archivados en la tabla
+        db.session.execute(text(
+            "INSERT INTO messages_fts(messages_fts, rank) VALUES ('integrity-check', 1)"))
+
+    def test_archived_message_stays_indexed(self):
+        archived = Message.query.filter(Message.content_archive.isnot(None)).one()
+
+        self.assertEqual(archived.content, "")
+        self.assertEqual(self._hits("archivada"), [archived.id])
+
+    def test_delete_removes_archived_entry(self):
+        db.session.delete(self.conv)
+        db.session.commit()
+
+        self.assertEqual(self._hits("archivada"), [])
+        self.assertEqual(self._hits("respuesta"), [])
+        self._integrity_check()
+
+    def test_rebuild_keeps_archived_text(self):
+        archived = Message.query.filter(Message.content_archive.isnot(None)).one()
+
+        self.assertEqual(rebuild_search_index(), 1)
+
+        self.assertEqual(self._hits("archivada"), [archived.id])
+        self.assertEqual(len(self._hits("respuesta")), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,41 @@
+# tests/test_single_flight.py
+import asyncio
+import unittest
+
+from single_flight import SingleFlight
+
+
+class DoAsyncCancelTest(unittest.IsolatedAsyncioTestCase):
+    """Cancelar la petición del líder no deja sin respuesta a los que esperaban."""
+
+    async def test_waiters_survive_leader_cancel(self):
+        flight = SingleFlight()
+        calls = []
+
+        async def call():
+            calls.append(1)
+            await asyncio.sleep(0.05)
+            return {"calls": len(calls)}
+
+        leader = asyncio.create_task(flight.do_async("k", call))
+        await asyncio.sleep(0)
+        waiters = [asyncio.create_task(flight.do_async("k", call)) for _ in range(3)]
+        cancelled_waiter = asyncio.create_task(flight.do_async("k", call))
+        await asyncio.sleep(0)
+        leader.cancel()
+        cancelled_waiter.cancel()
+
+        results = await asyncio.gather(*waiters)
+
+        self.assertEqual(len(calls), 2)
+        self.assertEqual([r for r, _ in results], [{"calls": 2}] * 3)
+        self.assertEqual(sorted(c for _, c in results), [False, True, True])
+        with self.assertRaises(asyncio.CancelledError):
+            await leader
+        with self.assertRaises(asyncio.CancelledError):
+            await cancelled_waiter
+        self.assertEqual(flight._futures, {})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,342 @@
+# upstream.py
+"""
+Capa de acceso a la API de OpenAI.
+
+- Un cliente por proceso con pool HTTP (keep-alive) ajustado por configuración.
+- Timeouts por modelo: conexión, lectura y, en streams, plazo hasta el primer
+  token (que también acota los silencios entre chunks).
+- Reintentos con backoff exponencial y jitter solo para fallos idempotentes:
+  errores de conexión, timeouts, 429 y 5xx. En un stream solo se reintenta la
+  apertura; una vez que han salido tokens no se repite nada.
+- Circuit breaker por modelo: tras N fallos seguidos se corta durante un
+  tiempo y las peticiones fallan al momento con 503 en lugar de esperar al
+  timeout de gunicorn.
+- Cada llamada deja su latencia y si falló en una ventana por modelo que usa
+  el enrutado de `model: "auto"` (config/model_router.py).
+
+El SDK ya respeta OPENAI_BASE_URL, así que todo se puede probar contra
+`scripts/fake_openai.py` (que puede inyectar fallos y latencia).
+"""
+import asyncio
+import logging
+import random
+import threading
+import time
+
+import httpx
+import openai
+from openai import AsyncOpenAI, OpenAI
+
+from config.model_utils import get_model_config
+from config.model_router import get_model_stats
+import metrics
+
+model_config = get_model_config()
+logger = logging.getLogger(__name__)
+
+
+class UpstreamUnavailable(Exception):
+    """El circuito del modelo está abierto: no se llama a OpenAI."""
+
+    def __init__(self, model, retry_after):
+        super().__init__(f"Upstream no disponible para {model}")
+        self.model = model
+        self.retry_after = retry_after
+
+
+def is_retryable(exc):
+    if isinstance(exc, openai.APIConnectionError):   # incluye APITimeoutError
+        return True
+    if isinstance(exc, openai.RateLimitError):
+        # Sin saldo no es transitorio
+        return getattr(exc, "code", None) != "insufficient_quota"
+    return isinstance(exc, openai.APIStatusError) and exc.status_code >= 500
+
+
+def is_failure(exc):
+    """Fallos que cuentan para el circuit breaker (los 4xx son del cliente)."""
+    if isinstance(exc, openai.APIConnectionError):
+        return True
+    return isinstance(exc, openai.APIStatusError) and exc.status_code >= 500
+
+
+def _retry_after(exc):
+    response = getattr(exc, "response", None)
+    try:
+        return float(response.headers.get("retry-after"))
+    except (AttributeError, TypeError, ValueError):
+        return None
+
+
+class CircuitBreaker:
+    """
+    Un circuito por modelo (por proceso). Cerrado: todo pasa. Tras
+    `failure_threshold` fallos seguidos se abre durante `reset_timeout`
+    segundos; después deja pasar una única petición de prueba (semiabierto)
+    y según su resultado se cierra o vuelve a abrirse.
+    """
+
+    def __init__(self, failure_threshold=5, reset_timeout=30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._state = {}   # model -> [fallos seguidos, abierto_hasta, inicio de la prueba]
+        self._lock = threading.Lock()
+
+    def before_call(self, model):
+        """Devuelve 0 si se puede llamar, o los segundos que quedan de circuito abierto."""
+        with self._lock:
+            state = self._state.get(model)
+            if state is None or state[0] < self.failure_threshold:
+                return 0
+            now = time.monotonic()
+            if state[1] > now:
+                return state[1] - now
+            if state[2] and now - state[2] < self.reset_timeout:
+                # Ya hay una petición de prueba en vuelo
+                return self.reset_timeout - (now - state[2])
+            state[2] = now
+            return 0
+
+    def retry_after(self, model):
+        """Como `before_call` pero sin reservar la petición de prueba."""
+        with self._lock:
+            state = self._state.get(model)
+            if state is None or state[0] < self.failure_threshold:
+                return 0
+            return max(state[1] - time.monotonic(), 0)
+
+    def record_success(self, model):
+        with self._lock:
+            self._state.pop(model, None)
+
+    def record_failure(self, model):
+        with self._lock:
+            state = self._state.setdefault(model, [0, 0.0, 0.0])
+            state[0] += 1
+            state[2] = 0.0
+            if state[0] >= self.failure_threshold:
+                if state[0] == self.failure_threshold:
+                    logger.warning(f"Circuito abierto para {model} durante {self.reset_timeout}s")
+                state[1] = time.monotonic() + self.reset_timeout
+
+
+class RetryPolicy:
+    def __init__(self, max_retries=2, base_delay=0.5, max_delay=8.0):
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def delay(self, attempt, exc):
+        """Backoff exponencial con jitter completo; respeta Retry-After si viene."""
+        hinted = _retry_after(exc)
+        if hinted is not None:
+            return min(hinted, self.max_delay)
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+
+class _UpstreamBase:
+    def __init__(self, client, breaker, policy, timeouts):
+        self.client = client
+        self.breaker = breaker
+        self.policy = policy
+        # Timeouts por defecto (segundos): connect, read, first_token
+        self.timeouts = timeouts
+        # Latencia y errores recientes por modelo, para `model: "auto"`
+        self.stats = get_model_stats()
+
+    def timeout(self, model, stream):
+        """httpx.Timeout del modelo: los de allowed_models.json pisan los globales."""
+        t = dict(self.timeouts, **model_config.get_timeouts(model))
+        read = t["first_token"] if stream else t["read"]
+        return httpx.Timeout(read, connect=t["connect"])
+
+    def ensure_available(self, model):
+        wait = self.breaker.retry_after(model)
+        if wait > 0:
+            raise UpstreamUnavailable(model, wait)
+
+    def report_failure(self, model, exc):
+        """
+        Cortes de transporte a mitad de un stream (timeout entre chunks,
+        conexión caída). Los errores de `create` ya se cuentan allí.
+        """
+        if isinstance(exc, httpx.TransportError):
+            self.breaker.record_failure(model)
+            self.stats.observe(model, 0.0, failed=True)
+            metrics.upstream_error(model)
+
+    def _observe(self, model, started, api, kwargs, exc=None):
+        """
+        Muestra para el enrutado automático y /metrics: duración de la
+        llamada (en un stream, hasta las cabeceras). Los 4xx no cuentan.
+        """
+        if exc is not None and not is_failure(exc):
+            return
+        elapsed = time.monotonic() - started
+        self.stats.observe(model, elapsed, failed=exc is not None)
+        if exc is None:
+            metrics.upstream_call(model, api, kwargs.get("stream", False), elapsed)
+        else:
+            metrics.upstream_error(model)
+
+    def _method(self, api):
+        if api == "responses":
+            return self.client.responses.create
+        return self.client.chat.completions.create
+
+    def _check_breaker(self, model):
+        wait = self.breaker.before_call(model)
+        if wait > 0:
+            raise UpstreamUnavailable(model, wait)
+
+    def _should_retry(self, model, attempt, exc):
+        if is_failure(exc):
+            self.breaker.record_failure(model)
+        else:
+            # Un 4xx no dice nada de la salud del upstream
+            self.breaker.record_success(model)
+        return is_retryable(exc) and attempt < self.policy.max_retries
+
+
+class Upstream(_UpstreamBase):
+    def create(self, api, **kwargs):
+        """
+        Llama a responses.create ("responses") o chat.completions.create
+        ("chat") con timeouts, reintentos y circuit breaker.
+        """
+        model = kwargs.get("model")
+        kwargs.setdefault("timeout", self.timeout(model, kwargs.get("stream", False)))
+        attempt = 0
+        while True:
+            self._check_breaker(model)
+            started = time.monotonic()
+            try:
+                resp = self._method(api)(**kwargs)
+            except openai.APIError as e:
+                self._observe(model, started, api, kwargs, e)
+                if not self._should_retry(model, attempt, e):
+                    raise
+                delay = self.policy.delay(attempt, e)
+                logger.warning(f"Reintentando {api} para {model} en {delay:.2f}s: {e}")
+                time.sleep(delay)
+                attempt += 1
+                continue
+            self._observe(model, started, api, kwargs)
+            self.breaker.record_success(model)
+            return resp
+
+    def call(self, fn, *args, retry=True, **kwargs):
+        """
+        Otras llamadas a la API (ficheros, batches): reintentos con backoff
+        para fallos transitorios y sin circuit breaker. `retry=False` para las
+        que no son idempotentes.
+        """
+        attempt = 0
+        while True:
+            try:
+                return fn(*args, **kwargs)
+            except openai.APIError as e:
+                if not (retry and is_retryable(e) and attempt < self.policy.max_retries):
+                    raise
+                delay = self.policy.delay(attempt, e)
+                logger.warning(f"Reintentando llamada a OpenAI en {delay:.2f}s: {e}")
+                time.sleep(delay)
+                attempt += 1
+
+    def warm_up(self):
+        """Abre una conexión del pool (DNS + TCP + TLS) antes de la primera petición."""
+        try:
+            self.client.get("/models", cast_to=httpx.Response)
+        except openai.APIStatusError:
+            pass   # Cualquier respuesta HTTP deja la conexión en el pool
+        except Exception as e:
+            logger.warning(f"Warm-up del cliente OpenAI fallido: {e}")
+
+
+class AsyncUpstream(_UpstreamBase):
+    async def create(self, api, **kwargs):
+        model = kwargs.get("model")
+        kwargs.setdefault("timeout", self.timeout(model, kwargs.get("stream", False)))
+        attempt = 0
+        while True:
+            self._check_breaker(model)
+            started = time.monotonic()
+            try:
+                resp = await self._method(api)(**kwargs)
+            except openai.APIError as e:
+                self._observe(model, started, api, kwargs, e)
+                if not self._should_retry(model, attempt, e):
+                    raise
+                delay = self.policy.delay(attempt, e)
+                logger.warning(f"Reintentando {api} para {model} en {delay:.2f}s: {e}")
+                await asyncio.sleep(delay)
+                attempt += 1
+                continue
+            self._observe(model, started, api, kwargs)
+            self.breaker.record_success(model)
+            return resp
+
+
+def _pool_settings(config):
+    limits = httpx.Limits(
+        max_connections=config.get("UPSTREAM_MAX_CONNECTIONS", 100),
+        max_keepalive_connections=config.get("UPSTREAM_MAX_KEEPALIVE", 20),
+        keepalive_expiry=config.get("UPSTREAM_KEEPALIVE_EXPIRY", 60),
+    )
+    timeouts = {
+        "connect": config.get("UPSTREAM_CONNECT_TIMEOUT", 5.0),
+        "read": config.get("UPSTREAM_READ_TIMEOUT", 60.0),
+        "first_token": config.get("UPSTREAM_FIRST_TOKEN_TIMEOUT", 30.0),
+    }
+    return limits, timeouts
+
+
+def _shared_parts(app):
+    config = app.config
+    breaker = app.extensions.get("upstream_breaker")
+    if breaker is None:
+        breaker = CircuitBreaker(
+            failure_threshold=config.get("UPSTREAM_BREAKER_THRESHOLD", 5),
+            reset_timeout=config.get("UPSTREAM_BREAKER_RESET", 30.0),
+        )
+        app.extensions["upstream_breaker"] = breaker
+    policy = RetryPolicy(
+        max_retries=config.get("UPSTREAM_MAX_RETRIES", 2),
+        base_delay=config.get("UPSTREAM_RETRY_BASE_DELAY", 0.5),
+        max_delay=config.get("UPSTREAM_RETRY_MAX_DELAY", 8.0),
+    )
+    return breaker, policy
+
+
+def init_upstream(app):
+    """Cliente síncrono del proceso (vistas Flask); queda en app.extensions."""
+    limits, timeouts = _pool_settings(app.config)
+    breaker, policy = _shared_parts(app)
+    client = OpenAI(
+        api_key=app.config.get("OPENAI_API_KEY"),
+        # Los reintentos los hace Upstream, con jitter y circuit breaker
+        max_retries=0,
+        http_client=httpx.Client(limits=limits, timeout=httpx.Timeout(timeouts["read"], connect=timeouts["connect"])),
+    )
+    upstream = Upstream(client, breaker, policy, timeouts)
+    app.extensions["upstream"] = upstream
+    return upstream
+
+
+def build_async_upstream(app):
+    """Cliente asíncrono para el modo ASGI; comparte el circuit breaker del proceso."""
+    limits, timeouts = _pool_settings(app.config)
+    breaker, policy = _shared_parts(app)
+    client = AsyncOpenAI(
+        api_key=app.config.get("OPENAI_API_KEY"),
+        max_retries=0,
+        http_client=httpx.AsyncClient(limits=limits, timeout=httpx.Timeout(timeouts["read"], connect=timeouts["connect"])),
+    )
+    return AsyncUpstream(client, breaker, policy, timeouts)
+
+
+def warm_up(app):
+    """Para el hook post_worker_init de gunicorn."""
+    upstream = app.extensions.get("upstream")
+    if upstream is not None and app.config.get("UPSTREAM_WARMUP", True):
+        upstream.warm_up()
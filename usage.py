@@ -0,0 +1,250 @@
+# usage.py
+"""
+Registro de consumo de tokens por usuario.
+
+Cada llamada a OpenAI deja un `UsageRecord` (tokens de entrada, entrada
+cacheada, salida y coste calculado con `pricing_per_1m_tokens`) y suma en el
+acumulado diario `UsageDaily` por usuario y modelo, más una fila total con
+model="*" que es la que consultan las cuotas.
+
+Las escrituras no van en la petición: se encolan en un buffer en memoria que
+un hilo de fondo vuelca por lotes (un INSERT múltiple + un UPSERT por lote).
+"""
+import atexit
+import logging
+import os
+import threading
+from datetime import datetime
+from functools import wraps
+
+from flask import current_app, jsonify, request
+from flask_login import current_user
+from sqlalchemy import insert
+
+from models import db, UsageRecord, UsageDaily
+from config.model_utils import get_model_config
+
+model_config = get_model_config()
+logger = logging.getLogger(__name__)
+
+ALL_MODELS = "*"
+
+
+def usage_from_response(resp):
+    """
+    Extrae (input, cached_input, output) del objeto `usage` de OpenAI, tanto
+    de la Responses API como de chat.completions.
+    """
+    usage = getattr(resp, "usage", None)
+    if usage is None:
+        return None
+    if hasattr(usage, "input_tokens"):
+        details = getattr(usage, "input_tokens_details", None)
+        return (usage.input_tokens or 0,
+                getattr(details, "cached_tokens", 0) or 0,
+                usage.output_tokens or 0)
+    details = getattr(usage, "prompt_tokens_details", None)
+    return (usage.prompt_tokens or 0,
+            getattr(details, "cached_tokens", 0) or 0,
+            usage.completion_tokens or 0)
+
+
+def compute_cost(model, input_tokens, cached_tokens, output_tokens):
+    """Coste en USD según pricing_per_1m_tokens; 0 si el modelo no tiene precios."""
+    pricing = model_config.get_pricing(model) or {}
+    uncached = max(input_tokens - cached_tokens, 0)
+    return (uncached * pricing.get("input", 0)
+            + cached_tokens * pricing.get("cached_input", pricing.get("input", 0))
+            + output_tokens * pricing.get("output", 0)) / 1_000_000
+
+
+class UsageLedger:
+    def __init__(self, app, flush_interval=5.0, batch_size=200):
+        self.app = app
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self._buffer = []
+        # (user_id, day) -> [tokens, cost] aún no volcados, para las cuotas
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+        self._pid = None
+        atexit.register(self.flush)
+
+    # --- Escritura (camino caliente: solo memoria) ---
+
+    def record(self, user_id, model, usage, message_id=None, cost_factor=1.0):
+        """`cost_factor` ajusta el precio de lista (p. ej. 0.5 en la Batch API)."""
+        if usage is None or user_id is None:
+            return
+        input_tokens, cached_tokens, output_tokens = usage
+        cost = compute_cost(model, input_tokens, cached_tokens, output_tokens) * cost_factor
+        now = datetime.utcnow()
+        row = {
+            "user_id": user_id,
+            "message_id": message_id,
+            "model": model,
+            "input_tokens": input_tokens,
+            "cached_input_tokens": cached_tokens,
+            "output_tokens": output_tokens,
+            "cost_usd": cost,
+            "created_at": now,
+        }
+        with self._lock:
+            self._buffer.append(row)
+            pending = self._pending.setdefault((user_id, now.date()), [0, 0.0])
+            pending[0] += input_tokens + output_tokens
+            pending[1] += cost
+            full = len(self._buffer) >= self.batch_size
+        self._ensure_thread()
+        if full:
+            self._wakeup.set()
+
+    def _ensure_thread(self):
+        # Tras un fork de gunicorn el hilo del padre no existe en el hijo
+        if self._thread is not None and self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._thread is not None and self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name="usage-ledger", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f"Usage flush failed: {e}", exc_info=True)
+
+    # --- Volcado por lotes ---
+
+    def flush(self):
+        with self._lock:
+            rows, self._buffer = self._buffer, []
+            pending, self._pending = self._pending, {}
+        if not rows:
+            return
+        try:
+            with self.app.app_context():
+                db.session.execute(insert(UsageRecord.__table__), rows)
+                _upsert_daily(_rollup(rows))
+                db.session.commit()
+        except Exception:
+            # Se reencolan para el siguiente intento
+            with self._lock:
+                self._buffer = rows + self._buffer
+                for key, (tokens, cost) in pending.items():
+                    current = self._pending.setdefault(key, [0, 0.0])
+                    current[0] += tokens
+                    current[1] += cost
+            raise
+
+    # --- Cuotas (una lectura por clave primaria) ---
+
+    def spent_today(self, user_id):
+        """(tokens, coste) del usuario hoy: acumulado + lo que aún está en el buffer."""
+        today = datetime.utcnow().date()
+        row = db.session.get(UsageDaily, (user_id, ALL_MODELS, today))
+        tokens = (row.input_tokens + row.output_tokens) if row else 0
+        cost = row.cost_usd if row else 0.0
+        with self._lock:
+            pending = self._pending.get((user_id, today))
+            if pending:
+                tokens += pending[0]
+                cost += pending[1]
+        return tokens, cost
+
+
+def _rollup(rows):
+    totals = {}
+    for row in rows:
+        day = row["created_at"].date()
+        for model in (row["model"], ALL_MODELS):
+            key = (row["user_id"], model, day)
+            t = totals.setdefault(key, {
+                "user_id": row["user_id"], "model": model, "day": day, "requests": 0,
+                "input_tokens": 0, "cached_input_tokens": 0, "output_tokens": 0, "cost_usd": 0.0,
+            })
+            t["requests"] += 1
+            t["input_tokens"] += row["input_tokens"]
+            t["cached_input_tokens"] += row["cached_input_tokens"]
+            t["output_tokens"] += row["output_tokens"]
+            t["cost_usd"] += row["cost_usd"]
+    return list(totals.values())
+
+
+SUM_COLUMNS = ("requests", "input_tokens", "cached_input_tokens", "output_tokens", "cost_usd")
+
+
+def _upsert_daily(rows):
+    """INSERT ... ON CONFLICT DO UPDATE sumando (PostgreSQL y SQLite)."""
+    dialect = db.session.get_bind().dialect.name
+    table = UsageDaily.__table__
+    if dialect == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert as dialect_insert
+    elif dialect == "sqlite":
+        from sqlalchemy.dialects.sqlite import insert as dialect_insert
+    else:
+        for row in rows:
+            existing = db.session.get(UsageDaily, (row["user_id"], row["model"], row["day"]))
+            if existing is None:
+                db.session.add(UsageDaily(**row))
+            else:
+                for col in SUM_COLUMNS:
+                    setattr(existing, col, getattr(existing, col) + row[col])
+        return
+
+    stmt = dialect_insert(table).values(rows)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[table.c.user_id, table.c.model, table.c.day],
+        set_={col: table.c[col] + stmt.excluded[col] for col in SUM_COLUMNS},
+    )
+    db.session.execute(stmt)
+
+
+def init_usage_ledger(app):
+    ledger = UsageLedger(
+        app,
+        flush_interval=app.config.get("USAGE_FLUSH_INTERVAL", 5.0),
+        batch_size=app.config.get("USAGE_FLUSH_BATCH", 200),
+    )
+    app.extensions["usage_ledger"] = ledger
+    return ledger
+
+
+def record_usage(user_id, model, resp, message_id=None):
+    """Atajo para registrar el `usage` de una respuesta de OpenAI."""
+    ledger = current_app.extensions.get("usage_ledger")
+    if ledger is not None:
+        ledger.record(user_id, model, usage_from_response(resp), message_id)
+
+
+def quota_required(f):
+    """
+    Rechaza con 429 si el usuario ha superado su cuota diaria de tokens o de
+    coste (DAILY_TOKEN_QUOTA / DAILY_COST_QUOTA_USD; 0 = sin límite).
+    Solo se comprueba en POST: leer el historial no consume tokens.
+    """
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        if request.method != "POST":
+            return f(*args, **kwargs)
+        token_quota = current_app.config.get("DAILY_TOKEN_QUOTA", 0)
+        cost_quota = current_app.config.get("DAILY_COST_QUOTA_USD", 0)
+        ledger = current_app.extensions.get("usage_ledger")
+        if ledger is not None and (token_quota or cost_quota) and current_user.is_authenticated:
+            tokens, cost = ledger.spent_today(current_user.id)
+            if (token_quota and tokens >= token_quota) or (cost_quota and cost >= cost_quota):
+                response = jsonify({
+                    "error_code": "QUOTA_EXCEEDED",
+                    "error": "Has alcanzado tu cuota diaria de uso.",
+                })
+                response.status_code = 429
+                return response
+        return f(*args, **kwargs)
+    return decorated_function
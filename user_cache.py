@@ -0,0 +1,76 @@
+# user_cache.py
+"""
+Caché de identidad para el user_loader de Flask-Login.
+
+Sin ella, cada petición autenticada (incluidos el streaming y los sondeos de
+la barra lateral) hace un SELECT a `users`. Aquí se guardan solo los campos
+que usan `login_required`, `admin_required`, las rutas y las plantillas, con
+un TTL corto: si el admin edita o revoca a un usuario se invalida su entrada,
+y en el peor caso (otro worker con backend "memory") deja de valer en
+USER_CACHE_TTL segundos.
+"""
+from flask import current_app
+from flask_login import UserMixin
+
+import metrics
+from models import db, User
+from response_cache import build_cache
+
+# Campos que se leen de current_user en la aplicación
+IDENTITY_FIELDS = ("id", "username", "is_admin", "is_approved", "tier")
+
+
+class CachedUser(UserMixin):
+    """Identidad de solo lectura reconstruida desde la caché (sin sesión ORM)."""
+
+    def __init__(self, data):
+        for field in IDENTITY_FIELDS:
+            setattr(self, field, data.get(field))
+
+    @property
+    def is_active(self):
+        return bool(self.is_approved)
+
+
+def _key(user_id):
+    return f"user:{user_id}"
+
+
+def load_identity(user_id):
+    """
+    Devuelve el usuario para Flask-Login, o None si no existe o ya no está
+    aprobado (la sesión se trata entonces como anónima).
+    """
+    cache = current_app.extensions.get("user_cache")
+    data = cache.get(_key(user_id)) if cache is not None else None
+    if cache is not None:
+        metrics.cache_lookup("user", data is not None)
+    if data is None:
+        user = db.session.get(User, user_id)
+        if user is None:
+            return None
+        data = {field: getattr(user, field) for field in IDENTITY_FIELDS}
+        if cache is not None:
+            cache.set(_key(user_id), data)
+    if not data.get("is_approved"):
+        return None
+    return CachedUser(data)
+
+
+def invalidate_user(*user_ids):
+    cache = current_app.extensions.get("user_cache")
+    if cache is not None:
+        for user_id in user_ids:
+            cache.delete(_key(user_id))
+
+
+def init_user_cache(app):
+    cache = build_cache(
+        app.config.get("USER_CACHE_BACKEND"),
+        app.config.get("USER_CACHE_PATH"),
+        app.config.get("USER_CACHE_TTL", 30),
+        max_entries=app.config.get("USER_CACHE_MAX_ENTRIES", 10000),
+        max_bytes=4 * 1024 * 1024,
+    )
+    app.extensions["user_cache"] = cache
+    return cache